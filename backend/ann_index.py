@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# 向量数少于该值时直接暴力检索，不建倒排表
+BRUTE_FORCE_LIMIT = 4096
+# 训练聚类中心时最多使用的样本数
+TRAIN_SAMPLE_SIZE = 50000
+
+
+def normalize(vectors):
+    """按行做 L2 归一化，返回 float32 数组"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class IVFIndex:
+    """
+    纯 NumPy 实现的倒排文件（IVF）近似最近邻索引，相似度为余弦相似度
+
+    向量按球面 k-means 聚类到 sqrt(N) 个中心，查询时只扫描最近的 nprobe 个中心下的向量。
+    支持增量插入和删除，删除后空出的编号由之后插入的向量复用，数组不会随替换无限增长；
+    有效向量数增长到训练时的两倍后重新训练。
+    """
+
+    def __init__(self, dim, nprobe=8, seed=0):
+        self.dim = dim
+        self.nprobe = nprobe
+        self._rng = np.random.default_rng(seed)
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._alive = np.empty(0, dtype=bool)
+        self._assign = np.empty(0, dtype=np.int32)
+        self._size = 0
+        # 有效向量数与已删除、可复用的编号
+        self._count = 0
+        self._free = []
+        self.centroids = None
+        self._lists = []
+        self._trained_size = 0
+
+    def __len__(self):
+        return self._count
+
+    def _ensure_capacity(self, extra):
+        needed = self._size + extra
+        if needed <= len(self._vectors):
+            return
+        capacity = max(needed, len(self._vectors) * 2, 1024)
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._size] = self._alive[:self._size]
+        assign = np.full(capacity, -1, dtype=np.int32)
+        assign[:self._size] = self._assign[:self._size]
+        self._vectors, self._alive, self._assign = vectors, alive, assign
+
+    def add(self, vectors):
+        """
+        插入向量
+
+        返回:
+        新向量在索引中的编号数组
+        """
+        vectors = normalize(np.atleast_2d(vectors))
+        # 先复用已删除的编号，不够时再追加
+        reused = self._free[max(0, len(self._free) - len(vectors)):]
+        del self._free[len(self._free) - len(reused):]
+        appended = len(vectors) - len(reused)
+        self._ensure_capacity(appended)
+        ids = np.concatenate([
+            np.asarray(reused, dtype=np.int64),
+            np.arange(self._size, self._size + appended, dtype=np.int64)
+        ])
+        self._vectors[ids] = vectors
+        self._alive[ids] = True
+        self._size += appended
+        self._count += len(vectors)
+
+        if self.centroids is not None:
+            assign = self._nearest_centroids(vectors)
+            self._assign[ids] = assign
+            for slot, list_id in zip(ids.tolist(), assign.tolist()):
+                self._lists[list_id].append(slot)
+        if self._count >= BRUTE_FORCE_LIMIT and self._count >= 2 * self._trained_size:
+            self.train()
+        return ids
+
+    def remove(self, ids):
+        """删除向量，编号留给之后插入的向量复用"""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[self._alive[ids]]
+        self._alive[ids] = False
+        if self.centroids is not None:
+            for slot, list_id in zip(ids.tolist(), self._assign[ids].tolist()):
+                self._lists[list_id].remove(slot)
+        self._assign[ids] = -1
+        self._free.extend(ids.tolist())
+        self._count -= len(ids)
+
+    def vector(self, slot):
+        return self._vectors[slot]
+
+    def _nearest_centroids(self, vectors, chunk=65536):
+        result = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            result[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ self.centroids.T, axis=1)
+        return result
+
+    def train(self, iterations=10):
+        """用球面 k-means 重新计算聚类中心并重建倒排表"""
+        alive_ids = np.flatnonzero(self._alive[:self._size])
+        # 记下本次训练时的有效向量数，数量不足而不建倒排表时同样记下，避免每次插入都重新检查
+        self._trained_size = len(alive_ids)
+        if len(alive_ids) < BRUTE_FORCE_LIMIT:
+            self.centroids = None
+            self._lists = []
+            return
+        num_lists = int(np.sqrt(len(alive_ids)))
+        sample_ids = alive_ids
+        if len(sample_ids) > TRAIN_SAMPLE_SIZE:
+            sample_ids = self._rng.choice(alive_ids, TRAIN_SAMPLE_SIZE, replace=False)
+        sample = self._vectors[sample_ids]
+        centroids = sample[self._rng.choice(len(sample), num_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=num_lists)
+            # 空簇用随机样本重新初始化
+            empty = counts == 0
+            sums[empty] = sample[self._rng.choice(len(sample), int(empty.sum()))]
+            centroids = normalize(sums)
+        self.centroids = centroids
+        self._assign[:self._size] = -1
+        self._assign[alive_ids] = self._nearest_centroids(self._vectors[alive_ids])
+        self._rebuild_lists()
+
+    def _rebuild_lists(self):
+        # 已删除的编号 assign 为 -1，排在所有倒排表之前
+        self._lists = [[] for _ in range(len(self.centroids))]
+        assign = self._assign[:self._size]
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        for list_id in range(len(self.centroids)):
+            self._lists[list_id] = order[bounds[list_id]:bounds[list_id + 1]].tolist()
+
+    def search(self, query, k, exclude=None):
+        """
+        查询与 query 最相似的 k 个向量
+
+        参数:
+        exclude -- 需要排除的编号，可以是单个编号或编号数组
+
+        返回:
+        (编号数组, 相似度数组)，按相似度降序
+        """
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = normalize(query)
+        if self.centroids is None:
+            candidates = np.arange(self._size)
+        else:
+            nprobe = min(self.nprobe, len(self.centroids))
+            centroid_scores = self.centroids @ query
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            candidates = np.fromiter(
+                (slot for list_id in probes for slot in self._lists[list_id]), dtype=np.int64)
+        candidates = candidates[self._alive[candidates]]
+        if exclude is not None:
+            candidates = candidates[~np.isin(candidates, exclude)]
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = self._vectors[candidates] @ query
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return candidates[top], scores[top]
+
+    def save(self, path, **extra):
+        """保存到 .npz 文件，extra 为需要一并保存的数组"""
+        arrays = {
+            "vectors": self._vectors[:self._size],
+            "alive": self._alive[:self._size],
+            "assign": self._assign[:self._size],
+            "trained_size": np.asarray(self._trained_size)
+        }
+        if self.centroids is not None:
+            arrays["centroids"] = self.centroids
+        arrays.update(extra)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path, nprobe=8):
+        """
+        从 .npz 文件加载
+
+        返回:
+        (索引, 文件中全部数组)
+        """
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        index = cls(arrays["vectors"].shape[1], nprobe=nprobe)
+        index._size = len(arrays["vectors"])
+        index._vectors = arrays["vectors"].astype(np.float32)
+        index._alive = arrays["alive"].astype(bool)
+        index._assign = arrays["assign"].astype(np.int32)
+        index._assign[~index._alive] = -1
+        index._count = int(index._alive.sum())
+        index._free = np.flatnonzero(~index._alive).tolist()
+        index._trained_size = int(arrays["trained_size"])
+        if "centroids" in arrays:
+            index.centroids = arrays["centroids"].astype(np.float32)
+            index._rebuild_lists()
+        return index, arrays
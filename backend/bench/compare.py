@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import argparse
+
+
+def _key(entry):
+    return entry["suite"], entry["name"], json.dumps(entry["params"], sort_keys=True)
+
+
+def load_results(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data.get("environment", {}), {_key(entry): entry for entry in data["results"]}
+
+
+def compare(base_path, new_path, metric="p50_ms", threshold=0.1):
+    """
+    比较两次运行的结果
+
+    返回:
+    变慢超过 threshold（相对比例）的条目列表
+    """
+    base_env, base = load_results(base_path)
+    new_env, new = load_results(new_path)
+    print(f"基准: {base_env.get('git_commit')}  对比: {new_env.get('git_commit')}  指标: {metric}")
+    regressions = []
+    for key in sorted(set(base) & set(new)):
+        old_value = base[key]["stats"][metric]
+        new_value = new[key]["stats"][metric]
+        ratio = new_value / old_value if old_value > 0 else float('inf')
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  <-- 变慢"
+            regressions.append((key, old_value, new_value, ratio))
+        elif ratio < 1 - threshold:
+            flag = "  <-- 变快"
+        suite, name, params = key
+        print(f"[{suite}] {name} {params}: {old_value:.3f} -> {new_value:.3f} ms (x{ratio:.2f}){flag}")
+    for key in sorted(set(base) ^ set(new)):
+        print(f"[{key[0]}] {key[1]} {key[2]}: 仅在{'基准' if key in base else '对比'}结果中出现")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较两次基准测试结果')
+    parser.add_argument('base', type=str, help='基准结果 JSON')
+    parser.add_argument('new', type=str, help='对比结果 JSON')
+    parser.add_argument('-metric', type=str, default='p50_ms', choices=['mean_ms', 'p50_ms', 'p95_ms', 'min_ms'],
+                        help='比较的统计量')
+    parser.add_argument('-threshold', type=float, default=0.1, help='超过该相对比例视为变慢')
+    args = parser.parse_args()
+    regressions = compare(args.base, args.new, args.metric, args.threshold)
+    # 有变慢的条目时返回非零，便于在脚本中判断
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
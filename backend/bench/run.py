@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from bench.synthetic import make_wav, make_mp4, make_music_db
+from bench.stubs import build_emotion_predictor, StubMusicTagger
+
+SUITES = ("recommend", "features", "api")
+
+
+def summarize(samples):
+    """把耗时样本（秒）汇总为毫秒统计"""
+    samples = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        "n": int(len(samples)),
+        "mean_ms": round(float(samples.mean()), 4),
+        "p50_ms": round(float(np.percentile(samples, 50)), 4),
+        "p95_ms": round(float(np.percentile(samples, 95)), 4),
+        "min_ms": round(float(samples.min()), 4),
+        "max_ms": round(float(samples.max()), 4)
+    }
+
+
+class BenchRun:
+    """收集一次运行的全部结果，最后写成 JSON"""
+
+    def __init__(self):
+        self.results = []
+        self.skipped = []
+
+    def measure(self, suite, name, params, func, inputs, warmup=1, stubbed=False):
+        """
+        对 inputs 中的每个输入调用一次 func 并计时
+
+        参数:
+        warmup -- 正式计时前用前几个输入预热的次数，预热结果不计入
+        """
+        inputs = list(inputs)
+        for item in inputs[:warmup]:
+            func(item)
+        samples = []
+        for item in inputs:
+            start = time.perf_counter()
+            func(item)
+            samples.append(time.perf_counter() - start)
+        self.record(suite, name, params, samples, stubbed=stubbed)
+
+    def record(self, suite, name, params, samples, stubbed=False, **extra):
+        entry = {"suite": suite, "name": name, "params": params, "stubbed": stubbed, "stats": summarize(samples)}
+        entry.update(extra)
+        self.results.append(entry)
+        stats = entry["stats"]
+        print(f"[{suite}] {name} {params}: p50 {stats['p50_ms']:.3f}ms  p95 {stats['p95_ms']:.3f}ms  (n={stats['n']})")
+
+    def skip(self, suite, reason):
+        self.skipped.append({"suite": suite, "reason": reason})
+        print(f"[{suite}] 跳过: {reason}")
+
+
+def environment():
+    """记录运行环境，便于跨提交比较时确认条件一致"""
+    def git(*command):
+        try:
+            return subprocess.run(['git', *command], cwd=BACKEND_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": git('rev-parse', 'HEAD'),
+        "git_dirty": bool(git('status', '--porcelain', '--', '.')),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__
+    }
+
+
+def read_wav_pcm(path):
+    with wave.open(path, 'rb') as f:
+        return np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+
+
+def bench_recommend(run, args, work_dir):
+    from music_recommender import get_music_recommendations, MusicRecommenderIndex, MusicEmbeddingIndex, MusicTagIndex
+
+    rng = np.random.default_rng(0)
+    for rows in args.rows:
+        db_path = make_music_db(os.path.join(work_dir, f"music_{rows}.db"), rows, embedding_dim=50)
+        params = {"rows": rows}
+        names = [f"track_{i:07d}.mp3" for i in rng.integers(0, rows, size=args.repeat)]
+
+        # 一次性接口每次都重新读库建索引，大曲库时减少次数
+        one_shot = names[:max(3, args.repeat // max(1, rows // 10000))]
+        run.measure("recommend", "get_music_recommendations", params,
+                    lambda name: get_music_recommendations(db_path, name, 3), one_shot)
+
+        run.measure("recommend", "MusicRecommenderIndex.build", params,
+                    lambda _: MusicRecommenderIndex(db_path).refresh(), range(3), warmup=0)
+        index = MusicRecommenderIndex(db_path)
+        run.measure("recommend", "MusicRecommenderIndex.recommend", params,
+                    lambda name: index.recommend(name, 3), names)
+        run.measure("recommend", "MusicRecommenderIndex.recommend_blend", params,
+                    lambda start: index.recommend_many(names[start:start + 10], 10, blend=True),
+                    range(0, len(names), 10))
+
+        # 首次同步解析全部 style_label 写入 music_tags，之后只在查询时处理变化的行
+        run.measure("recommend", "MusicTagIndex.sync", params,
+                    lambda _: MusicTagIndex(db_path).sync(), range(1), warmup=0)
+        tags = MusicTagIndex(db_path)
+        run.measure("recommend", "MusicTagIndex.recommend", params,
+                    lambda name: tags.recommend(name, 3), names)
+
+        if rows <= args.neighbours_max_rows:
+            run.measure("recommend", "MusicRecommenderIndex.precompute_neighbours", params,
+                        lambda _: MusicRecommenderIndex(db_path).precompute_neighbours(20), range(1), warmup=0)
+            precomputed = MusicRecommenderIndex(db_path)
+            run.measure("recommend", "MusicRecommenderIndex.recommend_precomputed", params,
+                        lambda name: precomputed.recommend(name, 3), names)
+
+        index_path = os.path.join(work_dir, f"music_{rows}.ann.npz")
+
+        def build_embeddings(_):
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            MusicEmbeddingIndex(db_path, index_path=index_path).refresh()
+
+        run.measure("recommend", "MusicEmbeddingIndex.build", params, build_embeddings, range(1), warmup=0)
+        embeddings = MusicEmbeddingIndex(db_path, index_path=index_path)
+        run.measure("recommend", "MusicEmbeddingIndex.recommend", params,
+                    lambda name: embeddings.recommend(name, 3), names)
+
+
+def bench_features(run, args, work_dir):
+    try:
+        predictor, stubbed = build_emotion_predictor(args.model_path, args.bert_path)
+    except ImportError as e:
+        run.skip("features", f"缺少依赖: {e}")
+        return
+    try:
+        video_path = make_mp4(os.path.join(work_dir, "clip.mp4"), seconds=args.video_seconds)
+    except (ImportError, RuntimeError, subprocess.CalledProcessError) as e:
+        run.skip("features", f"无法生成测试视频: {e}")
+        return
+    from media_decoder import DecodedMedia
+
+    params = {"video_seconds": args.video_seconds}
+    repeat = range(args.feature_repeat)
+    run.measure("features", "decode_media", params, lambda _: predictor.decode_media(video_path).release(), repeat)
+
+    with DecodedMedia(video_path) as media:
+        audio = media.audio_float()
+        run.measure("features", "extract_audio_features", params,
+                    lambda _: predictor.extract_audio_features(audio), repeat)
+        run.measure("features", "extract_video_features", params,
+                    lambda _: predictor.extract_video_features(media), repeat)
+
+    text = "the quick brown fox jumps over the lazy dog " * 4
+    run.measure("features", "extract_text_features", {"words": len(text.split())},
+                lambda _: predictor.extract_text_features(text), repeat, stubbed=stubbed)
+
+    for kind in ("sine", "noise"):
+        pcm = read_wav_pcm(make_wav(os.path.join(work_dir, f"{kind}.wav"), args.audio_seconds, kind=kind))
+        for max_tokens in (108, None):
+            run.measure("features", "extract_text_from_audio",
+                        {"audio_seconds": args.audio_seconds, "kind": kind, "max_tokens": max_tokens},
+                        lambda _: predictor.extract_text_from_audio(pcm, max_tokens=max_tokens), repeat,
+                        stubbed=stubbed)
+
+    run.measure("features", "extract_features", params,
+                lambda _: predictor.extract_features(video_path), repeat, stubbed=stubbed)
+    predictor.close()
+
+
+def bench_api(run, args, work_dir):
+    try:
+        importlib.import_module("flask")
+    except ImportError as e:
+        run.skip("api", f"缺少依赖: {e}")
+        return
+
+    rows = args.api_rows
+    db_path = make_music_db(os.path.join(work_dir, f"api_{rows}.db"), rows, embedding_dim=50)
+    # main 在导入时解析命令行参数并创建全局对象
+    argv = sys.argv
+    sys.argv = ['main.py', '-db_path', db_path, '-startup', 'lazy', '-log_level', 'WARNING',
+                '-cache_path', os.path.join(work_dir, 'cache.sqlite'),
+                '-feature_dir', os.path.join(work_dir, 'features')]
+    try:
+        main = importlib.import_module("main")
+    finally:
+        sys.argv = argv
+
+    tagger_stubbed = not args.real_models
+    if tagger_stubbed:
+        main.music_tagger_model.loader = StubMusicTagger
+    emotion_stubbed = True
+    try:
+        predictor, emotion_stubbed = build_emotion_predictor(args.model_path, args.bert_path)
+        main.emotion_model.loader = lambda: predictor
+    except ImportError as e:
+        predictor = None
+        run.skip("api", f"情感接口缺少依赖: {e}")
+
+    client = main.app.test_client()
+    params = {"rows": rows}
+    rng = np.random.default_rng(1)
+    names = [f"track_{i:07d}.mp3" for i in rng.integers(0, rows, size=args.repeat)]
+
+    def post(url, payload):
+        response = client.post(url, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} 返回 {response.status_code}: {response.get_data(as_text=True)}")
+        return response
+
+    run.measure("api", "GET /api/hello", {}, lambda _: client.get('/api/hello'), range(args.repeat))
+    run.measure("api", "POST /api/recommend", params,
+                lambda name: post('/api/recommend', {"file_name": name, "top_n": 3}), names)
+    run.measure("api", "POST /api/recommend/batch", dict(params, seeds=10, blend=True),
+                lambda start: post('/api/recommend/batch',
+                                   {"file_names": names[start:start + 10], "top_n": 10, "blend": True}),
+                range(0, len(names), 10))
+
+    wav_paths = [make_wav(os.path.join(work_dir, f"song_{i}.wav"), 5.0, kind="noise", seed=i)
+                 for i in range(args.feature_repeat + 1)]
+    run.measure("api", "POST /api/musiclabel (miss)", {"audio_seconds": 5.0},
+                lambda path: post('/api/musiclabel', {"path": path}), wav_paths, stubbed=tagger_stubbed)
+    run.measure("api", "POST /api/musiclabel (cache hit)", {"audio_seconds": 5.0},
+                lambda _: post('/api/musiclabel', {"path": wav_paths[0]}), range(args.repeat),
+                stubbed=tagger_stubbed)
+
+    if predictor is not None:
+        try:
+            video_path = make_mp4(os.path.join(work_dir, "api_clip.mp4"), seconds=args.video_seconds)
+        except (ImportError, RuntimeError, subprocess.CalledProcessError) as e:
+            run.skip("api", f"无法生成测试视频: {e}")
+        else:
+            run.measure("api", "POST /api/emotion (miss)", {"video_seconds": args.video_seconds},
+                        lambda _: post('/api/emotion', {"path": video_path}), range(1), warmup=0,
+                        stubbed=emotion_stubbed)
+            run.measure("api", "POST /api/emotion (cache hit)", {"video_seconds": args.video_seconds},
+                        lambda _: post('/api/emotion', {"path": video_path}), range(args.repeat),
+                        stubbed=emotion_stubbed)
+
+    # 吞吐：多个客户端并发请求推荐接口
+    per_client = args.repeat
+    def client_loop(seed):
+        local_client = main.app.test_client()
+        local_names = np.random.default_rng(seed).integers(0, rows, size=per_client)
+        samples = []
+        for i in local_names:
+            start = time.perf_counter()
+            local_client.post('/api/recommend', json={"file_name": f"track_{i:07d}.mp3", "top_n": 3})
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        samples = [s for result in executor.map(client_loop, range(args.concurrency)) for s in result]
+    elapsed = time.perf_counter() - start
+    run.record("api", "POST /api/recommend (concurrent)", dict(params, concurrency=args.concurrency), samples,
+               throughput_rps=round(len(samples) / elapsed, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='后端性能基准测试，结果写为 JSON')
+    parser.add_argument('-suites', type=str, default=','.join(SUITES), help=f'要运行的测试组，逗号分隔：{",".join(SUITES)}')
+    parser.add_argument('-rows', type=str, default='1000,10000,100000', help='合成曲库的歌曲数，逗号分隔，可到1000000')
+    parser.add_argument('-repeat', type=int, default=50, help='快速操作的重复次数')
+    parser.add_argument('-feature_repeat', type=int, default=5, help='特征提取等慢操作的重复次数')
+    parser.add_argument('-neighbours_max_rows', type=int, default=20000, help='歌曲数不超过该值时测试近邻预计算')
+    parser.add_argument('-video_seconds', type=float, default=10.0, help='合成视频时长（秒）')
+    parser.add_argument('-audio_seconds', type=float, default=30.0, help='语音识别测试音频时长（秒）')
+    parser.add_argument('-api_rows', type=int, default=10000, help='接口测试使用的曲库歌曲数')
+    parser.add_argument('-concurrency', type=int, default=4, help='接口吞吐测试的并发客户端数')
+    parser.add_argument('-model_path', type=str, default=None, help='情感模型目录，不存在时使用替身')
+    parser.add_argument('-bert_path', type=str, default=None, help='BERT模型目录，不存在时使用替身')
+    parser.add_argument('-real_models', action='store_true', help='接口测试使用真实 musicnn 模型')
+    parser.add_argument('-work_dir', type=str, default=None, help='合成数据目录，默认使用临时目录并在结束后删除')
+    parser.add_argument('-output', type=str, default=None, help='结果 JSON 路径，默认 bench/results/<时间>-<提交>.json')
+    args = parser.parse_args()
+    args.rows = [int(value) for value in args.rows.split(',') if value]
+    suites = [name for name in args.suites.split(',') if name]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"未知的测试组: {', '.join(sorted(unknown))}")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="soyo-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    run = BenchRun()
+    env = environment()
+    try:
+        for name in suites:
+            globals()[f"bench_{name}"](run, args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(BENCH_DIR, 'results', f"{stamp}-{(env['git_commit'] or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"environment": env, "results": run.results, "skipped": run.skipped}, f,
+                  ensure_ascii=False, indent=2)
+    print(f"结果已写入: {output}")
+
+
+if __name__ == '__main__':
+    main()
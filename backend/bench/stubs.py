@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# 没有模型权重时使用的替身：只替换模型前向（BERT、情感模型、Vosk、musicnn），
+# 解码、MFCC、帧采样、投影、微批处理等仍走真实实现，结果中以 "stubbed": true 标注
+import os
+import json
+import queue
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from micro_batcher import MicroBatcher
+from lazy_model import ModelRegistry
+
+# bert-base-uncased 的隐藏层维度
+BERT_HIDDEN_SIZE = 768
+NUM_CLASSES = 6
+
+
+class StubTokenizer:
+    """只实现 extract_text_from_audio 用到的 tokenize"""
+
+    def tokenize(self, text):
+        return text.split()
+
+
+class StubRecognizer:
+    """模拟 Vosk KaldiRecognizer：每收到 chunks_per_result 块返回一句固定文本"""
+
+    def __init__(self, chunks_per_result=4, sentence="the quick brown fox jumps over the lazy dog"):
+        self.chunks_per_result = chunks_per_result
+        self.sentence = sentence
+        self._chunks = 0
+
+    def AcceptWaveform(self, chunk):
+        self._chunks += 1
+        return self._chunks % self.chunks_per_result == 0
+
+    def Result(self):
+        return json.dumps({"text": self.sentence})
+
+    def FinalResult(self):
+        return json.dumps({"text": ""})
+
+    def Reset(self):
+        self._chunks = 0
+
+
+def _text_seed(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def stub_encode_text_batch(texts):
+    """按文本内容生成确定的 (token数, 768) 隐藏状态"""
+    outputs = []
+    for text in texts:
+        length = min(len(text.split()) + 2, 110)
+        rng = np.random.default_rng(_text_seed(text))
+        outputs.append(rng.standard_normal((length, BERT_HIDDEN_SIZE), dtype=np.float32))
+    return outputs
+
+
+def stub_infer_batch(items):
+    """返回由输入特征决定的 (110, 类别数) 输出"""
+    results = []
+    for audio_features, video_features, text_features in items:
+        logits = np.stack([
+            audio_features.mean(axis=1), video_features.mean(axis=1), text_features.mean(axis=1),
+            audio_features.std(axis=1), video_features.std(axis=1), text_features.std(axis=1)
+        ], axis=1)[:, :NUM_CLASSES]
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        results.append((exp / exp.sum(axis=1, keepdims=True)).astype(np.float32))
+    return results
+
+
+def build_emotion_predictor(checkpoint_path=None, bert_model_path=None, max_workers=2, batch_size=8):
+    """
+    构造 EmotionPredictor
+
+    两个权重目录都存在时加载真实模型，否则构造一个只替换了模型前向的实例。
+    导入 inference 所需的依赖（TensorFlow、OpenCV、librosa 等）缺失时抛出 ImportError。
+
+    返回:
+    (predictor, 是否使用替身)
+    """
+    import inference
+
+    if checkpoint_path and bert_model_path and os.path.isdir(checkpoint_path) and os.path.isdir(bert_model_path):
+        predictor = inference.EmotionPredictor(
+            checkpoint_path, bert_model_path, max_workers=max_workers, batch_size=batch_size)
+        return predictor, False
+
+    predictor = inference.EmotionPredictor.__new__(inference.EmotionPredictor)
+    predictor.num_classes = NUM_CLASSES
+    predictor.feature_store = None
+    predictor.projection_seed = 0
+    predictor.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="emotion")
+    predictor.recognizer = None
+    predictor.tokenizer = StubTokenizer()
+    predictor.registry = ModelRegistry()
+    predictor.bert_model = predictor.registry.register("bert", lambda: None)
+    predictor.tf_model = predictor.registry.register("emotion_tf", lambda: None)
+    # 非 None 时 extract_text_from_audio 走离线识别分支，识别器由下面的替身提供
+    predictor.vosk = predictor.registry.register("vosk", object)
+    predictor._recognizer_pool = queue.Queue()
+    predictor._acquire_recognizer = lambda vosk_model: StubRecognizer()
+    predictor._release_recognizer = lambda recognizer: None
+    predictor.text_batcher = MicroBatcher(stub_encode_text_batch, batch_size, 5, name="stub-bert")
+    predictor.inference_batcher = MicroBatcher(stub_infer_batch, batch_size, 5, name="stub-model")
+    predictor.projections = {
+        name: predictor._make_projection(current_dim, 100)
+        for name, current_dim in (("text", BERT_HIDDEN_SIZE), ("audio", 20), ("video", 64 * 64 * 3))
+    }
+    return predictor, True
+
+
+class StubMusicTagger:
+    """模拟 MusicTagger：读取文件后按内容生成确定的标签概率向量"""
+
+    labels = [f"tag_{i}" for i in range(50)]
+
+    def analyze(self, file_path, top_n=5):
+        with open(file_path, 'rb') as f:
+            seed = _text_seed(hashlib.blake2b(f.read()).hexdigest())
+        likelihood_mean = np.random.default_rng(seed).dirichlet(np.full(len(self.labels), 0.3)).astype(np.float32)
+        top = likelihood_mean.argsort()[-top_n:][::-1]
+        return [self.labels[i] for i in top], likelihood_mean
+
+    def top_tags(self, file_path, top_n=5):
+        return self.analyze(file_path, top_n)[0]
+
+    def tag_files(self, file_paths, top_n=5):
+        for path in file_paths:
+            try:
+                labels, embedding = self.analyze(path, top_n)
+            except OSError as e:
+                yield {"path": path, "error": str(e)}
+                continue
+            yield {"path": path, "labels": labels, "embedding": embedding}
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import os
+import wave
+import shutil
+import sqlite3
+import subprocess
+
+import numpy as np
+
+# 合成曲库使用的风格标签
+STYLE_TAGS = (
+    "rock", "pop", "alternative", "indie", "electronic", "female vocalists", "dance", "00s",
+    "alternative rock", "jazz", "beautiful", "metal", "chillout", "male vocalists", "classic rock",
+    "soul", "indie rock", "Mellow", "electronica", "80s", "folk", "90s", "chill", "instrumental",
+    "punk", "oldies", "blues", "hard rock", "ambient", "acoustic", "experimental", "female vocalist",
+    "guitar", "Hip-Hop", "70s", "party", "country", "easy listening", "sexy", "catchy", "funk",
+    "electro", "heavy metal", "Progressive rock", "60s", "rnb", "indie pop", "sad", "House", "happy"
+)
+
+
+def make_wav(path, seconds=30.0, sample_rate=16000, kind="sine", seed=0):
+    """
+    生成单声道16位WAV文件
+
+    参数:
+    kind -- "sine" 为若干正弦波叠加（带简单节奏包络），"noise" 为白噪声
+    """
+    num_samples = int(seconds * sample_rate)
+    t = np.arange(num_samples, dtype=np.float32) / sample_rate
+    if kind == "sine":
+        signal = sum(np.sin(2 * np.pi * freq * t) for freq in (220.0, 330.0, 440.0)) / 3
+        # 每0.5秒一拍的包络，避免音频完全平稳
+        signal *= 0.5 + 0.5 * (np.mod(t, 0.5) < 0.25)
+    elif kind == "noise":
+        signal = np.random.default_rng(seed).uniform(-1.0, 1.0, num_samples)
+    else:
+        raise ValueError(f"未知的音频类型: {kind}")
+    pcm = (np.clip(signal, -1.0, 1.0) * 0.8 * 32767).astype('<i2')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+    return path
+
+
+def find_ffmpeg():
+    """返回 ffmpeg 可执行文件路径，找不到时返回 None"""
+    try:
+        from moviepy.config import get_setting
+        binary = get_setting("FFMPEG_BINARY")
+        if binary and shutil.which(binary):
+            return binary
+    except ImportError:
+        pass
+    return shutil.which("ffmpeg")
+
+
+def make_mp4(path, seconds=10.0, fps=25, size=(320, 240), seed=0):
+    """
+    生成带音轨的MP4：画面为移动的色块，音轨为正弦波
+
+    需要 OpenCV 写入画面、ffmpeg 合并音轨
+    """
+    import cv2
+
+    ffmpeg = find_ffmpeg()
+    if ffmpeg is None:
+        raise RuntimeError("找不到 ffmpeg，无法生成带音轨的视频")
+
+    width, height = size
+    rng = np.random.default_rng(seed)
+    silent_path = path + ".video.mp4"
+    audio_path = path + ".audio.wav"
+    writer = cv2.VideoWriter(silent_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    try:
+        background = rng.integers(0, 255, size=3).tolist()
+        for i in range(int(seconds * fps)):
+            frame = np.full((height, width, 3), background, dtype=np.uint8)
+            x = int((i * 4) % max(width - 40, 1))
+            y = int(height / 2 + height / 4 * np.sin(i / fps * 2 * np.pi))
+            cv2.rectangle(frame, (x, max(y - 20, 0)), (x + 40, min(y + 20, height - 1)), (255, 255, 255), -1)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+    make_wav(audio_path, seconds, kind="sine")
+    try:
+        subprocess.run(
+            [ffmpeg, '-v', 'error', '-y', '-i', silent_path, '-i', audio_path,
+             '-c:v', 'copy', '-c:a', 'aac', '-shortest', path],
+            check=True
+        )
+    finally:
+        for temp_path in (silent_path, audio_path):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return path
+
+
+def make_music_db(path, rows, tags_per_track=(2, 5), seed=0, embedding_dim=None):
+    """
+    生成与前端表结构一致的 music_labels 数据库
+
+    参数:
+    rows -- 歌曲数
+    tags_per_track -- 每首歌标签数的范围（含两端）
+    embedding_dim -- 不为 None 时同时生成 music_embeddings 表，向量为该维度的随机概率向量
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(seed)
+    # 标签按 Zipf 分布抽取，接近真实曲库中少数风格占多数的情况
+    weights = 1.0 / np.arange(1, len(STYLE_TAGS) + 1)
+    weights /= weights.sum()
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('''
+            CREATE TABLE music_labels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_name TEXT NOT NULL,
+                file_path TEXT NOT NULL UNIQUE,
+                style_label TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        chunk = 50000
+        for start in range(0, rows, chunk):
+            batch = []
+            for i in range(start, min(start + chunk, rows)):
+                count = int(rng.integers(tags_per_track[0], tags_per_track[1] + 1))
+                tags = rng.choice(len(STYLE_TAGS), size=count, replace=False, p=weights)
+                batch.append((f"track_{i:07d}.mp3", f"/music/track_{i:07d}.mp3",
+                              ", ".join(STYLE_TAGS[t] for t in tags)))
+            conn.executemany('INSERT INTO music_labels (file_name, file_path, style_label) VALUES (?, ?, ?)', batch)
+
+        if embedding_dim is not None:
+            conn.execute('''
+                CREATE TABLE music_embeddings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_path TEXT NOT NULL UNIQUE,
+                    file_name TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            for start in range(0, rows, chunk):
+                count = min(start + chunk, rows) - start
+                vectors = rng.dirichlet(np.full(embedding_dim, 0.3), size=count).astype(np.float32)
+                conn.executemany(
+                    'INSERT INTO music_embeddings (file_path, file_name, model, vector) VALUES (?, ?, ?, ?)',
+                    ((f"/music/track_{start + i:07d}.mp3", f"track_{start + i:07d}.mp3", "synthetic",
+                      vectors[i].tobytes()) for i in range(count))
+                )
+        conn.commit()
+    finally:
+        conn.close()
+    return path
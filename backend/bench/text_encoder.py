@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from bench.run import BenchRun, environment, BENCH_DIR
+
+# 覆盖短句、长句和超过110个token需要截断的文本
+SENTENCES = [
+    "hello",
+    "i can't believe you did that",
+    "well that's just great, now we're going to be late again",
+    "the quick brown fox jumps over the lazy dog and keeps running through the forest until night falls",
+    "oh my god this is the best day of my life i got the job i actually got the job",
+    "i don't want to talk about it right now please just leave me alone for a while",
+    "what do you mean you lost the tickets we have been planning this trip for months",
+    " ".join(["and then we went to the market and bought some bread"] * 15),
+]
+
+
+def projection(hidden_size, seed=0):
+    """与 EmotionPredictor._make_projection 相同的 (hidden_size, 100) 投影矩阵"""
+    rng = np.random.default_rng([seed, hidden_size, 100])
+    return rng.standard_normal((hidden_size, 100), dtype=np.float32) / np.sqrt(hidden_size)
+
+
+def drift(reference, outputs, matrix):
+    """各文本逐 token 比较与 fp32 输出的差异，同时比较投影到100维后的特征"""
+    cosines = []
+    max_abs = 0.0
+    projected_max_abs = 0.0
+    for ref, out in zip(reference, outputs):
+        ref_norm = ref / np.maximum(np.linalg.norm(ref, axis=1, keepdims=True), 1e-12)
+        out_norm = out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        cosines.extend(np.sum(ref_norm * out_norm, axis=1).tolist())
+        max_abs = max(max_abs, float(np.abs(ref - out).max()))
+        projected_max_abs = max(projected_max_abs, float(np.abs(ref @ matrix - out @ matrix).max()))
+    return {
+        "mean_cosine": round(float(np.mean(cosines)), 6),
+        "min_cosine": round(float(np.min(cosines)), 6),
+        "max_abs_diff": round(max_abs, 6),
+        "projected_max_abs_diff": round(projected_max_abs, 6)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较各文本编码后端的延迟与相对 fp32 的输出偏差')
+    parser.add_argument('-bert_path', type=str, default="./bert-base-uncased", help='BERT模型路径')
+    parser.add_argument('-encoders', type=str, default='fp32,int8,onnx', help='要比较的后端，逗号分隔')
+    parser.add_argument('-threads', type=int, default=0, help='编码线程数，0 表示不限制')
+    parser.add_argument('-onnx_path', type=str, default=None, help='ONNX 模型路径')
+    parser.add_argument('-repeat', type=int, default=20, help='每种批大小的重复次数')
+    parser.add_argument('-output', type=str, default=None, help='结果 JSON 路径')
+    args = parser.parse_args()
+
+    run = BenchRun()
+    env = environment()
+    try:
+        from text_encoder import build_text_encoder
+    except ImportError as e:
+        run.skip("text_encoder", f"缺少依赖: {e}")
+        kinds = []
+    else:
+        kinds = [kind for kind in args.encoders.split(',') if kind]
+    # 偏差以 fp32 输出为基准
+    if kinds:
+        kinds = ["fp32"] + [kind for kind in kinds if kind != "fp32"]
+
+    reference = None
+    for kind in kinds:
+        try:
+            encoder = build_text_encoder(kind, args.bert_path, args.threads, args.onnx_path)
+        except ImportError as e:
+            run.skip("text_encoder", f"{kind} 缺少依赖: {e}")
+            continue
+
+        outputs = encoder.encode(SENTENCES)
+        if reference is None:
+            reference = outputs
+        extra = drift(reference, outputs, projection(encoder.hidden_size))
+        for batch_size in (1, len(SENTENCES)):
+            batches = [SENTENCES[i:i + batch_size] for i in range(0, len(SENTENCES), batch_size)]
+            inputs = [batches[i % len(batches)] for i in range(args.repeat)]
+            run.measure("text_encoder", kind, {"batch_size": batch_size, "threads": args.threads},
+                        encoder.encode, inputs)
+            run.results[-1]["drift_vs_fp32"] = extra
+        print(f"[text_encoder] {kind} 相对 fp32 的偏差: {extra}")
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(BENCH_DIR, 'results', f"text_encoder-{stamp}-{(env['git_commit'] or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"environment": env, "results": run.results, "skipped": run.skipped}, f,
+                  ensure_ascii=False, indent=2)
+    print(f"结果已写入: {output}")
+
+
+if __name__ == '__main__':
+    main()
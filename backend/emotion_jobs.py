@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# 空闲的工作线程与事件流检查其他进程提交或更新的任务的间隔（秒）
+POLL_INTERVAL = 0.5
+
+
+class QueueFullError(Exception):
+    """任务队列已满"""
+    pass
+
+
+class EmotionJob:
+    """一个情感分析任务的状态"""
+
+    FIELDS = ("id", "path", "status", "stage", "result", "error", "created_at", "updated_at", "version")
+
+    def __init__(self, path):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.status = "queued"  # queued / running / done / failed
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # 每次状态变化自增，供事件流判断是否需要推送
+        self.version = 0
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls.__new__(cls)
+        for name, value in zip(cls.FIELDS, row):
+            setattr(job, name, value)
+        job.result = json.loads(job.result) if job.result is not None else None
+        return job
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "path": self.path,
+            "status": self.status,
+            "stage": self.stage,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+
+class EmotionJobQueue:
+    """
+    后台情感分析任务队列
+
+    提交任务立即返回任务 id，由固定数量的工作线程依次处理；
+    同一路径的任务在排队或运行期间只会存在一个。
+
+    任务状态保存在 SQLite 中：store_path 为文件时，生产模式的多个工作进程共用同一个队列，
+    任一进程都能查询其他进程提交或执行的任务；默认保存在进程内存中。
+    执行任务的进程退出后，它名下运行中的任务由其他进程标记为失败。
+
+    分析无法从外部中断：任务超时后标记为失败，仍在运行的分析转入后台（最多 max_stalled 个），
+    工作线程立即处理下一个任务；后台名额用尽时工作线程等待超时的分析结束，
+    此时排队任务增多，队列满后新任务被拒绝。
+    """
+
+    def __init__(self, run_func, workers=1, max_queue=16, timeout=600, max_finished=1000, max_stalled=None,
+                 store_path=None, name="emotion", start=True):
+        """
+        参数:
+        run_func -- 执行分析的函数，签名为 run_func(path, progress)，progress(stage) 用于上报阶段
+        workers -- 并发工作线程数
+        max_queue -- 最大排队任务数
+        timeout -- 单个任务超时时间（秒）
+        max_finished -- 保留的已完成任务数量
+        max_stalled -- 超时后仍在后台运行的分析数上限，默认与 workers 相同
+        store_path -- 保存任务状态的 SQLite 数据库路径，None 表示只保存在进程内存中
+        name -- 队列名，多个队列可共用同一个 store_path
+        start -- 是否立即启动工作线程；为 False 时由调用方在需要处理任务的进程中调用 start()
+        """
+        self.run_func = run_func
+        self.timeout = timeout
+        self.max_finished = max_finished
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_stalled = workers if max_stalled is None else max_stalled
+        self.store_path = store_path
+        self.name = name
+        self._reset()
+        if start:
+            self.start()
+        if hasattr(os, 'register_at_fork'):
+            # 连接和线程不能跨 fork 使用，生产模式的工作进程各自建立连接，由 start_worker 启动工作线程
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._conn = None
+        self._started = False
+        # 保护连接，并在本进程内的任务状态变化时唤醒等待方
+        self._changed = threading.Condition()
+        # 超时后仍在运行的分析数
+        self._stalled = 0
+        self._runner = None
+
+    def start(self):
+        """启动工作线程，同一进程内重复调用无效"""
+        with self._changed:
+            if self._started:
+                return
+            self._started = True
+            self._db()
+            self._recover_orphans()
+        # 实际执行分析的线程：每个工作线程同时只等待一个分析，加上超时转入后台的分析
+        self._runner = ThreadPoolExecutor(max_workers=self.workers + self.max_stalled,
+                                          thread_name_prefix=f"{self.name}-job")
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True).start()
+
+    def _db(self):
+        """任务状态数据库的连接，调用方需持有 _changed"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.store_path or ':memory:', timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+            if self.store_path:
+                # 任务状态丢失最近一次提交可以接受，不必每个事务都刷盘
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    queue TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    owner INTEGER
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(queue, status, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_path ON jobs(queue, path, status)')
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self):
+        """以 BEGIN IMMEDIATE 开始事务：先查后改的操作在其他进程看来是原子的"""
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def _select(self, conn, job_id):
+        row = conn.execute(
+            f'SELECT {", ".join(EmotionJob.FIELDS)} FROM jobs WHERE id = ? AND queue = ?', (job_id, self.name)
+        ).fetchone()
+        return EmotionJob.from_row(row) if row else None
+
+    def submit(self, path):
+        """提交任务，返回 (任务, 是否为已有任务)"""
+        with self._changed:
+            conn = self._transaction()
+            try:
+                row = conn.execute(
+                    f'''SELECT {", ".join(EmotionJob.FIELDS)} FROM jobs
+                        WHERE queue = ? AND path = ? AND status IN ('queued', 'running')''',
+                    (self.name, path)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('COMMIT')
+                    return EmotionJob.from_row(row), True
+                queued = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE queue = ? AND status = 'queued'", (self.name,)
+                ).fetchone()[0]
+                if queued >= self.max_queue:
+                    raise QueueFullError("任务队列已满，请稍后重试")
+                job = EmotionJob(path)
+                conn.execute(
+                    '''INSERT INTO jobs (id, queue, path, status, created_at, updated_at, version)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (job.id, self.name, job.path, job.status, job.created_at, job.updated_at, job.version)
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            self._changed.notify_all()
+            return job, False
+
+    def get(self, job_id):
+        with self._changed:
+            job = self._select(self._db(), job_id)
+            return job.to_dict() if job else None
+
+    def wait_for_change(self, job_id, version, timeout=15):
+        """
+        等待任务状态变化
+
+        本进程内的变化立即唤醒，其他进程的变化每隔 POLL_INTERVAL 秒检查一次。
+
+        返回:
+        (任务字典, 新版本号)；任务不存在时任务字典为 None
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._select(self._db(), job_id)
+                if job is None:
+                    return None, version
+                remaining = deadline - time.monotonic()
+                if job.version != version or remaining <= 0:
+                    return job.to_dict(), job.version
+                self._changed.wait(min(remaining, POLL_INTERVAL))
+
+    def stats(self):
+        with self._changed:
+            counts = dict(self._db().execute(
+                'SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status', (self.name,)))
+            stalled = self._stalled
+        return {"queue_depth": counts.get("queued", 0), "jobs": counts, "stalled": stalled}
+
+    def _update(self, job_id, only_running=False, **fields):
+        """更新任务字段并自增版本号；only_running 为 True 时只更新仍在运行的任务"""
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        assignments = "".join(f"{name} = ?, " for name in fields)
+        condition = " AND status = 'running'" if only_running else ""
+        with self._changed:
+            self._db().execute(
+                f'UPDATE jobs SET {assignments}updated_at = ?, version = version + 1 WHERE id = ?{condition}',
+                (*fields.values(), time.time(), job_id)
+            )
+            if fields.get("status") in ("done", "failed"):
+                self._evict_finished()
+            self._changed.notify_all()
+
+    def _progress(self, job_id, stage):
+        # 超时后仍在运行的分析不再更新任务状态
+        self._update(job_id, only_running=True, stage=stage)
+
+    def _evict_finished(self):
+        self._db().execute('''
+            DELETE FROM jobs WHERE id IN (
+                SELECT id FROM jobs WHERE queue = ? AND status IN ('done', 'failed')
+                ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.name, self.max_finished))
+
+    def _claim(self):
+        """取出最早排队的任务并标记为本进程运行中，没有排队任务时返回 None"""
+        with self._changed:
+            conn = self._transaction()
+            try:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE queue = ? AND status = 'queued' ORDER BY created_at LIMIT 1",
+                    (self.name,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('''
+                        UPDATE jobs SET status = 'running', stage = 'starting', owner = ?,
+                            updated_at = ?, version = version + 1
+                        WHERE id = ?
+                    ''', (os.getpid(), time.time(), row[0]))
+                    job = self._select(conn, row[0])
+                else:
+                    job = None
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if job is not None:
+                self._changed.notify_all()
+            return job
+
+    def _recover_orphans(self):
+        """把已退出进程名下运行中的任务标记为失败，调用方需持有 _changed"""
+        owners = [row[0] for row in self._db().execute(
+            "SELECT DISTINCT owner FROM jobs WHERE queue = ? AND status = 'running'", (self.name,))]
+        for owner in owners:
+            if owner is not None and owner != os.getpid() and not _process_alive(owner):
+                self._db().execute('''
+                    UPDATE jobs SET status = 'failed', error = '执行任务的进程已退出',
+                        updated_at = ?, version = version + 1
+                    WHERE queue = ? AND status = 'running' AND owner = ?
+                ''', (time.time(), self.name, owner))
+
+    def _worker(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                with self._changed:
+                    self._recover_orphans()
+                    self._changed.wait(POLL_INTERVAL)
+                continue
+            future = self._runner.submit(
+                self.run_func, job.path, lambda stage, job_id=job.id: self._progress(job_id, stage))
+            try:
+                result = future.result(timeout=self.timeout)
+                self._update(job.id, status="done", stage="done", result=result)
+            except FutureTimeoutError:
+                self._update(job.id, status="failed", error=f"任务超时（{self.timeout}秒）")
+                self._abandon(future)
+            except Exception as e:
+                self._update(job.id, status="failed", error=str(e))
+
+    def _abandon(self, future):
+        """超时的分析转入后台继续运行；后台名额用尽时等待其结束，工作线程暂不处理新任务"""
+        with self._changed:
+            stalled = self._stalled < self.max_stalled
+            if stalled:
+                self._stalled += 1
+        if stalled:
+            future.add_done_callback(self._stall_finished)
+            return
+        try:
+            future.result()
+        except Exception:
+            pass
+
+    def _stall_finished(self, future):
+        with self._changed:
+            self._stalled -= 1
+
+
+def _process_alive(pid):
+    # Windows 上 os.kill 会结束目标进程；该平台只有单个服务进程，其他进程号都来自已退出的进程
+    if os.name == 'nt':
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+# 持久化的模态特征，每项为 (110, 100) 的 float32 数组
+FEATURE_NAMES = ("text", "audio", "video")
+
+
+class FeatureStore:
+    """
+    媒体文件的预计算特征库
+
+    以文件内容指纹为键，每个文件一个目录，各模态特征保存为 .npy（读取时内存映射），
+    识别文本保存为 transcript.json。namespace 区分 BERT 模型、投影矩阵等影响特征的配置。
+    """
+
+    def __init__(self, root_dir, namespace="default"):
+        self.namespace = hashlib.blake2b(namespace.encode(), digest_size=8).hexdigest()
+        self.root_dir = os.path.join(root_dir, self.namespace)
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _entry_dir(self, fingerprint):
+        return os.path.join(self.root_dir, fingerprint[:2], fingerprint)
+
+    def load(self, fingerprint):
+        """
+        读取已保存的特征
+
+        返回:
+        字典，可能包含 "text"/"audio"/"video" 数组和 "transcript" 文本；未保存的项不出现
+        """
+        entry_dir = self._entry_dir(fingerprint)
+        entry = {}
+        if not os.path.isdir(entry_dir):
+            return entry
+        for name in FEATURE_NAMES:
+            path = os.path.join(entry_dir, name + ".npy")
+            if os.path.exists(path):
+                try:
+                    entry[name] = np.load(path, mmap_mode='r')
+                except (OSError, ValueError):
+                    # 文件损坏时当作未保存处理
+                    pass
+        transcript_path = os.path.join(entry_dir, "transcript.json")
+        if os.path.exists(transcript_path):
+            try:
+                with open(transcript_path, 'r', encoding='utf-8') as f:
+                    entry["transcript"] = json.load(f)["text"]
+            except (OSError, ValueError, KeyError):
+                pass
+        return entry
+
+    def save(self, fingerprint, features):
+        """保存特征，features 中可以只包含部分模态"""
+        entry_dir = self._entry_dir(fingerprint)
+        os.makedirs(entry_dir, exist_ok=True)
+        for name in FEATURE_NAMES:
+            if name in features and features[name] is not None:
+                self._atomic_write(entry_dir, name + ".npy",
+                                   lambda f, value=features[name]: np.save(f, np.asarray(value, dtype=np.float32)))
+        if features.get("transcript") is not None:
+            payload = json.dumps({"text": features["transcript"]}, ensure_ascii=False).encode('utf-8')
+            self._atomic_write(entry_dir, "transcript.json", lambda f: f.write(payload))
+
+    @staticmethod
+    def _atomic_write(entry_dir, file_name, write):
+        # 先写临时文件再替换，避免并发读取到写了一半的文件
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, os.path.join(entry_dir, file_name))
+        except Exception:
+            os.unlink(temp_path)
+            raise
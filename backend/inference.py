@@ -4,66 +4,259 @@ from model import LSTM_Model
 import cv2
 import librosa
 import speech_recognition as sr
-from transformers import BertTokenizer, BertModel
-import torch
 import os
-import tempfile
-import wave
 import json
+import hashlib
+import time
+import queue
+import logging
+import contextvars
 import vosk
-from moviepy.editor import VideoFileClip
-from pydub import AudioSegment
+from concurrent.futures import ThreadPoolExecutor, wait
+from media_decoder import DecodedMedia, MediaStream, SAMPLE_RATE, iter_pcm_chunks
+from micro_batcher import MicroBatcher
+from text_encoder import build_text_encoder
+from lazy_model import ModelRegistry
+from feature_store import FEATURE_NAMES
+from result_cache import file_fingerprint
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Vosk 每次送入的采样数（0.5秒）
+ASR_CHUNK_SAMPLES = 8000
+# BERT 输入窗口为110个token，去掉 [CLS] 和 [SEP] 后可容纳的文本token数
+TEXT_TOKEN_BUDGET = 108
 
 # 在程序开始时启用 eager execution
 tf.compat.v1.enable_eager_execution()
 
-# 添加用于预测的函数
-@tf.function
-def predict_function(model, inputs):
-    return model(inputs, training=False)
+# 情感模型输入的时间步数与各模态特征维度
+SEQUENCE_LENGTH = 110
+FEATURE_DIM = 100
+
+
+class CompiledModel:
+    """
+    加载时构建的固定签名推理函数
+
+    input_signature 固定为 (可变批大小, 110, 100)，加载时追踪一次，之后任何批大小都不会重新追踪；
+    开启 XLA 时每种批大小各编译一次，因此把批补齐到 2 的幂，并在预热时逐一编译。
+    """
+
+    def __init__(self, model, max_batch_size=8, jit_compile=False):
+        self.model = model
+        self.jit_compile = jit_compile
+        self.traces = 0
+        if jit_compile:
+            self.buckets = sorted({min(2 ** i, max_batch_size) for i in range(max(1, max_batch_size).bit_length() + 1)})
+        else:
+            self.buckets = [1, max_batch_size] if max_batch_size > 1 else [1]
+
+        feature_spec = tf.TensorSpec([None, SEQUENCE_LENGTH, FEATURE_DIM], tf.float32)
+        signature = [{
+            'a_input': feature_spec,
+            'v_input': feature_spec,
+            't_input': feature_spec,
+            'mask': tf.TensorSpec([None, SEQUENCE_LENGTH], tf.float32)
+        }]
+
+        @tf.function(input_signature=signature, jit_compile=jit_compile)
+        def predict(inputs):
+            # Python 语句只在追踪时执行，用于统计追踪次数
+            self.traces += 1
+            logger.info("追踪情感模型推理函数（第 %d 次）", self.traces)
+            return model(inputs, training=False)
+
+        try:
+            predict.get_concrete_function()
+            self._predict = predict
+        except Exception as e:
+            # 模型只保存了固定批大小等情况下无法按该签名追踪，退回 SavedModel 自带的签名
+            logger.warning("无法按固定签名追踪情感模型，改用 serving_default 签名: %s", e)
+            serving = model.signatures["serving_default"]
+            self._predict = lambda inputs: next(iter(serving(**inputs).values()))
+
+    def bucket(self, batch_size):
+        """XLA 模式下补齐后的批大小，否则原样返回"""
+        if not self.jit_compile:
+            return batch_size
+        for size in self.buckets:
+            if size >= batch_size:
+                return size
+        return batch_size
+
+    def predict(self, audio_features, video_features, text_features):
+        """
+        运行模型
+
+        参数:
+        三个形状为 (批大小, 110, 100) 的 float32 数组
+
+        返回:
+        (批大小, 110, 类别数) 的数组
+        """
+        batch_size = len(audio_features)
+        padded = self.bucket(batch_size)
+        features = [np.asarray(group, dtype=np.float32) for group in (audio_features, video_features, text_features)]
+        if padded > batch_size:
+            features = [np.concatenate([group, np.zeros((padded - batch_size,) + group.shape[1:], np.float32)])
+                        for group in features]
+        inputs = {
+            'a_input': tf.convert_to_tensor(features[0], dtype=tf.float32, name='a_input'),
+            'v_input': tf.convert_to_tensor(features[1], dtype=tf.float32, name='v_input'),
+            't_input': tf.convert_to_tensor(features[2], dtype=tf.float32, name='t_input'),
+            # 各模态都已补齐到110步，所有时间步均有效
+            'mask': tf.convert_to_tensor(np.ones((padded, SEQUENCE_LENGTH)), dtype=tf.float32, name='mask')
+        }
+        traces = self.traces
+        preds = self._predict(inputs)
+        if self.traces != traces:
+            logger.warning("情感模型推理函数被重新追踪，累计 %d 次（批大小 %d）", self.traces, padded)
+        return np.asarray(preds)[:batch_size]
+
+    def warmup(self):
+        """
+        用全零输入依次运行各批大小，加载时完成追踪（和 XLA 编译），首个请求不再承担这部分开销
+
+        返回:
+        {批大小: 耗时（秒）}
+        """
+        timings = {}
+        for size in self.buckets:
+            zeros = np.zeros((size, SEQUENCE_LENGTH, FEATURE_DIM), dtype=np.float32)
+            start = time.perf_counter()
+            preds = self.predict(zeros, zeros, zeros)
+            timings[size] = time.perf_counter() - start
+            logger.debug("预热批大小 %d: 输出形状 %s，耗时 %.3fs", size, preds.shape, timings[size])
+        return timings
+
+# fork 之后仍可安全使用的文本编码后端；ONNX Runtime 会话在加载时创建线程池，不能跨 fork 使用
+FORK_SAFE_TEXT_ENCODERS = ("fp32", "int8")
+
+
+def preload_shared_models(registry, bert_model_path, text_encoder="fp32", text_threads=0):
+    """
+    多进程服务在 fork 之前加载可以跨进程共享的模型，登记到 registry 中
+
+    工作进程中构造 EmotionPredictor 时按同名从 registry 取回已加载的模型，
+    PyTorch BERT 与 Vosk 的权重以写时复制方式在工作进程间共享。加载期间 torch 只用一个线程，
+    主进程不会创建 OpenMP 线程池（线程池不能跨 fork 使用）。TensorFlow 情感模型在加载时
+    初始化运行时线程池，ONNX Runtime 会话同样如此，二者仍在各工作进程中加载。
+
+    参数:
+    text_encoder -- 与 EmotionPredictor 的 text_encoder 相同，onnx 时不预先加载 BERT
+    text_threads -- BERT编码使用的线程数，0 表示沿用进程设置
+
+    返回:
+    已加载的模型名列表
+    """
+    import torch
+
+    threads = text_threads if text_threads > 0 else torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        loaded = []
+        if text_encoder in FORK_SAFE_TEXT_ENCODERS:
+            registry.register("bert", lambda: EmotionPredictor._load_text_encoder(
+                text_encoder, bert_model_path, 0, None)).get()
+            loaded.append("bert")
+        registry.register("vosk", EmotionPredictor._load_vosk).get()
+        loaded.append("vosk")
+        return loaded
+    finally:
+        # 只设置线程数，线程池在工作进程中首次并行计算时才创建
+        torch.set_num_threads(threads)
+
 
 class EmotionPredictor:
-    def __init__(self, checkpoint_path, bert_model_path="/home/wps/weights/bert-base-uncased", num_classes=6):
+    def __init__(self, checkpoint_path, bert_model_path="/home/wps/weights/bert-base-uncased", num_classes=6, max_workers=2, projection_seed=0,
+                 batch_size=8, batch_wait_ms=5, feature_store=None, text_encoder="fp32", text_threads=0, onnx_path=None,
+                 registry=None, jit_compile=False):
         self.num_classes = num_classes
+        # 推理函数按最大批大小预热，jit_compile 为 True 时用 XLA 编译
+        self.batch_size = batch_size
+        self.jit_compile = jit_compile
+        # 可选的预计算特征库（feature_store.FeatureStore），保存投影后的特征，命名空间应包含 projection_id
+        self.feature_store = feature_store
+        self.projection_seed = projection_seed
+        # 视频帧与MFCC提取在线程池中与 ASR→BERT 并行执行
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="emotion")
         # 初始化语音识别器
         self.recognizer = sr.Recognizer()
-
-        # 加载预训练的BERT模型
-        print("Loading BERT model from:", bert_model_path)
+        # 复用 KaldiRecognizer，避免每次识别重新创建
+        self._recognizer_pool = queue.Queue(maxsize=max_workers + batch_size)
+
+        # BERT、情感模型和 Vosk 各自在 registry 中登记，空闲或超出内存预算时可单独卸载，下次使用时重新加载
+        self.registry = registry or ModelRegistry()
+        self.bert_model = self.registry.register(
+            "bert", lambda: self._load_text_encoder(text_encoder, bert_model_path, text_threads, onnx_path))
+        self.tf_model = self.registry.register("emotion_tf", lambda: self._load_model(checkpoint_path))
+        self.vosk = self.registry.register("vosk", self._load_vosk, unloader=lambda model: self._clear_recognizers())
+
+        # 与之前一致，构造时加载各模型以尽早发现错误
+        with self.bert_model.use() as encoder:
+            # 分词器很小，常驻以便统计识别文本的 token 数
+            self.tokenizer = encoder.tokenizer
+            text_hidden_size = encoder.hidden_size
+        self.tf_model.get()
+        self.vosk.get()
+
+        # 并发请求的BERT前向和模型推理各自合并成批执行
+        self.text_batcher = MicroBatcher(self._encode_text_batch, batch_size, batch_wait_ms, name="bert-batcher")
+        self.inference_batcher = MicroBatcher(self._infer_batch, batch_size, batch_wait_ms, name="model-batcher")
+
+        # 预先生成各模态的投影矩阵，之后每次预测直接复用
+        self.projections = self._load_projections(checkpoint_path, {
+            "text": (text_hidden_size, 100),
+            "audio": (20, 100),
+            "video": (64 * 64 * 3, 100)
+        })
+
+    @staticmethod
+    def _load_text_encoder(kind, bert_model_path, num_threads, onnx_path):
+        """加载预训练的BERT模型，kind 选择 fp32 / int8 动态量化 / ONNX Runtime 后端"""
         try:
-            self.tokenizer = BertTokenizer.from_pretrained(bert_model_path, local_files_only=True)
-            self.bert_model = BertModel.from_pretrained(bert_model_path, local_files_only=True)
-            print("BERT model loaded successfully from local path")
+            encoder = build_text_encoder(kind, bert_model_path, num_threads, onnx_path)
+            logger.info("BERT model loaded successfully from local path")
+            return encoder
         except Exception as e:
-            print(f"Error loading BERT model from local path: {e}")
+            logger.error("Error loading BERT model from local path: %s", e)
             raise
 
-        # 加载SavedModel格式的模型
-        print(f"Loading model from: {checkpoint_path}")
+    def _load_model(self, checkpoint_path):
+        """加载SavedModel格式的模型"""
+        logger.info("Loading model from: %s", checkpoint_path)
         try:
             # 检查是否是SavedModel格式
             if os.path.isdir(checkpoint_path):
                 # 加载SavedModel
-                self.model = tf.saved_model.load(checkpoint_path)
-                print("Successfully loaded SavedModel")
+                model = tf.saved_model.load(checkpoint_path)
+                logger.info("Successfully loaded SavedModel")
+
+                # 构建固定签名的推理函数
+                compiled = CompiledModel(model, self.batch_size, jit_compile=self.jit_compile)
                 
-                # 测试模型输入输出以确认模型正常工作
-                self._test_model()
+                # 测试模型输入输出以确认模型正常工作，同时完成预热
+                self._test_model(compiled)
+                return compiled
             else:
                 raise ValueError(f"Checkpoint path {checkpoint_path} is not a directory (SavedModel format)")
         except Exception as e:
-            print(f"Error loading model: {e}")
+            logger.error("Error loading model: %s", e)
             raise
 
-        # 初始化 Vosk 模型
+    @staticmethod
+    def _load_vosk():
+        """加载 Vosk 模型，不可用时返回 None，语音识别改用在线服务"""
         try:
             # 设置 Vosk 模型路径
             vosk_model_path = "./resources/backend/vosk-model-small-en-us-0.15"
             
             # 检查模型目录是否存在
             if not os.path.exists(vosk_model_path):
-                print(f"\nVosk 模型目录不存在: {vosk_model_path}")
-                print("正在下载 Vosk 模型...")
+                logger.warning("Vosk 模型目录不存在: %s", vosk_model_path)
+                logger.info("正在下载 Vosk 模型...")
                 
                 # 创建模型目录
                 os.makedirs(vosk_model_path, exist_ok=True)
@@ -75,180 +268,223 @@ class EmotionPredictor:
                 model_url = "https://alphacephei.com/vosk/models/vosk-model-small-en-us-0.15.zip"
                 zip_path = os.path.join(vosk_model_path, "model.zip")
                 
-                print(f"从 {model_url} 下载模型...")
+                logger.info("从 %s 下载模型...", model_url)
                 urllib.request.urlretrieve(model_url, zip_path)
                 
-                print("解压模型文件...")
+                logger.info("解压模型文件...")
                 with zipfile.ZipFile(zip_path, 'r') as zip_ref:
                     zip_ref.extractall(vosk_model_path)
                 
                 # 清理zip文件
                 os.remove(zip_path)
                 
-                print("Vosk 模型下载完成")
+                logger.info("Vosk 模型下载完成")
             
             # 检查模型文件是否存在
             if not os.path.exists(os.path.join(vosk_model_path, "conf")):
                 raise Exception("模型文件不完整，请重新下载")
             
             # 加载模型
-            self.vosk_model = vosk.Model(vosk_model_path)
-            print("Vosk 模型加载成功")
-            
+            vosk_model = vosk.Model(vosk_model_path)
+            logger.info("Vosk 模型加载成功")
+            return vosk_model
+
         except Exception as e:
-            print(f"加载 Vosk 模型出错: {e}")
-            print("\n解决方案:")
-            print("1. 手动下载 Vosk 模型:")
-            print("   - 访问 https://alphacephei.com/vosk/models")
-            print("   - 下载 vosk-model-small-en-us-0.15.zip")
-            print("   - 解压到当前目录下的 vosk-model-small-en-us-0.15 文件夹")
-            print("2. 或者使用在线语音识别（已自动启用）")
-            self.vosk_model = None
-
-    def _test_model(self):
-        """测试模型输入输出以确认模型正常工作"""
+            logger.error("加载 Vosk 模型出错: %s", e)
+            logger.warning("可手动从 https://alphacephei.com/vosk/models 下载 vosk-model-small-en-us-0.15 并解压到当前目录；已自动启用在线语音识别")
+            return None
+
+    def _clear_recognizers(self):
+        """Vosk 模型卸载时丢弃绑定它的识别器"""
+        while True:
+            try:
+                self._recognizer_pool.get_nowait()
+            except queue.Empty:
+                return
+
+    def _load_projections(self, checkpoint_path, shapes):
+        """
+        加载或生成投影矩阵
+
+        模型目录下存在 projections.npz 时优先加载，否则用固定种子生成，
+        保证相同输入得到相同输出。同时设置 projection_id，供特征库区分不同投影下保存的特征：
+        全部由种子生成时为种子，有矩阵来自文件时为各矩阵内容的哈希。
+        """
+        projections = {}
+        projection_path = os.path.join(checkpoint_path, "projections.npz")
+        if os.path.exists(projection_path):
+            logger.info("Loading projection matrices from: %s", projection_path)
+            with np.load(projection_path) as saved:
+                for name in saved.files:
+                    projections[name] = np.ascontiguousarray(saved[name], dtype=np.float32)
+
+        loaded = False
+        for name, (current_dim, target_dim) in shapes.items():
+            if name not in projections or projections[name].shape != (current_dim, target_dim):
+                projections[name] = self._make_projection(current_dim, target_dim)
+            else:
+                loaded = True
+
+        if loaded:
+            digest = hashlib.blake2b(digest_size=8)
+            for name in sorted(shapes):
+                digest.update(f"{name}:{projections[name].shape}".encode())
+                digest.update(projections[name].tobytes())
+            self.projection_id = f"projections={digest.hexdigest()}"
+        else:
+            self.projection_id = f"projection_seed={self.projection_seed}"
+        return projections
+
+    def _make_projection(self, current_dim, target_dim):
+        rng = np.random.default_rng([self.projection_seed, current_dim, target_dim])
+        matrix = rng.standard_normal((current_dim, target_dim), dtype=np.float32)
+        matrix /= np.sqrt(current_dim)
+        return np.ascontiguousarray(matrix)
+
+    def _test_model(self, compiled):
+        """测试模型输入输出以确认模型正常工作，同时预热推理函数"""
         try:
-            print("\n测试模型输入输出...")
-            # 创建模拟输入
-            t_input = np.zeros((1, 110, 100), dtype=np.float32)
-            a_input = np.zeros((1, 110, 100), dtype=np.float32)
-            v_input = np.zeros((1, 110, 100), dtype=np.float32)
-            mask = np.ones((1, 110), dtype=np.float32)
-            
-            # 准备输入数据
-            inputs = {
-                'a_input': tf.convert_to_tensor(a_input, dtype=tf.float32),
-                'v_input': tf.convert_to_tensor(v_input, dtype=tf.float32),
-                't_input': tf.convert_to_tensor(t_input, dtype=tf.float32),
-                'mask': tf.convert_to_tensor(mask, dtype=tf.float32)
-            }
-            
-            # 尝试进行预测
-            preds = self.model(inputs, training=False)
-            
-            # 打印输出形状
-            print(f"模型预期输入形状: t_input={t_input.shape}, a_input={a_input.shape}, v_input={v_input.shape}, mask={mask.shape}")
-            print(f"模型输出形状: {preds.shape}")
-            print("模型测试成功")
-            
+            logger.info("测试模型输入输出...")
+            timings = compiled.warmup()
+            logger.info("模型测试成功，推理函数追踪 %d 次%s，各批大小预热耗时: %s",
+                        compiled.traces, "（XLA）" if compiled.jit_compile else "",
+                        ", ".join(f"{size}: {seconds:.3f}s" for size, seconds in timings.items()))
         except Exception as e:
-            print(f"模型测试失败: {e}")
-            print("这可能表明模型期望的输入形状与我们提供的不匹配")
+            logger.error("模型测试失败: %s", e)
+            logger.error("这可能表明模型期望的输入形状与我们提供的不匹配")
             raise
 
+    @staticmethod
+    def _timed(timings, name, func, *args):
+        """执行 func 并把耗时记录到 timings[name] 和阶段指标"""
+        stage_start = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception:
+            metrics.STAGE_ERRORS.inc(name)
+            raise
+        finally:
+            timings[name] = time.perf_counter() - stage_start
+            metrics.observe_stage(name, timings[name])
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.text_batcher.close()
+        self.inference_batcher.close()
+
     def project_features(self, features, target_dim, name):
         """将特征投影到目标维度"""
         current_dim = features.shape[-1]
         if current_dim == target_dim:
             return features
 
-        print(f"Projecting {name} features from {current_dim} to {target_dim}")
-        projection_matrix = np.random.randn(current_dim, target_dim) / np.sqrt(current_dim)
-        return np.dot(features, projection_matrix)
-
-    def extract_audio_from_video(self, video_path):
-        """从视频文件中提取音频"""
+        projection_matrix = self.projections.get(name)
+        if projection_matrix is None or projection_matrix.shape != (current_dim, target_dim):
+            projection_matrix = self._make_projection(current_dim, target_dim)
+            self.projections[name] = projection_matrix
+        return np.dot(np.asarray(features, dtype=np.float32), projection_matrix)
+
+    def decode_media(self, video_path):
+        """解复用视频，得到内存中的16kHz单声道PCM和已打开的视频流"""
+        logger.debug("正在解码视频: %s", video_path)
+        media = DecodedMedia(video_path)
+        logger.debug("音频解码成功，时长 %.2fs", media.duration)
+        return media
+
+    def _acquire_recognizer(self, vosk_model):
+        """从识别器池中取出一个绑定 vosk_model 的 KaldiRecognizer，池空时新建"""
         try:
-            # 创建临时文件
-            temp_dir = tempfile.mkdtemp()
-            temp_audio_path = os.path.join(temp_dir, "temp_audio.wav")
-
-            print(f"正在从视频中提取音频: {video_path}")
-            print(f"临时音频文件: {temp_audio_path}")
-            
-            # 使用moviepy提取音频
-            video = VideoFileClip(video_path)
-            audio = video.audio
-            if audio is None:
-                raise Exception("视频中没有音频轨道")
-            
-            # 保存音频文件
-            audio.write_audiofile(temp_audio_path, codec='pcm_s16le', fps=16000)
-            
-            # 关闭视频和音频对象
-            audio.close()
-            video.close()
-            
-            print("音频提取成功")
-            return temp_audio_path
-        except Exception as e:
-            print(f"Error extracting audio: {e}")
-            return None
-
-    def extract_text_from_audio(self, audio_path):
-        """从音频文件中提取文本，优先使用离线识别，失败时尝试在线识别"""
-        # 首先尝试使用离线识别
-        if self.vosk_model is not None:
-            try:
-                # 确保音频格式正确（16kHz, 16bit, mono）
-                audio = AudioSegment.from_file(audio_path)
-                audio = audio.set_frame_rate(16000)
-                audio = audio.set_channels(1)
-
-                # 创建临时 WAV 文件
-                temp_wav = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-                temp_wav_path = temp_wav.name
-                temp_wav.close()  # 关闭文件句柄
-
-                # 导出音频到临时文件
-                audio.export(temp_wav_path, format="wav")
-
-                # 使用 Vosk 进行识别
-                recognizer = vosk.KaldiRecognizer(self.vosk_model, 16000)
-                text = ""
+            return self._recognizer_pool.get_nowait()
+        except queue.Empty:
+            return vosk.KaldiRecognizer(vosk_model, SAMPLE_RATE)
 
+    def _release_recognizer(self, recognizer):
+        recognizer.Reset()
+        try:
+            self._recognizer_pool.put_nowait(recognizer)
+        except queue.Full:
+            pass
+
+    def extract_text_from_audio(self, pcm, max_tokens=TEXT_TOKEN_BUDGET):
+        """
+        从16kHz单声道int16 PCM中提取文本，优先使用离线识别，失败时尝试在线识别
+
+        参数:
+        pcm -- np.int16 数组，或逐块产出 PCM 字节的生成器
+        max_tokens -- 识别出的文本达到该 BERT token 数后提前结束，None 表示识别全部音频
+        """
+        if isinstance(pcm, np.ndarray):
+            chunks = iter_pcm_chunks(pcm, ASR_CHUNK_SAMPLES)
+        else:
+            chunks = iter(pcm)
+        # 记录已送入离线识别的数据，在线识别回退时需要完整音频
+        consumed = []
+
+        # 首先尝试使用离线识别，识别期间持有 Vosk 模型，避免被卸载
+        with self.vosk.use() as vosk_model:
+            if vosk_model is not None:
+                recognizer = self._acquire_recognizer(vosk_model)
                 try:
-                    with wave.open(temp_wav_path, "rb") as wf:
-                        while True:
-                            data = wf.readframes(4000)
-                            if len(data) == 0:
-                                break
-                            if recognizer.AcceptWaveform(data):
-                                result = json.loads(recognizer.Result())
-                                if result.get("text", ""):
-                                    text += result["text"] + " "
+                    # PCM 直接分块送入 Vosk，无需临时文件
+                    segments = []
+                    token_count = 0
+                    for chunk in chunks:
+                        consumed.append(chunk)
+                        if recognizer.AcceptWaveform(chunk):
+                            segment = json.loads(recognizer.Result()).get("text", "")
+                            if segment:
+                                segments.append(segment)
+                                token_count += len(self.tokenizer.tokenize(segment))
+                                # 超出 BERT 窗口的文本会被截断，无需继续识别
+                                if max_tokens is not None and token_count >= max_tokens:
+                                    return " ".join(segments)
 
                     # 获取最终结果
-                    result = json.loads(recognizer.FinalResult())
-                    if result.get("text", ""):
-                        text += result["text"]
-                finally:
-                    # 确保临时文件被删除
-                    try:
-                        os.unlink(temp_wav_path)
-                    except Exception as e:
-                        print(f"删除临时文件时出错: {e}")
+                    segment = json.loads(recognizer.FinalResult()).get("text", "")
+                    if segment:
+                        segments.append(segment)
 
-                return text.strip()
+                    return " ".join(segments)
 
-            except Exception as e:
-                print(f"离线语音识别失败: {e}")
-                print("尝试在线识别...")
+                except Exception as e:
+                    logger.warning("离线语音识别失败: %s", e)
+                    logger.info("尝试在线识别...")
+                finally:
+                    self._release_recognizer(recognizer)
 
         # 如果离线识别失败或未配置，尝试在线识别
         try:
             recognizer = sr.Recognizer()
-            with sr.AudioFile(audio_path) as source:
-                recognizer.adjust_for_ambient_noise(source)
-                audio = recognizer.record(source)
-                text = recognizer.recognize_google(audio)
-                return text
+            pcm_bytes = b"".join(consumed) + b"".join(chunks)
+            audio = sr.AudioData(pcm_bytes, SAMPLE_RATE, 2)
+            text = recognizer.recognize_google(audio)
+            return text
         except sr.UnknownValueError:
-            print("语音识别无法理解音频内容")
+            logger.info("语音识别无法理解音频内容")
             return ""
         except sr.RequestError as e:
-            print(f"无法从语音识别服务获取结果: {e}")
+            logger.warning("无法从语音识别服务获取结果: %s", e)
             return ""
         except Exception as e:
-            print(f"语音识别出错: {e}")
+            logger.warning("语音识别出错: %s", e)
             return ""
 
+    def _encode_text_batch(self, texts):
+        """一次BERT前向处理多条文本，按各自的有效长度切分返回"""
+        with self.bert_model.use() as encoder:
+            return encoder.encode(texts)
+
+    def _infer_batch(self, items):
+        """把多组 (audio, video, text) 特征堆叠成一批运行模型，返回每组的 (110, 类别数) 输出"""
+        audio_features, video_features, text_features = (np.stack(group) for group in zip(*items))
+        with self.tf_model.use() as compiled:
+            preds = compiled.predict(audio_features, video_features, text_features)
+        return [preds[i] for i in range(len(items))]
+
     def extract_text_features(self, text):
         """提取文本特征"""
-        inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=110)
-        with torch.no_grad():
-            outputs = self.bert_model(**inputs)
-        bert_features = outputs.last_hidden_state.numpy()[0]
+        # 与其他并发请求的文本合并成一批做BERT前向
+        bert_features = self.text_batcher(text)
 
         # 确保序列长度为110
         if bert_features.shape[0] < 110:
@@ -263,13 +499,11 @@ class EmotionPredictor:
         # 直接返回形状为 (110, 100) 的特征
         return features
 
-    def extract_audio_features(self, audio_path):
-        """提取音频特征"""
+    def extract_audio_features(self, audio):
+        """从16kHz单声道float32音频中提取音频特征"""
         try:
-            y, sr = librosa.load(audio_path)
-
             # 提取MFCC特征
-            mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20)
+            mfcc = librosa.feature.mfcc(y=audio, sr=SAMPLE_RATE, n_mfcc=20)
             mfcc = mfcc.T
 
             # 确保序列长度为110
@@ -286,191 +520,297 @@ class EmotionPredictor:
             return features
 
         except Exception as e:
-            print(f"Error extracting audio features: {e}")
+            logger.error("Error extracting audio features: %s", e)
             return None
 
-    def extract_video_features(self, video_path):
-        """提取视频特征"""
-        cap = cv2.VideoCapture(video_path)
-        frames = []
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            frame = cv2.resize(frame, (64, 64))
-            frame = frame / 255.0
-            frames.append(frame)
-        cap.release()
-
-        frames = np.array(frames)
-
-        # 确保有110帧
-        if len(frames) < 110:
-            pad_frames = np.repeat(frames[-1:], 110 - len(frames), axis=0)
-            frames = np.concatenate([frames, pad_frames], axis=0)
-        else:
-            indices = np.linspace(0, len(frames) - 1, 110, dtype=int)
-            frames = frames[indices]
+    def extract_video_features(self, media):
+        """从已解复用的媒体中提取视频特征"""
+        # 只解码采样到的110帧，写入预分配的uint8缓冲区
+        frames = media.sample_frames(110, (64, 64))
+        frames = frames.astype(np.float32) / 255.0
 
         # 展平并投影到目标维度
         features = frames.reshape(frames.shape[0], -1)
-        features = self.project_features(features, 100, "video")  # 修改为512维
+        features = self.project_features(features, 100, "video")
 
-        # 直接返回形状为 (110, 512) 的特征
+        # 直接返回形状为 (110, 100) 的特征
         return features
 
-    def predict(self, video_path):
-        """预测视频的情感类别"""
-        try:
-            print(f"\nStep 1: Validating video file...")
-            if not os.path.exists(video_path):
-                raise FileNotFoundError(f"Video file not found: {video_path}")
-
-            # 验证视频文件
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened():
-                raise IOError(f"Cannot open video file: {video_path}")
-
-            # 获取视频信息
-            fps = cap.get(cv2.CAP_PROP_FPS)
-            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            print(f"Video info - FPS: {fps}, Frame count: {frame_count}")
-            cap.release()
-
-            print("\nStep 2: Extracting audio...")
-            audio_path = self.extract_audio_from_video(video_path)
-            if audio_path is None:
-                raise Exception("Failed to extract audio from video")
-            print(f"Audio extracted to: {audio_path}")
-
-            print("\nStep 3: Performing speech recognition...")
-            text = self.extract_text_from_audio(audio_path)
-            if not text:
-                print("Warning: No text could be extracted from audio")
-                text = "no speech detected"
-            print(f"Extracted text: {text}")
-
-            print("\nStep 4: Extracting features...")
-            print("- Extracting video features...")
-            video_features = self.extract_video_features(video_path)
-            print(f"  Video features shape: {video_features.shape}")
-
-            print("- Extracting audio features...")
-            audio_features = self.extract_audio_features(audio_path)
-            print(f"  Audio features shape: {audio_features.shape}")
-
-            print("- Extracting text features...")
-            text_features = self.extract_text_features(text)
-            print(f"  Text features shape: {text_features.shape}")
-
-            print("\nStep 5: Preparing features for model...")
-            # 调整特征维度，确保与模型期望的输入维度一致
-            video_features = video_features.reshape(1, 110, 100)  # 修正为512维
-            audio_features = audio_features.reshape(1, 110, 100)
-            text_features = text_features.reshape(1, 110, 100)
-
-            print("Feature shapes after reshaping:")
-            print(f"- Video: {video_features.shape}")
-            print(f"- Audio: {audio_features.shape}")
-            print(f"- Text: {text_features.shape}")
-
-            print("\nStep 6: Running prediction...")
-            # 准备输入数据
-            inputs = {
-                'a_input': tf.convert_to_tensor(audio_features, dtype=tf.float32, name='a_input'),
-                'v_input': tf.convert_to_tensor(video_features, dtype=tf.float32, name='v_input'),
-                't_input': tf.convert_to_tensor(text_features, dtype=tf.float32, name='t_input'),
-                'mask': tf.convert_to_tensor(np.ones((1, 110)), dtype=tf.float32, name='mask')
+    def _class_probabilities(self, preds):
+        """把 (时间步, 类别数) 的模型输出转换为归一化的类别概率"""
+        # 对时序维度取平均，得到每个类别的整体概率
+        preds_mean = np.mean(preds, axis=0)  # 对时序维度取平均
+        logger.debug("Average prediction values: %s", preds_mean)
+
+        # 确保预测值在有效范围内
+        preds_mean = np.clip(preds_mean, 0, 1)  # 将值限制在0-1之间
+        preds_mean = preds_mean / np.sum(preds_mean)  # 归一化
+        
+        # 如果是二分类问题并且预测不符合预期，考虑翻转预测
+        if len(preds_mean) == 2:
+            # 检查分布是否不符合预期
+            logger.debug("原始预测分布: %s", preds_mean)
+            # 如果预测概率极度不平衡（如一个类别概率过高），考虑翻转
+            if preds_mean[0] > 0.95 or preds_mean[1] > 0.95:
+                logger.debug("检测到预测可能需要翻转，正在翻转预测结果...")
+                preds_mean = np.array([preds_mean[1], preds_mean[0]])  # 翻转预测
+                logger.debug("翻转后的预测分布: %s", preds_mean)
+        return preds_mean
+
+    def _emotion_map(self):
+        """调整情感映射以匹配当前模型的输出类别"""
+        emotion_map = {}
+        if self.num_classes == 2:
+            emotion_map = {
+                0: "negative",
+                1: "positive"
             }
+        elif self.num_classes == 6:
+            emotion_map = {
+                0: "angry",
+                1: "happy", 
+                2: "sad",
+                3: "neutral",
+                4: "excited",
+                5: "frustrated"
+            }
+        else:
+            # 为未知类别数创建默认映射
+            for i in range(self.num_classes):
+                emotion_map[i] = f"emotion_{i}"
+        return emotion_map
+
+    def extract_features(self, video_path, timings=None, report=None):
+        """
+        提取视频的三模态特征和识别文本
+
+        配置了特征库时先按内容指纹查询，只提取缺失的部分并写回；三种特征都已保存时不解码视频。
+
+        返回:
+        {"transcript": 文本, "text"/"audio"/"video": (110, 100) 特征}
+        """
+        if timings is None:
+            timings = {}
+        fingerprint = None
+        features = {}
+        if self.feature_store is not None:
+            fingerprint = file_fingerprint(video_path)
+            features = self.feature_store.load(fingerprint)
+            if features:
+                logger.debug("从特征库读取: %s", sorted(features))
+
+        # 本次新提取、需要写回特征库的部分
+        computed = {}
+        missing = [name for name in FEATURE_NAMES if name not in features]
+        if "text" in missing and "transcript" in features:
+            # 已有识别文本时只需重新做BERT编码
+            missing.remove("text")
+            computed["text"] = self._timed(timings, "bert", self.extract_text_features, features["transcript"])
+        if not missing:
+            return self._store_features(fingerprint, features, computed)
+
+        if report is not None:
+            report("decode")
+        logger.debug("Step 1: Decoding video file...")
+        # 只解复用一次：音频解码为内存PCM，视频流保持打开供帧提取使用
+        with self._timed(timings, "decode", self.decode_media, video_path) as media:
+            logger.debug("Video info - FPS: %s, Frame count: %s", media.fps, media.frame_count)
+
+            if report is not None:
+                report("features")
+            logger.debug("Step 2: Extracting features...")
+            # 视频帧（OpenCV 释放 GIL）和 MFCC 在线程池中执行，当前线程执行 ASR→BERT
+            futures = {}
+            if "video" in missing:
+                # 复制上下文，线程池中的阶段也计入当前请求的分阶段耗时
+                futures["video"] = self.executor.submit(
+                    contextvars.copy_context().run,
+                    self._timed, timings, "video", self.extract_video_features, media)
+            if "audio" in missing:
+                futures["audio"] = self.executor.submit(
+                    contextvars.copy_context().run,
+                    self._timed, timings, "mfcc", self.extract_audio_features, media.audio_float())
 
-            # 使用模型进行预测
-            # preds = self.model(inputs, training=False)
             try:
-                preds = predict_function(self.model, inputs)
-            except RuntimeError as e:
-                print(f"使用 predict_function 调用失败: {e}")
-                print("尝试使用模型签名调用...")
-                try:
-                    # 尝试使用模型的签名调用
-                    preds = self.model.signatures["serving_default"](**inputs)
-                    # 获取输出张量
-                    preds = next(iter(preds.values()))
-                except Exception as sig_error:
-                    print(f"使用签名调用也失败: {sig_error}")
-                    # 尝试最后的方法
-                    with tf.compat.v1.Session() as sess:
-                        preds = self.model(inputs)
-                        preds = sess.run(preds)
-
-            print("\nDebug information:")
-            print(f"Prediction shape: {preds.shape}")
-
-            # 对时序维度取平均，得到每个类别的整体概率
-            preds_mean = np.mean(preds[0], axis=0)  # 对时序维度取平均
-            print(f"Average prediction values: {preds_mean}")
-
-            # 确保预测值在有效范围内
-            preds_mean = np.clip(preds_mean, 0, 1)  # 将值限制在0-1之间
-            preds_mean = preds_mean / np.sum(preds_mean)  # 归一化
-            
-            # 如果是二分类问题并且预测不符合预期，考虑翻转预测
-            if len(preds_mean) == 2:
-                # 检查分布是否不符合预期
-                print(f"原始预测分布: {preds_mean}")
-                # 如果预测概率极度不平衡（如一个类别概率过高），考虑翻转
-                if preds_mean[0] > 0.95 or preds_mean[1] > 0.95:
-                    print("检测到预测可能需要翻转，正在翻转预测结果...")
-                    preds_mean = np.array([preds_mean[1], preds_mean[0]])  # 翻转预测
-                    print(f"翻转后的预测分布: {preds_mean}")
+                if "text" in missing:
+                    text = self._timed(
+                        timings, "asr", self.extract_text_from_audio, media.iter_pcm(ASR_CHUNK_SAMPLES))
+                    if not text:
+                        logger.warning("No text could be extracted from audio")
+                        text = "no speech detected"
+                    logger.debug("Extracted text: %s", text)
+                    computed["transcript"] = text
+                    computed["text"] = self._timed(timings, "bert", self.extract_text_features, text)
+            finally:
+                # 视频流在 with 结束时释放，必须先等待视频分支完成
+                wait(list(futures.values()))
+            for name, future in futures.items():
+                computed[name] = future.result()
+
+        return self._store_features(fingerprint, features, computed)
+
+    def _store_features(self, fingerprint, features, computed):
+        """合并新提取的特征并写回特征库"""
+        features.update(computed)
+        features.setdefault("transcript", "")
+        for name in FEATURE_NAMES:
+            logger.debug("%s features shape: %s", name.capitalize(), features[name].shape)
+        if self.feature_store is not None and computed:
+            try:
+                self.feature_store.save(fingerprint, computed)
+            except OSError as e:
+                logger.warning("写入特征库失败: %s", e)
+        return features
+
+    def predict(self, video_path, progress=None):
+        """
+        预测视频的情感类别
 
+        progress 为可选回调，每进入一个阶段时以阶段名调用
+        """
+        def report(stage):
+            if progress is not None:
+                progress(stage)
+
+        try:
+            timings = {}
+            start = time.perf_counter()
+
+            features = self.extract_features(video_path, timings, report)
+            text = features["transcript"]
+            video_features = features["video"]
+            audio_features = features["audio"]
+            text_features = features["text"]
+
+            logger.debug("Step 3: Preparing features for model...")
+            # 调整特征维度，确保与模型期望的输入维度一致
+            video_features = video_features.reshape(110, 100)
+            audio_features = audio_features.reshape(110, 100)
+            text_features = text_features.reshape(110, 100)
+
+            report("inference")
+            logger.debug("Step 4: Running prediction...")
+            # 与其他并发请求合并成一批送入模型
+            inference_start = time.perf_counter()
+            preds = self.inference_batcher((audio_features, video_features, text_features))
+            timings["inference"] = time.perf_counter() - inference_start
+            metrics.observe_stage("inference", timings["inference"])
+
+            logger.debug("Prediction shape: %s", preds.shape)
+
+            preds_mean = self._class_probabilities(preds)
             emotion_class = np.argmax(preds_mean)
-            print(f"Predicted class index: {emotion_class}")
-
-            # 调整情感映射以匹配当前模型的输出类别
-            emotion_map = {}
-            if self.num_classes == 2:
-                emotion_map = {
-                    0: "negative",
-                    1: "positive"
-                }
-            elif self.num_classes == 6:
-                emotion_map = {
-                    0: "angry",
-                    1: "happy", 
-                    2: "sad",
-                    3: "neutral",
-                    4: "excited",
-                    5: "frustrated"
-                }
-            else:
-                # 为未知类别数创建默认映射
-                for i in range(self.num_classes):
-                    emotion_map[i] = f"emotion_{i}"
+            logger.debug("Predicted class index: %s", emotion_class)
 
+            emotion_map = self._emotion_map()
             result = {
                 "emotion": emotion_map[emotion_class],
                 "text": text,
                 "confidence": float(preds_mean[emotion_class]),
                 "all_probabilities": {emotion_map[i]: float(preds_mean[i]) for i in range(min(6, self.num_classes))}
             }
+            timings["total"] = time.perf_counter() - start
+            # 各阶段耗时（秒）
+            result["timings"] = {name: round(seconds, 4) for name, seconds in timings.items()}
 
-            print("\nPrediction details:")
-            print(f"Predicted emotion: {result['emotion']}")
-            print("Emotion probabilities:")
-            for emotion, prob in result["all_probabilities"].items():
-                print(f"{emotion}: {prob:.4f}")
+            logger.debug("Predicted emotion: %s", result['emotion'])
+            logger.debug("Emotion probabilities: %s", result["all_probabilities"])
 
-            print("\nPrediction completed successfully!")
+            logger.debug("Prediction completed successfully!")
             return result
 
         except Exception as e:
-            print(f"\nError during prediction: {str(e)}")
-            print(f"Error type: {type(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error during prediction: %s", e)
             return None
 
 
+    def _window_features(self, window):
+        """提取单个时间窗口的三模态特征"""
+        frames = window.frames.astype(np.float32) / 255.0
+        video_future = self.executor.submit(
+            self.project_features, frames.reshape(frames.shape[0], -1), 100, "video")
+        audio_future = self.executor.submit(
+            self.extract_audio_features, window.pcm.astype(np.float32) / 32768.0)
+        try:
+            text = self.extract_text_from_audio(window.pcm)
+            text_features = self.extract_text_features(text or "no speech detected")
+        finally:
+            wait([video_future, audio_future])
+        return text, (audio_future.result().reshape(110, 100),
+                      video_future.result().reshape(110, 100),
+                      text_features.reshape(110, 100))
+
+    def _segment_result(self, window, text, preds_mean):
+        emotion_map = self._emotion_map()
+        emotion_class = int(np.argmax(preds_mean))
+        return {
+            "index": window.index,
+            "start": round(window.start, 3),
+            "end": round(window.end, 3),
+            "emotion": emotion_map[emotion_class],
+            "confidence": float(preds_mean[emotion_class]),
+            "text": text,
+            "probabilities": {emotion_map[i]: float(preds_mean[i]) for i in range(min(6, self.num_classes))}
+        }
+
+    def predict_timeline(self, video_path, window_seconds=10.0, batch_windows=4):
+        """
+        按固定时间窗口分段预测视频情感
+
+        窗口边解码边提取特征，每凑满 batch_windows 个窗口就作为一批送入模型，
+        因此前面的分段结果无需等待整个文件解码完成。
+
+        参数:
+        video_path -- 视频文件路径
+        window_seconds -- 窗口长度（秒）
+        batch_windows -- 每批推理的窗口数
+
+        返回:
+        生成器，依次产出各分段结果，最后产出 {"aggregate": ...}，
+        其中整体概率为各分段概率按时长加权的平均
+        """
+        emotion_map = self._emotion_map()
+        totals = np.zeros(self.num_classes)
+        total_duration = 0.0
+        segments = 0
+
+        with MediaStream(video_path) as stream:
+            def batches():
+                pending = []
+                for window in stream.iter_windows(window_seconds, 110, (64, 64)):
+                    text, features = self._window_features(window)
+                    pending.append((window, text, features))
+                    if len(pending) >= batch_windows:
+                        yield pending
+                        pending = []
+                if pending:
+                    yield pending
+
+            for pending in batches():
+                outputs = self._infer_batch([features for _, _, features in pending])
+                for (window, text, _), preds in zip(pending, outputs):
+                    preds_mean = self._class_probabilities(preds)
+                    yield self._segment_result(window, text, preds_mean)
+                    duration = window.end - window.start
+                    totals += duration * preds_mean
+                    total_duration += duration
+                    segments += 1
+
+        if segments == 0:
+            raise IOError(f"No audio or video could be decoded from: {video_path}")
+        probabilities = totals / max(total_duration, 1e-6)
+        emotion_class = int(np.argmax(probabilities))
+        yield {
+            "aggregate": {
+                "emotion": emotion_map[emotion_class],
+                "confidence": float(probabilities[emotion_class]),
+                "probabilities": {emotion_map[i]: float(probabilities[i]) for i in range(min(6, self.num_classes))},
+                "segments": segments,
+                "duration": round(total_duration, 3)
+            }
+        }
+
+
 # 使用示例
 if __name__ == "__main__":
 
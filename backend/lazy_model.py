@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import gc
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 正在加载的模型栈（每个线程一个），嵌套加载时外层模型的内存不重复计入内层模型
+_loading = threading.local()
+
+
+def process_rss():
+    """
+    当前进程的常驻内存（字节）
+
+    优先使用 psutil，其次读取 /proc/self/statm；都不可用时返回 None
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class LazyModel:
+    """
+    延迟加载的模型
+
+    首次调用 get() 时才执行加载函数（也可用 start_background() 在后台预热），
+    加载状态与耗时可通过 status() 查询。
+
+    在 ModelRegistry 中注册的模型还会记录加载前后的常驻内存差作为内存开销，
+    空闲超时或超出内存预算时由 registry 卸载，下一次使用时重新加载。
+    """
+
+    NOT_LOADED = "not_loaded"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, name, loader, unloader=None, registry=None):
+        """
+        参数:
+        name -- 模型名称，用于日志和健康检查
+        loader -- 无参加载函数，返回模型对象
+        unloader -- 可选，卸载时以模型对象为参数调用，用于关闭会话、停止线程等
+        registry -- 可选，所属的 ModelRegistry
+        """
+        self.name = name
+        self.loader = loader
+        self.unloader = unloader
+        self.registry = registry
+        self.state = self.NOT_LOADED
+        self.error = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.last_used = None
+        self.loads = 0
+        self.unloads = 0
+        self._value = None
+        self._users = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """返回已加载的模型，未加载时在当前线程加载；加载失败时抛出异常"""
+        if self.state == self.READY:
+            self.last_used = time.time()
+            return self._value
+        with self._lock:
+            if self.state != self.READY:
+                self._load()
+            value = self._value
+        self._loaded()
+        return value
+
+    @contextmanager
+    def use(self):
+        """
+        使用模型期间持有引用，registry 不会卸载正在使用的模型
+
+        用法:
+        with model.use() as tagger:
+            tagger.analyze(...)
+        """
+        loaded = False
+        with self._lock:
+            if self.state != self.READY:
+                self._load()
+                loaded = True
+            self._users += 1
+            value = self._value
+        self.last_used = time.time()
+        try:
+            if loaded:
+                self._loaded()
+            yield value
+        finally:
+            with self._lock:
+                self._users -= 1
+            self.last_used = time.time()
+
+    def _loaded(self):
+        if self.registry is not None:
+            self.registry.enforce_budget(keep=self)
+
+    def _load(self):
+        self.state = self.LOADING
+        self.error = None
+        logger.info("正在加载模型: %s", self.name)
+        start = time.perf_counter()
+        rss_before = process_rss()
+        stack = getattr(_loading, "stack", None)
+        if stack is None:
+            stack = _loading.stack = []
+        # 栈中累计嵌套加载的子模型占用的内存
+        stack.append(0)
+        try:
+            self._value = self.loader()
+        except Exception as e:
+            self.state = self.FAILED
+            self.error = str(e)
+            self.load_seconds = time.perf_counter() - start
+            logger.error("模型 %s 加载失败（%.2fs）: %s", self.name, self.load_seconds, e)
+            if self.registry is not None:
+                self.registry.record_event(self, "failed", str(e))
+            raise
+        finally:
+            nested = stack.pop()
+        rss_after = process_rss()
+        if rss_before is not None and rss_after is not None:
+            total = max(0, rss_after - rss_before)
+            self.memory_bytes = max(0, total - nested)
+            if stack:
+                stack[-1] += total
+        self.load_seconds = time.perf_counter() - start
+        self.last_used = time.time()
+        self.loads += 1
+        self.state = self.READY
+        logger.info("模型 %s 加载完成，耗时 %.2fs", self.name, self.load_seconds)
+        if self.registry is not None:
+            self.registry.record_event(self, "loaded")
+
+    def unload(self, reason="manual", blocking=True):
+        """
+        卸载模型，正在使用或正在加载时不卸载
+
+        返回:
+        是否已卸载
+        """
+        if not self._lock.acquire(blocking=blocking):
+            return False
+        try:
+            if self.state != self.READY or self._users > 0:
+                return False
+            value = self._value
+            self._value = None
+            self.state = self.NOT_LOADED
+            freed = self.memory_bytes
+            self.memory_bytes = None
+            self.unloads += 1
+        finally:
+            self._lock.release()
+
+        if self.unloader is not None:
+            try:
+                self.unloader(value)
+            except Exception as e:
+                logger.warning("卸载模型 %s 时出错: %s", self.name, e)
+        del value
+        gc.collect()
+        logger.info("已卸载模型 %s（%s）", self.name, reason)
+        if self.registry is not None:
+            self.registry.record_event(self, "unloaded", reason, freed)
+        return True
+
+    def start_background(self):
+        """在后台线程中预热模型，失败只记录状态"""
+        def warm():
+            try:
+                self.get()
+            except Exception:
+                pass
+        threading.Thread(target=warm, name=f"warm-{self.name}", daemon=True).start()
+
+    @property
+    def ready(self):
+        return self.state == self.READY
+
+    @property
+    def in_use(self):
+        return self._users > 0
+
+    def status(self):
+        return {
+            "state": self.state,
+            "load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            "error": self.error,
+            "memory_mb": round(self.memory_bytes / 2 ** 20, 1) if self.memory_bytes is not None else None,
+            "idle_seconds": round(time.time() - self.last_used, 1) if self.ready and self.last_used else None,
+            "in_use": self.in_use,
+            "loads": self.loads,
+            "unloads": self.unloads
+        }
+
+
+class ModelRegistry:
+    """
+    进程内全部模型的登记处
+
+    各模型首次使用时加载；空闲超过 idle_timeout 秒的模型由后台线程卸载，
+    常驻模型的内存开销合计超过 max_memory_mb 时按最近最少使用（LRU）顺序卸载其他模型。
+    内存开销为加载前后进程常驻内存之差，只是估计值（首次加载还包含模块导入等无法归还的部分）。
+    """
+
+    def __init__(self, max_memory_mb=0, idle_timeout=0, max_events=100):
+        """
+        参数:
+        max_memory_mb -- 常驻模型的内存预算（MB），0 表示不限制
+        idle_timeout -- 空闲多少秒后卸载，0 表示不按空闲时间卸载
+        max_events -- 保留的最近加载/卸载事件数
+        """
+        self.max_memory_bytes = max_memory_mb * 2 ** 20
+        self.idle_timeout = idle_timeout
+        self._models = {}
+        self._events = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def register(self, name, loader, unloader=None):
+        """
+        登记模型并返回对应的 LazyModel
+
+        同名模型已登记时更新其加载与卸载函数并返回原对象，已加载的模型继续复用
+        """
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = self._models[name] = LazyModel(name, loader, unloader, registry=self)
+            else:
+                model.loader = loader
+                model.unloader = unloader
+            return model
+
+    def models(self):
+        with self._lock:
+            return list(self._models.values())
+
+    def record_event(self, model, event, detail=None, memory_bytes=None):
+        if memory_bytes is None:
+            memory_bytes = model.memory_bytes
+        self._events.append({
+            "time": time.time(),
+            "model": model.name,
+            "event": event,
+            "detail": detail,
+            "memory_mb": round(memory_bytes / 2 ** 20, 1) if memory_bytes is not None else None
+        })
+
+    def resident_bytes(self):
+        return sum(model.memory_bytes or 0 for model in self.models() if model.ready)
+
+    def enforce_budget(self, keep=None):
+        """超出内存预算时按最近最少使用顺序卸载空闲模型，keep 为刚加载的模型"""
+        if not self.max_memory_bytes:
+            return
+        candidates = sorted(
+            (model for model in self.models() if model.ready and model is not keep),
+            key=lambda model: model.last_used or 0
+        )
+        for model in candidates:
+            if self.resident_bytes() <= self.max_memory_bytes:
+                return
+            # 其他线程持有该模型的锁（如正在嵌套加载）时跳过，避免死锁
+            model.unload("memory_budget", blocking=False)
+        if self.resident_bytes() > self.max_memory_bytes:
+            logger.warning("常驻模型占用 %.0fMB，超出预算 %.0fMB（其余模型正在使用）",
+                           self.resident_bytes() / 2 ** 20, self.max_memory_bytes / 2 ** 20)
+
+    def unload_idle(self):
+        """卸载空闲超过 idle_timeout 的模型"""
+        if not self.idle_timeout:
+            return
+        now = time.time()
+        for model in self.models():
+            if model.ready and not model.in_use and now - (model.last_used or now) > self.idle_timeout:
+                model.unload("idle", blocking=False)
+
+    def start_reaper(self):
+        """启动按空闲时间卸载模型的后台线程"""
+        if not self.idle_timeout or self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(min(30, max(1, self.idle_timeout / 4)))
+                try:
+                    self.unload_idle()
+                except Exception as e:
+                    logger.error("卸载空闲模型失败: %s", e)
+
+        self._reaper = threading.Thread(target=reap, name="model-reaper", daemon=True)
+        self._reaper.start()
+
+    def status(self):
+        rss = process_rss()
+        return {
+            "budget_mb": round(self.max_memory_bytes / 2 ** 20) if self.max_memory_bytes else None,
+            "idle_timeout": self.idle_timeout or None,
+            "resident_mb": round(self.resident_bytes() / 2 ** 20, 1),
+            "process_rss_mb": round(rss / 2 ** 20, 1) if rss is not None else None,
+            "events": list(self._events)
+        }
@@ -0,0 +1,612 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import errno
+import select
+import struct
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 与前端 musicSuffix 一致的音乐文件扩展名
+MUSIC_EXTENSIONS = ('.mp3', '.wav', '.flac')
+
+# 队列优先级：正在播放或刚被请求的歌曲插队，快速模式的整曲复核排在曲库新文件之后
+PRIORITY_REFINE = -10
+PRIORITY_NORMAL = 0
+PRIORITY_PLAYING = 10
+
+# 单个文件打标签失败的最大重试次数，超过后不再尝试，直到文件再次变化
+MAX_ATTEMPTS = 3
+
+
+def default_library_path(db_path):
+    """监视状态与工作队列数据库放在 -db_path 旁边"""
+    root, _ = os.path.splitext(db_path)
+    return root + '.library.sqlite'
+
+
+def is_music_file(path):
+    return path.lower().endswith(MUSIC_EXTENSIONS)
+
+
+def _prefix_range(directory):
+    """目录下所有路径在字符串排序中的区间 [lower, upper)"""
+    lower = os.path.join(directory, '')
+    return lower, lower[:-1] + chr(ord(lower[-1]) + 1)
+
+
+def write_style_labels(db, results):
+    """
+    在一个事务中写入（或更新）多首歌的 style_label
+
+    标签与前端（JSON.stringify）一致保存为紧凑的 JSON 数组字符串；music_labels 由前端创建，尚不存在时按相同结构创建
+    """
+    with db.write("library_save_labels") as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS music_labels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_name TEXT NOT NULL,
+                file_path TEXT NOT NULL UNIQUE,
+                style_label TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.executemany('''
+            INSERT INTO music_labels (file_name, file_path, style_label) VALUES (?, ?, ?)
+            ON CONFLICT(file_path) DO UPDATE SET
+                style_label = excluded.style_label,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [
+            (os.path.basename(result['path']), result['path'],
+             json.dumps(result['labels'], ensure_ascii=False, separators=(',', ':')))
+            for result in results
+        ])
+
+
+def delete_tracks(db, paths):
+    """在一个事务中删除已不存在的文件对应的 music_labels 记录"""
+    with db.write("library_delete_labels") as conn:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'music_labels'"
+        ).fetchone()
+        if exists:
+            conn.executemany('DELETE FROM music_labels WHERE file_path = ?', [(path,) for path in paths])
+
+
+class TagWorkQueue:
+    """
+    持久化的打标签工作队列
+
+    library_files 记录每个文件上次扫描到的大小与修改时间，tag_queue 保存待打标签的文件；
+    两者都存放在独立的 SQLite 文件中，服务重启后从中断处继续。
+    """
+
+    def __init__(self, queue_path):
+        self.queue_path = queue_path
+        self._open()
+        if hasattr(os, 'register_at_fork'):
+            # SQLite 连接不能跨 fork 使用，生产模式的工作进程各自重新打开
+            os.register_at_fork(after_in_child=self._open)
+
+    def _open(self):
+        self._lock = threading.Lock()
+        # 有新任务时唤醒打标签线程
+        self.available = threading.Event()
+        self._conn = sqlite3.connect(self.queue_path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS library_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS tag_queue (
+                path TEXT PRIMARY KEY,
+                priority INTEGER NOT NULL,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_tag_queue_order ON tag_queue(priority DESC, enqueued_at)')
+        self._conn.commit()
+        with self._lock:
+            if self._pending_count():
+                self.available.set()
+
+    def _pending_count(self):
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM tag_queue WHERE attempts < ?', (MAX_ATTEMPTS,)
+        ).fetchone()[0]
+
+    def known_files(self, directory):
+        """返回目录下已记录的 {路径: (大小, 修改时间)}"""
+        lower, upper = _prefix_range(directory)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT path, size, mtime_ns FROM library_files WHERE path >= ? AND path < ?', (lower, upper)
+            ).fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def known_file(self, path):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size, mtime_ns FROM library_files WHERE path = ?', (path,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def record(self, changed, priority=PRIORITY_NORMAL):
+        """
+        记录新增或变化的文件并加入队列
+
+        参数:
+        changed -- [(路径, 大小, 修改时间)]
+        """
+        if not changed:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO library_files (path, size, mtime_ns) VALUES (?, ?, ?)', changed)
+            # 文件再次变化时清零失败次数，已在队列中的保留原有的较高优先级
+            self._conn.executemany('''
+                INSERT INTO tag_queue (path, priority, enqueued_at) VALUES (?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    priority = MAX(priority, excluded.priority),
+                    attempts = 0,
+                    last_error = NULL
+            ''', [(path, priority, now) for path, _, _ in changed])
+            self._conn.commit()
+        self.available.set()
+
+    def enqueue(self, paths, priority=PRIORITY_NORMAL):
+        """读取文件当前的大小与修改时间后加入队列，不存在的文件跳过"""
+        changed = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            changed.append((path, stat.st_size, stat.st_mtime_ns))
+        self.record(changed, priority)
+        return len(changed)
+
+    def forget(self, paths):
+        """文件被删除：移出状态表和队列"""
+        if not paths:
+            return
+        with self._lock:
+            self._conn.executemany('DELETE FROM library_files WHERE path = ?', [(path,) for path in paths])
+            self._conn.executemany('DELETE FROM tag_queue WHERE path = ?', [(path,) for path in paths])
+            self._conn.commit()
+
+    def prioritize(self, paths):
+        """
+        让已排队的文件插队
+
+        返回:
+        实际提升了优先级的文件数
+        """
+        with self._lock:
+            cursor = self._conn.executemany(
+                'UPDATE tag_queue SET priority = ? WHERE path = ? AND priority < ?',
+                [(PRIORITY_PLAYING, path, PRIORITY_PLAYING) for path in paths]
+            )
+            self._conn.commit()
+        if cursor.rowcount > 0:
+            self.available.set()
+        return max(cursor.rowcount, 0)
+
+    def take(self, limit):
+        """按优先级取出最多 limit 个待处理文件（不出队，处理完成后调用 done/fail）"""
+        with self._lock:
+            rows = self._conn.execute('''
+                SELECT path FROM tag_queue WHERE attempts < ?
+                ORDER BY priority DESC, enqueued_at LIMIT ?
+            ''', (MAX_ATTEMPTS, limit)).fetchall()
+            if not rows:
+                self.available.clear()
+        return [row[0] for row in rows]
+
+    def done(self, paths):
+        with self._lock:
+            self._conn.executemany('DELETE FROM tag_queue WHERE path = ?', [(path,) for path in paths])
+            self._conn.commit()
+
+    def fail(self, errors):
+        """
+        记录失败，达到 MAX_ATTEMPTS 后留在表中但不再被取出
+
+        插队的文件失败后降回普通优先级，不再反复占用队首；低于普通优先级的（如细化标签）保持不变
+
+        参数:
+        errors -- {路径: 错误信息}
+        """
+        with self._lock:
+            self._conn.executemany('''
+                UPDATE tag_queue SET attempts = attempts + 1, last_error = ?, priority = MIN(priority, ?)
+                WHERE path = ?
+            ''', [(error, PRIORITY_NORMAL, path) for path, error in errors.items()])
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            files = self._conn.execute('SELECT COUNT(*) FROM library_files').fetchone()[0]
+            pending, playing, failed = self._conn.execute('''
+                SELECT
+                    COALESCE(SUM(attempts < ?), 0),
+                    COALESCE(SUM(attempts < ? AND priority >= ?), 0),
+                    COALESCE(SUM(attempts >= ?), 0)
+                FROM tag_queue
+            ''', (MAX_ATTEMPTS, MAX_ATTEMPTS, PRIORITY_PLAYING, MAX_ATTEMPTS)).fetchone()
+        return {"files": files, "pending": pending, "prioritized": playing, "failed": failed}
+
+
+class _Inotify:
+    """通过 libc 调用 inotify 的最小封装（仅 Linux）"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    # 文件写完（而不是每次写入）时才触发，复制大文件时不会重复入队
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    # 只有这些事件说明文件内容已确定或文件已消失；IN_CREATE 时文件可能还在写入
+    FILE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._ctypes = ctypes
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self._paths = {}
+        self._wds = {}
+
+    def add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, f"无法监视目录 {directory}: {os.strerror(err)}")
+        self._paths[wd] = directory
+        self._wds[directory] = wd
+
+    def watched(self, directory):
+        return directory in self._wds
+
+    def read(self, timeout):
+        """
+        等待事件
+
+        返回:
+        [(路径, mask)]；队列溢出时路径为 None，超时返回空列表
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:
+                # 目录已删除或移走，内核自动移除了监视
+                self._paths.pop(wd, None)
+                self._wds.pop(directory, None)
+                continue
+            events.append((os.path.join(directory, name) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """
+    监视音乐目录，按大小和修改时间发现新增、变化和删除的文件
+
+    Linux 上使用 inotify，其余平台或 inotify 不可用（如监视数超过上限）时定期轮询全量扫描；
+    新增和变化的文件写入 TagWorkQueue，删除的文件交给 on_removed 回调。
+    """
+
+    # inotify 模式下的兜底全量扫描间隔（秒），防止漏掉事件
+    RESCAN_INTERVAL = 3600
+
+    def __init__(self, roots, work_queue, poll_interval=60, on_removed=None):
+        """
+        参数:
+        roots -- 要监视的目录列表
+        work_queue -- TagWorkQueue
+        poll_interval -- 轮询模式的扫描间隔（秒）
+        on_removed -- 文件删除时的回调，参数为路径列表
+        """
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.work_queue = work_queue
+        self.poll_interval = poll_interval
+        self.on_removed = on_removed
+        self.mode = None
+        self.last_scan = None
+
+    def scan(self, directory=None):
+        """
+        全量扫描目录（默认全部根目录），与记录的状态比较
+
+        返回:
+        (入队文件数, 删除文件数)
+        """
+        changed = []
+        removed = []
+        for root in ([directory] if directory else self.roots):
+            known = self.work_queue.known_files(root)
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if not is_music_file(path):
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    state = (stat.st_size, stat.st_mtime_ns)
+                    if known.pop(path, None) != state:
+                        changed.append((path, *state))
+            removed.extend(known)
+        self._apply(changed, removed)
+        if directory is None:
+            self.last_scan = time.time()
+        return len(changed), len(removed)
+
+    def check(self, path):
+        """检查单个文件是否新增、变化或被删除"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if self.work_queue.known_file(path) is not None:
+                self._apply([], [path])
+            return
+        state = (stat.st_size, stat.st_mtime_ns)
+        if self.work_queue.known_file(path) != state:
+            self._apply([(path, *state)], [])
+
+    def prioritize(self, paths):
+        """
+        正在播放或刚被请求的文件插队；监视目录下尚未扫描到的文件直接以高优先级入队
+
+        返回:
+        插队的文件数
+        """
+        unseen = []
+        for path in paths:
+            if not is_music_file(path) or not any(path.startswith(os.path.join(root, '')) for root in self.roots):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self.work_queue.known_file(path) != state:
+                unseen.append((path, *state))
+        self.work_queue.record(unseen, priority=PRIORITY_PLAYING)
+        return len(unseen) + self.work_queue.prioritize(paths)
+
+    def _apply(self, changed, removed):
+        if changed:
+            self.work_queue.record(changed)
+            logger.info("曲库中 %d 个文件新增或变化，已加入打标签队列", len(changed))
+        if removed:
+            self.work_queue.forget(removed)
+            logger.info("曲库中 %d 个文件已删除", len(removed))
+            if self.on_removed is not None:
+                self.on_removed(removed)
+
+    def run(self):
+        """监视循环，在后台线程中运行"""
+        roots = [root for root in self.roots if os.path.isdir(root)]
+        for root in set(self.roots) - set(roots):
+            logger.warning("曲库目录不存在，跳过: %s", root)
+        self.roots = roots
+
+        inotify = None
+        if sys.platform.startswith('linux'):
+            try:
+                inotify = _Inotify()
+                for root in self.roots:
+                    self._watch_tree(inotify, root)
+            except OSError as e:
+                logger.warning("inotify 不可用，改为每 %d 秒轮询: %s", self.poll_interval, e)
+                if inotify is not None:
+                    inotify.close()
+                inotify = None
+
+        # 先建立监视再做首次扫描，扫描期间的变化不会漏掉
+        self._safe_scan()
+        if inotify is not None:
+            self.mode = "inotify"
+            # 只有监视数达到上限时才返回，之后退回轮询
+            self._run_inotify(inotify)
+            inotify.close()
+        self.mode = "polling"
+        while True:
+            time.sleep(self.poll_interval)
+            self._safe_scan()
+
+    def _safe_scan(self, directory=None):
+        try:
+            self.scan(directory)
+        except Exception as e:
+            logger.error("扫描曲库失败: %s", e)
+
+    def _watch_tree(self, inotify, directory):
+        for dirpath, _, _ in os.walk(directory):
+            if not inotify.watched(dirpath):
+                inotify.add_watch(dirpath)
+
+    def _run_inotify(self, inotify):
+        while True:
+            events = inotify.read(timeout=max(0.0, (self.last_scan or time.time()) + self.RESCAN_INTERVAL - time.time()))
+            if not events:
+                self._safe_scan()
+                continue
+            # 短暂等待合并同一批操作（如整个目录复制）产生的事件
+            time.sleep(0.5)
+            events.extend(inotify.read(timeout=0))
+
+            rescan = False
+            directories = set()
+            files = set()
+            for path, mask in events:
+                if path is None:
+                    rescan = True
+                elif mask & inotify.IN_ISDIR:
+                    directories.add(path)
+                elif mask & inotify.FILE_EVENTS and is_music_file(path):
+                    files.add(path)
+
+            try:
+                if rescan:
+                    logger.warning("inotify 事件队列溢出，重新全量扫描")
+                    for root in self.roots:
+                        self._watch_tree(inotify, root)
+                    self.scan()
+                    continue
+                for directory in directories:
+                    # 新建或移入的目录需要添加监视并扫描其中已有的文件；删除或移走的目录扫描后记录删除
+                    if os.path.isdir(directory):
+                        self._watch_tree(inotify, directory)
+                    self.scan(directory)
+                for path in files:
+                    self.check(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.warning("inotify 监视数达到上限（fs.inotify.max_user_watches），改为每 %d 秒轮询",
+                                   self.poll_interval)
+                    return
+                logger.error("处理曲库变化失败: %s", e)
+
+    def stats(self):
+        return {
+            "roots": self.roots,
+            "mode": self.mode,
+            "last_scan": self.last_scan,
+            "queue": self.work_queue.stats()
+        }
+
+
+class ModelUnavailableError(Exception):
+    """音乐标签模型加载失败"""
+    pass
+
+
+class LibraryTagger:
+    """
+    后台打标签线程：按优先级从 TagWorkQueue 取文件，用常驻的 musicnn 模型批量打标签，
+    每批结果交给 save_results 在一个事务中写库。
+    """
+
+    # 其他工作进程写入队列时不会唤醒本进程，按此间隔（秒）检查一次
+    POLL_SECONDS = 5
+
+    def __init__(self, work_queue, tagger_model, save_results, lookup=None, batch_size=16, top_n=5):
+        """
+        参数:
+        work_queue -- TagWorkQueue
+        tagger_model -- 加载 MusicTagger 的 LazyModel，打标签期间持有模型，不会被 ModelRegistry 卸载
+        save_results -- 写库函数，参数为 [{"path", "labels", "embedding"}]
+        lookup -- 可选，查询已有结果的函数 lookup(path)，命中时返回 {"labels", "embedding"}，否则返回 None
+        batch_size -- 每批处理的文件数，正在播放的歌曲最多等待一批
+        top_n -- 每个文件保存的标签数量
+        """
+        self.work_queue = work_queue
+        self.tagger_model = tagger_model
+        self.save_results = save_results
+        self.lookup = lookup
+        self.batch_size = batch_size
+        self.top_n = top_n
+        self.tagged = 0
+        self.failed = 0
+
+    def run(self):
+        """打标签循环，在后台线程中运行"""
+        while True:
+            self.work_queue.available.wait(timeout=self.POLL_SECONDS)
+            paths = self.work_queue.take(self.batch_size)
+            if not paths:
+                continue
+            try:
+                self.process(paths)
+            except ModelUnavailableError as e:
+                logger.error("音乐标签模型不可用，稍后重试: %s", e)
+                time.sleep(60)
+            except Exception as e:
+                logger.error("写入曲库标签失败: %s", e)
+                self.work_queue.fail({path: str(e) for path in paths})
+
+    def process(self, paths):
+        results = []
+        errors = {}
+        misses = []
+        for path in paths:
+            cached = None
+            if self.lookup is not None:
+                try:
+                    cached = self.lookup(path)
+                except OSError:
+                    pass
+            if cached is None:
+                misses.append(path)
+            else:
+                # 刚被 /api/musiclabel 分析过的文件直接复用结果
+                results.append({"path": path, "labels": cached['labels'], "embedding": cached['embedding']})
+
+        if misses:
+            try:
+                self.tagger_model.get()
+            except Exception as e:
+                raise ModelUnavailableError(str(e)) from e
+            with self.tagger_model.use() as tagger:
+                for result in tagger.tag_files(misses, top_n=self.top_n):
+                    if 'error' in result:
+                        errors[result['path']] = result['error']
+                    else:
+                        results.append(result)
+        if results:
+            self.save_results(results)
+            self.work_queue.done([result['path'] for result in results])
+        if errors:
+            self.work_queue.fail(errors)
+        self.tagged += len(results)
+        self.failed += len(errors)
+        logger.info("后台打标签完成 %d 个文件，失败 %d 个", len(results), len(errors))
+
+    def stats(self):
+        return {"tagged": self.tagged, "failed": self.failed}
@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, stream_with_context
 from datetime import datetime
-from musicnn.tagger import top_tags
 import warnings
 import argparse
 import os
-from music_recommender import get_music_recommendations
-from inference import EmotionPredictor  # 导入EmotionPredictor
+import json
+import math
+import time
+import importlib
+import logging
+import threading
+from music_recommender import MusicRecommenderIndex, MusicEmbeddingIndex, MusicTagIndex
+from music_db import MusicDatabase
+from result_cache import ResultCache, default_cache_path, file_fingerprint
+from emotion_jobs import EmotionJobQueue, QueueFullError
+from lazy_model import ModelRegistry
+from feature_store import FeatureStore
+from serving import pin_threads, serve
+from library_watcher import (TagWorkQueue, LibraryWatcher, LibraryTagger, default_library_path,
+                             write_style_labels, delete_tracks, PRIORITY_REFINE)
+import metrics
 warnings.filterwarnings("ignore")  # 忽略所有警告
 
 # 若需更彻底禁用（包括第三方库的警告）：
@@ -17,30 +30,251 @@ parser = argparse.ArgumentParser(description='Python后端服务')
 parser.add_argument('-db_path', type=str, required=True, help='SQLite数据库路径')
 parser.add_argument('-model_path', type=str, default="./checkpoints/iemocap/multimodal_model_6way", help='情感识别模型路径')
 parser.add_argument('-bert_path', type=str, default="./bert-base-uncased", help='BERT模型路径')
+parser.add_argument('-tag_workers', type=int, default=4, help='音乐标签音频解码线程数')
+parser.add_argument('-tag_batch_size', type=int, default=64, help='音乐标签网络每批处理的patch数')
+parser.add_argument('-tag_mode', type=str, default='full', choices=['full', 'fast'],
+                    help='/api/musiclabel 默认的分析方式：full 分析整首歌，fast 只分析采样窗口（请求可用 "mode" 覆盖）')
+parser.add_argument('-tag_segments', type=int, default=8, help='快速模式分析的窗口数（每个窗口3秒）')
+parser.add_argument('-tag_segment_strategy', type=str, default='even', choices=['even', 'energy'],
+                    help='快速模式的窗口选取方式：even 均匀分布，energy 从两倍候选中取能量最高的窗口')
+parser.add_argument('-tag_refine', action='store_true',
+                    help='快速模式返回后在后台整曲复核并覆盖保存的标签（请求可用 "refine" 覆盖）')
+parser.add_argument('-ann_nprobe', type=int, default=8, help='近似最近邻推荐每次查询扫描的聚类数')
+parser.add_argument('-tag_backend', type=str, default='memory', choices=['memory', 'sql'],
+                    help='标签推荐方式：memory 为常驻内存的稀疏矩阵（预计算近邻时固定使用 memory）；'
+                         'sql 为 SQLite 倒排索引查询，不占用内存，但常见标签的候选很多时比 memory 慢数倍')
+parser.add_argument('-neighbours_top_k', type=int, default=0, help='后台预计算每首歌的近邻数，0 表示不预计算')
+parser.add_argument('-neighbours_interval', type=int, default=600, help='检查曲库变化并重新预计算近邻的间隔（秒）')
+parser.add_argument('-cache_path', type=str, default=None, help='结果缓存数据库路径，默认放在db_path旁')
+parser.add_argument('-cache_max_entries', type=int, default=10000, help='结果缓存最大条目数')
+parser.add_argument('-text_encoder', type=str, default='fp32', choices=['fp32', 'int8', 'onnx'],
+                    help='BERT文本编码后端：fp32 原始模型，int8 动态量化，onnx 导出到 ONNX Runtime 运行')
+parser.add_argument('-text_threads', type=int, default=0, help='BERT编码使用的线程数，0 表示沿用进程设置')
+parser.add_argument('-onnx_path', type=str, default=None,
+                    help='ONNX 模型路径，不存在时自动导出；默认放在用户缓存目录（~/.cache/soyo-player/onnx），按 BERT 模型区分')
+parser.add_argument('-emotion_batch_size', type=int, default=8, help='情感模型与BERT微批处理的最大批大小')
+parser.add_argument('-emotion_batch_wait_ms', type=int, default=5, help='微批处理凑批的最长等待时间（毫秒）')
+parser.add_argument('-xla', action='store_true', help='用 XLA 编译情感模型的推理函数（批大小补齐到2的幂，加载时逐一编译）')
+parser.add_argument('-emotion_workers', type=int, default=1, help='后台情感分析并发任务数')
+parser.add_argument('-emotion_queue_size', type=int, default=16, help='后台情感分析最大排队任务数')
+parser.add_argument('-emotion_job_timeout', type=int, default=600, help='单个情感分析任务超时时间（秒）')
+parser.add_argument('-startup', type=str, default='background', choices=['eager', 'background', 'lazy'],
+                    help='模型加载方式：eager 启动前加载，background 服务启动后后台预热，lazy 首次请求时加载')
+parser.add_argument('-max_model_memory', '--max-model-memory', dest='max_model_memory', type=int, default=0,
+                    help='常驻模型的内存预算（MB），超出时按最近最少使用卸载其他模型，0 表示不限制')
+parser.add_argument('-model_idle_timeout', type=int, default=0, help='模型空闲多少秒后卸载，下次使用时重新加载，0 表示不卸载')
+parser.add_argument('-serve', '--serve', type=str, default='dev', choices=['dev', 'prod'],
+                    help='dev 使用 Flask 调试服务器；prod 使用多线程服务器，可配合 -workers 预先 fork 多个工作进程')
+parser.add_argument('-workers', '--workers', type=int, default=1,
+                    help='prod 模式的工作进程数（仅 POSIX 平台支持多进程）；BERT 与 Vosk 在 fork 之前加载、由工作进程共享，'
+                         'TF 情感模型和 musicnn 在每个工作进程中各自加载，'
+                         '/api/metrics 与各 stats 接口只反映处理该请求的进程，后台任务状态保存在 -jobs_path 中由各进程共享')
+parser.add_argument('-intra_op_threads', type=int, default=0,
+                    help='每个进程 TF/torch 的算子内线程数，0 表示 prod 模式按 CPU 核数 / 工作进程数分配，dev 模式不限制')
+parser.add_argument('-log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    help='日志级别，DEBUG 输出每次预测的详细过程')
+parser.add_argument('-library_dirs', type=str, default=None,
+                    help=f'要监视并在后台自动打标签的音乐目录，多个目录用 "{os.pathsep}" 分隔，不指定则不启用')
+parser.add_argument('-library_path', type=str, default=None, help='曲库监视状态与打标签队列数据库路径，默认放在db_path旁')
+parser.add_argument('-library_poll_interval', type=int, default=60, help='inotify 不可用时轮询扫描曲库的间隔（秒）')
+parser.add_argument('-library_batch_size', type=int, default=16, help='后台打标签每批处理的文件数')
+parser.add_argument('-jobs_path', type=str, default=None, help='后台任务状态数据库路径，默认放在db_path旁')
+parser.add_argument('-feature_dir', type=str, default=None, help='预计算特征库目录，默认放在db_path旁')
 args = parser.parse_args()
 
+logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger("main")
+
 app = Flask(__name__)
 
-# 初始化情感预测器
-emotion_predictor = None
+# 音乐标签使用的 musicnn 模型
+TAG_MODEL = 'MSD_musicnn_big'
+# 情感模型的类别数
+EMOTION_CLASSES = 6
+
+# 曲库数据库访问层，各线程复用只读 WAL 连接并统计查询耗时
+music_db = MusicDatabase(args.db_path)
+
+# 常驻的音乐推荐索引，按 updated_at 增量同步数据库
+music_index = MusicRecommenderIndex(args.db_path, db=music_db)
+
+# 规范化标签表上的倒排索引，只查询与当前歌曲有共同标签的候选歌曲；
+# 仅在 -tag_backend sql 且不预计算近邻时使用，其余情况不建表也不同步
+music_tags = None
+if args.tag_backend == 'sql' and args.neighbours_top_k <= 0:
+    music_tags = MusicTagIndex(args.db_path, db=music_db)
+
+# 基于 musicnn 标签概率向量的近似最近邻索引，歌曲没有向量时回退到标签索引
+music_embeddings = MusicEmbeddingIndex(args.db_path, nprobe=args.ann_nprobe, db=music_db)
+
+# 音乐标签与情感预测的结果缓存，以文件内容指纹 + 模型标识为键
+result_cache = ResultCache(args.cache_path or default_cache_path(args.db_path), max_entries=args.cache_max_entries)
+
+# 各重量级依赖的导入耗时（秒）
+import_times = {}
+
+def timed_import(name, importer):
+    """导入重量级模块并记录耗时"""
+    start = time.perf_counter()
+    module = importer()
+    import_times[name] = round(time.perf_counter() - start, 3)
+    logger.info("导入 %s 耗时 %.2fs", name, import_times[name])
+    return module
+
+def load_music_tagger():
+    music_tagger = timed_import("music_tagger", lambda: importlib.import_module("music_tagger"))
+    return music_tagger.MusicTagger(
+        model=TAG_MODEL,
+        batch_size=args.tag_batch_size,
+        decode_workers=args.tag_workers
+    )
+
+# 影响文本特征的编码器配置；fp32 为空，保持已有特征库和缓存有效
+TEXT_ENCODER_ID = "" if args.text_encoder == 'fp32' else f";text_encoder={args.text_encoder}"
+
+# 时间线模式单个窗口的最长时间（秒），每个窗口的音频整段读入内存（16kHz int16，每分钟约 1.9MB）
+MAX_TIMELINE_WINDOW = 600
+
+# 预计算特征库目录
+FEATURE_DIR = args.feature_dir or os.path.splitext(args.db_path)[0] + '.features'
+
+def load_emotion_predictor():
+    inference = timed_import("inference", lambda: importlib.import_module("inference"))
+    predictor = inference.EmotionPredictor(
+        checkpoint_path=args.model_path,
+        bert_model_path=args.bert_path,
+        num_classes=EMOTION_CLASSES,
+        batch_size=args.emotion_batch_size,
+        batch_wait_ms=args.emotion_batch_wait_ms,
+        text_encoder=args.text_encoder,
+        text_threads=args.text_threads,
+        onnx_path=args.onnx_path,
+        registry=model_registry,
+        jit_compile=args.xla
+    )
+    # 特征库保存投影后的特征，命名空间区分 BERT 模型、实际使用的投影矩阵和文本编码器配置
+    predictor.feature_store = FeatureStore(
+        FEATURE_DIR,
+        namespace=f"bert={os.path.abspath(args.bert_path)};{predictor.projection_id}{TEXT_ENCODER_ID}"
+    )
+    return predictor
+
+# TensorFlow、PyTorch 等依赖随模型一起在首次使用时（或后台预热时）加载；
+# 情感预测器中的 BERT、情感模型和 Vosk 也在同一个 registry 中登记，可分别卸载
+model_registry = ModelRegistry(max_memory_mb=args.max_model_memory, idle_timeout=args.model_idle_timeout)
+music_tagger_model = model_registry.register("musicnn", load_music_tagger, unloader=lambda tagger: tagger.close())
+emotion_model = model_registry.register("emotion", load_emotion_predictor, unloader=lambda predictor: predictor.close())
+
+def tag_model_id(top_n):
+    # v2: 缓存内容为 {"labels", "embedding"}
+    return f"musicnn:{TAG_MODEL}:v2:top{top_n}"
 
-def initialize_predictor():
-    global emotion_predictor
+def save_tags(file_path, cache_key, model_id, labels, embedding):
+    """缓存标签结果，并把标签概率向量写入推荐索引"""
+    if cache_key is not None:
+        result_cache.put(cache_key, model_id, {"labels": labels, "embedding": embedding.tolist()})
+    music_embeddings.add_embedding(file_path, embedding, TAG_MODEL)
+
+def lookup_tags(file_path):
+    """查询结果缓存，供后台打标签复用 /api/musiclabel 已分析过的文件"""
+    _, cached = result_cache.get(tag_model_id(5), file_path)
+    return cached
+
+def save_library_tags(results):
+    """后台打标签的一批结果：style_label 与标签概率向量各在一个事务中写库，并写入结果缓存"""
+    write_style_labels(music_db, results)
+    music_embeddings.add_embeddings([(result['path'], result['embedding']) for result in results], TAG_MODEL)
+    model_id = tag_model_id(5)
+    for result in results:
+        try:
+            cache_key, cached = result_cache.get(model_id, result['path'])
+        except OSError:
+            continue
+        if cached is None:
+            result_cache.put(cache_key, model_id, {
+                "labels": result['labels'],
+                "embedding": [float(value) for value in result['embedding']]
+            })
+
+def remove_library_tracks(file_paths):
+    """曲库中已删除的文件：移除标签记录和推荐向量"""
+    delete_tracks(music_db, file_paths)
+    music_embeddings.remove_embeddings(file_paths)
+
+# 后台打标签队列：曲库监视发现的文件与快速模式的整曲复核都在这里排队
+tag_queue = TagWorkQueue(args.library_path or default_library_path(args.db_path))
+library_tagger = LibraryTagger(
+    tag_queue, music_tagger_model, save_library_tags,
+    lookup=lookup_tags, batch_size=args.library_batch_size
+)
+
+# 曲库监视，未指定 -library_dirs 时不启用
+if args.library_dirs:
+    library_watcher = LibraryWatcher(
+        [path for path in args.library_dirs.split(os.pathsep) if path],
+        tag_queue,
+        poll_interval=args.library_poll_interval,
+        on_removed=remove_library_tracks
+    )
+else:
+    library_watcher = None
+
+def prioritize_tracks(file_paths):
+    """正在播放或刚被请求的歌曲在后台打标签队列中插队"""
+    if not file_paths:
+        return 0
     try:
-        print("正在初始化情感预测模型...")
-        emotion_predictor = EmotionPredictor(
-            checkpoint_path=args.model_path,
-            bert_model_path=args.bert_path,
-            num_classes=6
-        )
-        print("情感预测模型初始化成功")
-        return True
+        if library_watcher is not None:
+            return library_watcher.prioritize(file_paths)
+        return tag_queue.prioritize(file_paths)
     except Exception as e:
-        print(f"情感预测模型初始化失败: {e}")
-        return False
+        logger.warning("调整打标签队列优先级失败: %s", e)
+        return 0
+
+def with_profile(response, profile):
+    """请求带 "profile": true 时在响应中附上分阶段耗时（秒）"""
+    if profile is not None:
+        response["profile"] = profile
+    return response
+
+HTTP_REQUESTS = metrics.register(metrics.Counter(
+    "soyo_http_requests_total", "HTTP 请求数", labels=("endpoint", "status")))
+HTTP_SECONDS = metrics.register(metrics.Histogram(
+    "soyo_http_request_seconds", "HTTP 请求处理耗时（秒，流式响应只计到开始输出）", labels=("endpoint",)))
+metrics.register(metrics.Gauge(
+    "soyo_cache_events", "结果缓存命中、未命中与淘汰次数",
+    lambda: {(name,): value for name, value in result_cache.stats().items() if name in ("hits", "misses", "evictions")},
+    labels=("event",)))
+metrics.register(metrics.Gauge(
+    "soyo_model_ready", "模型是否已加载",
+    lambda: {(model.name,): int(model.ready) for model in model_registry.models()},
+    labels=("model",)))
+metrics.register(metrics.Gauge(
+    "soyo_model_memory_bytes", "已加载模型估计的内存开销（字节）",
+    lambda: {(model.name,): model.memory_bytes or 0 for model in model_registry.models() if model.ready},
+    labels=("model",)))
+metrics.register(metrics.Gauge(
+    "soyo_library_queue", "后台打标签队列中待处理、插队与失败的文件数",
+    lambda: {(name,): value for name, value in tag_queue.stats().items() if name != "files"},
+    labels=("state",)))
+metrics.register(metrics.Gauge(
+    "soyo_emotion_queue_depth", "后台情感分析排队任务数",
+    lambda: {(): emotion_jobs.stats()["queue_depth"]}))
+
+@app.before_request
+def start_request_timer():
+    request.start_time = time.perf_counter()
 
-# 立即初始化模型，而不是等待第一个请求
-initialize_predictor()
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_REQUESTS.inc(endpoint, response.status_code)
+    HTTP_SECONDS.observe(time.perf_counter() - request.start_time, endpoint)
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/hello', methods=['GET'])
 def hello():
@@ -57,14 +291,131 @@ def music_label():
         return jsonify({"error": "Missing 'path' parameter"}), 400
     
     file_path = data['path']
+    mode = data.get('mode', args.tag_mode)
+    if mode not in ('full', 'fast'):
+        return jsonify({"error": "'mode' must be 'full' or 'fast'"}), 400
+    refine = data.get('refine', args.tag_refine)
     
-    # 调用top_tags函数分析音频文件
+    # 调用top_tags函数分析音频文件，命中缓存时直接返回
     try:
-        labels = top_tags(file_path, model='MSD_musicnn_big', topN=5, print_tags=False)
-        return jsonify({"labels": labels})
+        with metrics.profiled(data.get('profile')) as profile:
+            model_id = tag_model_id(5)
+            with metrics.stage("cache_lookup"):
+                cache_key, cached = result_cache.get(model_id, file_path)
+            if cached is not None:
+                # 已有整曲结果时快速模式也直接使用
+                mode = 'full'
+                labels = cached['labels']
+                music_embeddings.add_embedding(file_path, cached['embedding'], TAG_MODEL, replace=False)
+            elif mode == 'full':
+                with music_tagger_model.use() as tagger:
+                    labels, embedding = tagger.analyze(file_path, top_n=5)
+                save_tags(file_path, cache_key, model_id, labels, embedding)
+            else:
+                labels, sampled = fast_tags(file_path)
+                mode = 'fast' if sampled else 'full'
+        response = {"labels": labels, "mode": mode}
+        if mode == 'fast':
+            # 采样结果之后由后台整曲复核，写入 style_label 覆盖前端保存的快速结果
+            response["refine_scheduled"] = bool(refine) and tag_queue.enqueue([file_path], PRIORITY_REFINE) > 0
+        else:
+            # 刚请求过的文件在后台队列中插队，结果直接取自缓存写入 style_label
+            prioritize_tracks([file_path])
+        return jsonify(with_profile(response, profile))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def fast_tags(file_path):
+    """
+    快速模式：只分析 -tag_segments 个采样窗口
+
+    返回:
+    (标签, 是否为采样结果)；曲子较短等情况下退回整曲分析，结果按整曲缓存
+    """
+    fast_model_id = f"{tag_model_id(5)}:fast:{args.tag_segment_strategy}{args.tag_segments}"
+    with metrics.stage("cache_lookup"):
+        cache_key, cached = result_cache.get(fast_model_id, file_path)
+    if cached is not None:
+        music_embeddings.add_embedding(file_path, cached['embedding'], TAG_MODEL, replace=False)
+        return cached['labels'], True
+
+    with music_tagger_model.use() as tagger:
+        labels, embedding, sampled = tagger.analyze_sampled(
+            file_path, top_n=5, segments=args.tag_segments, strategy=args.tag_segment_strategy)
+    if sampled:
+        # 近似向量不覆盖已有的整曲向量
+        result_cache.put(cache_key, fast_model_id, {"labels": labels, "embedding": embedding.tolist()})
+        music_embeddings.add_embedding(file_path, embedding, TAG_MODEL, replace=False)
+    else:
+        model_id = tag_model_id(5)
+        save_tags(file_path, result_cache.make_key(model_id, file_fingerprint(file_path)), model_id, labels, embedding)
+    return labels, sampled
+
+@app.route('/api/musiclabel/batch', methods=['POST'])
+def music_label_batch():
+    # 获取请求中的paths参数
+    data = request.get_json()
+    if not data or not isinstance(data.get('paths'), list):
+        return jsonify({"error": "Missing 'paths' parameter"}), 400
+
+    file_paths = data['paths']
+    top_n = data.get('top_n', 5)
+
+    try:
+        music_tagger_model.get()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    model_id = tag_model_id(top_n)
+
+    # 每处理完一个文件输出一行JSON（NDJSON），客户端可边收边写库
+    def generate():
+        # 先返回缓存命中的文件，其余交给标签器
+        cache_keys = {}
+        misses = []
+        for path in file_paths:
+            try:
+                cache_key, cached = result_cache.get(model_id, path)
+            except OSError:
+                # 文件不存在等错误交给标签器统一报告
+                misses.append(path)
+                continue
+            if cached is None:
+                cache_keys[path] = cache_key
+                misses.append(path)
+            else:
+                music_embeddings.add_embedding(path, cached['embedding'], TAG_MODEL, replace=False)
+                yield json.dumps({"path": path, "labels": cached['labels']}, ensure_ascii=False) + "\n"
+
+        if not misses:
+            return
+        with music_tagger_model.use() as tagger:
+            for result in tagger.tag_files(misses, top_n=top_n):
+                embedding = result.pop('embedding', None)
+                if embedding is not None:
+                    save_tags(result['path'], cache_keys.get(result['path']), model_id, result['labels'], embedding)
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def parse_top_n(data, default):
+    """读取请求中的 top_n，不是整数时返回 None"""
+    top_n = data.get('top_n', default)
+    if isinstance(top_n, bool) or not isinstance(top_n, int):
+        return None
+    return top_n
+
+def recommend_for(file_name, top_n):
+    """优先使用标签概率向量的近似最近邻推荐，当前歌曲没有向量时回退到标签推荐；top_n 不大于 0 时返回空列表"""
+    with metrics.stage("recommend"):
+        recommended_songs = music_embeddings.recommend(file_name, top_n)
+        if recommended_songs is None:
+            if music_tags is None:
+                recommended_songs = music_index.recommend(file_name, top_n)
+            else:
+                recommended_songs = music_tags.recommend(file_name, top_n)
+    return recommended_songs
+
 @app.route('/api/recommend', methods=['POST'])
 def recommend_music():
     # 获取请求中的当前播放文件名
@@ -73,15 +424,123 @@ def recommend_music():
         return jsonify({"error": "Missing 'file_name' parameter"}), 400
     
     file_name = data['file_name']
-    top_n = data.get('top_n', 3)  # 默认推荐3首歌
+    top_n = parse_top_n(data, 3)  # 默认推荐3首歌
+    if top_n is None:
+        return jsonify({"error": "'top_n' must be an integer"}), 400
     
     try:
-        # 调用推荐函数获取推荐歌曲
-        recommended_songs = get_music_recommendations(args.db_path, file_name, top_n)
-        return jsonify({"recommended_songs": recommended_songs})
+        with metrics.profiled(data.get('profile')) as profile:
+            recommended_songs = recommend_for(file_name, top_n)
+        if library_watcher is not None:
+            # 当前播放的歌曲在后台打标签队列中插队
+            prioritize_tracks([row[0] for row in music_db.query("label_paths", (file_name,))])
+        return jsonify(with_profile({"recommended_songs": recommended_songs}, profile))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/recommend/batch', methods=['POST'])
+def recommend_music_batch():
+    """
+    批量推荐：为每首种子歌曲分别推荐，blend 为 true 时再为整个歌单返回一份混合推荐
+    """
+    data = request.get_json()
+    if not data or not isinstance(data.get('file_names'), list):
+        return jsonify({"error": "Missing 'file_names' parameter"}), 400
+
+    file_names = data['file_names']
+    top_n = parse_top_n(data, 3)
+    if top_n is None:
+        return jsonify({"error": "'top_n' must be an integer"}), 400
+
+    try:
+        with metrics.profiled(data.get('profile')) as profile:
+            response = {"results": {name: recommend_for(name, top_n) for name in file_names}}
+            if data.get('blend'):
+                with metrics.stage("recommend_blend"):
+                    blended = music_embeddings.recommend_blend(file_names, top_n)
+                    if blended is None:
+                        blended = music_index.recommend_many(file_names, top_n, blend=True)
+                response["blended"] = blended
+        return jsonify(with_profile(response, profile))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def precompute_neighbours_loop():
+    """定期检查曲库，有变化时在后台重新预计算标签近邻列表"""
+    while True:
+        try:
+            start = time.perf_counter()
+            count = music_index.precompute_neighbours(args.neighbours_top_k)
+            if count:
+                logger.info("已预计算 %d 首歌的近邻，耗时 %.2fs", count, time.perf_counter() - start)
+        except Exception as e:
+            logger.error("预计算近邻失败: %s", e)
+        time.sleep(args.neighbours_interval)
+
+def ensure_predictor():
+    """确保情感预测器已初始化，失败时抛出异常；使用时用 emotion_model.use() 持有引用"""
+    try:
+        emotion_model.get()
+    except Exception as e:
+        raise RuntimeError(f"情感预测模型初始化失败: {e}")
+
+def analyze_emotion(video_path, progress=None):
+    """
+    分析视频情感，命中缓存时直接返回
+
+    返回:
+    /api/emotion 的响应内容；预测失败时抛出异常
+    """
+    model_id = f"emotion:{args.model_path}:{EMOTION_CLASSES}{TEXT_ENCODER_ID}"
+    with metrics.stage("cache_lookup"):
+        cache_key, result = result_cache.get(model_id, video_path)
+    if result is None:
+        # 命中缓存时不需要加载模型
+        ensure_predictor()
+        with emotion_model.use() as predictor:
+            result = predictor.predict(video_path, progress=progress)
+        if not result:
+            raise RuntimeError("情感预测失败")
+        result_cache.put(cache_key, model_id, result)
+    return {
+        "emotion": result['emotion'],
+        "confidence": result['confidence'],
+        "text": result['text'],
+        "probabilities": result['all_probabilities']
+    }
+
+# 后台任务状态数据库，多个工作进程提交和查询的是同一个队列
+JOBS_PATH = args.jobs_path or os.path.splitext(args.db_path)[0] + '.jobs.db'
+
+# 后台情感分析任务队列，工作线程在 start_worker 中启动，不在 fork 之前的主进程中处理任务
+emotion_jobs = EmotionJobQueue(
+    analyze_emotion,
+    workers=args.emotion_workers,
+    max_queue=args.emotion_queue_size,
+    timeout=args.emotion_job_timeout,
+    store_path=JOBS_PATH,
+    name="emotion",
+    start=False
+)
+
+def warm_features(video_path, progress=None):
+    """只提取并保存特征，不运行情感模型"""
+    ensure_predictor()
+    with emotion_model.use() as predictor:
+        predictor.extract_features(video_path, report=progress)
+    return {"path": video_path}
+
+# 后台特征预提取队列，为整个媒体库预热特征库
+feature_jobs = EmotionJobQueue(
+    warm_features,
+    workers=1,
+    max_queue=100000,
+    timeout=args.emotion_job_timeout,
+    store_path=JOBS_PATH,
+    name="features",
+    start=False
+)
+
 @app.route('/api/emotion', methods=['POST'])
 def predict_emotion():
     # 获取请求中的视频文件路径
@@ -90,38 +549,225 @@ def predict_emotion():
         return jsonify({"error": "缺少'path'参数"}), 400
     
     video_path = data['path']
-    
-    # 检查情感预测器是否已初始化
-    global emotion_predictor
-    if emotion_predictor is None:
+
+    # 分段时间线模式：按固定窗口逐段预测，返回每段概率及整体结果
+    if data.get('mode') == 'timeline':
         try:
-            print("情感预测模型尚未初始化，正在尝试初始化...")
-            success = initialize_predictor()
-            if not success:
-                return jsonify({"error": "情感预测模型初始化失败"}), 500
-        except Exception as e:
-            return jsonify({"error": f"情感预测模型初始化失败: {str(e)}"}), 500
+            window_seconds = float(data.get('window', 10))
+        except (TypeError, ValueError):
+            return jsonify({"error": "window 必须是数字"}), 400
+        return emotion_timeline(video_path, window_seconds, bool(data.get('stream', False)))
     
     try:
         # 调用情感预测函数分析视频
-        result = emotion_predictor.predict(video_path)
-        if result:
-            return jsonify({
-                "emotion": result['emotion'],
-                "confidence": result['confidence'],
-                "text": result['text'],
-                "probabilities": result['all_probabilities']
-            })
-        else:
-            return jsonify({"error": "情感预测失败"}), 500
+        with metrics.profiled(data.get('profile')) as profile:
+            result = analyze_emotion(video_path)
+        return jsonify(with_profile(result, profile))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def emotion_timeline(video_path, window_seconds, stream):
+    if not math.isfinite(window_seconds) or window_seconds <= 0:
+        return jsonify({"error": "window 必须大于0"}), 400
+    if window_seconds > MAX_TIMELINE_WINDOW:
+        return jsonify({"error": f"window 不能超过{MAX_TIMELINE_WINDOW}秒"}), 400
+    if stream:
+        try:
+            ensure_predictor()
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+        # 每完成一段输出一行JSON（NDJSON），最后一行为整体结果
+        def generate():
+            try:
+                with emotion_model.use() as predictor:
+                    for item in predictor.predict_timeline(video_path, window_seconds):
+                        yield json.dumps(item, ensure_ascii=False) + "\n"
+            except Exception as e:
+                yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    try:
+        model_id = f"emotion-timeline:{args.model_path}:{EMOTION_CLASSES}:{window_seconds}{TEXT_ENCODER_ID}"
+        cache_key, result = result_cache.get(model_id, video_path)
+        if result is None:
+            ensure_predictor()
+            with emotion_model.use() as predictor:
+                segments = list(predictor.predict_timeline(video_path, window_seconds))
+            result = {"segments": segments[:-1], "aggregate": segments[-1]["aggregate"]}
+            result_cache.put(cache_key, model_id, result)
+        return jsonify(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/emotion/jobs', methods=['POST'])
+def submit_emotion_job():
+    # 获取请求中的视频文件路径
+    data = request.get_json()
+    if not data or 'path' not in data:
+        return jsonify({"error": "缺少'path'参数"}), 400
+
+    try:
+        job, existing = emotion_jobs.submit(data['path'])
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+
+    return jsonify({"job_id": job.id, "status": job.status, "existing": existing}), 202
+
+@app.route('/api/emotion/jobs/<job_id>', methods=['GET'])
+def get_emotion_job(job_id):
+    job = emotion_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify(job)
+
+@app.route('/api/emotion/jobs/<job_id>/events', methods=['GET'])
+def stream_emotion_job(job_id):
+    if emotion_jobs.get(job_id) is None:
+        return jsonify({"error": "任务不存在"}), 404
+
+    # 以 server-sent events 推送任务状态，任务结束后关闭
+    def generate():
+        version = -1
+        while True:
+            job, new_version = emotion_jobs.wait_for_change(job_id, version)
+            if job is None:
+                break
+            if new_version != version:
+                version = new_version
+                yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+                if job['status'] in ('done', 'failed'):
+                    break
+            else:
+                # 保活注释行
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+@app.route('/api/emotion/features', methods=['POST'])
+def submit_feature_jobs():
+    # 获取请求中的视频文件路径列表
+    data = request.get_json()
+    if not data or not isinstance(data.get('paths'), list):
+        return jsonify({"error": "缺少'paths'参数"}), 400
+
+    job_ids = {}
+    for path in data['paths']:
+        try:
+            job, _ = feature_jobs.submit(path)
+        except QueueFullError as e:
+            return jsonify({"error": str(e), "job_ids": job_ids}), 503
+        job_ids[path] = job.id
+    return jsonify({"job_ids": job_ids}), 202
+
+@app.route('/api/emotion/features/<job_id>', methods=['GET'])
+def get_feature_job(job_id):
+    job = feature_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify(job)
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    # 包括情感预测器内部的 BERT、情感模型和 Vosk；被卸载的模型下次使用时重新加载
+    models = {
+        model.name: model.status()
+        for model in model_registry.models()
+    }
+    return jsonify({
+        "status": "ok",
+        "ready": all(model.ready for model in (emotion_model, music_tagger_model)),
+        "startup": args.startup,
+        "models": models,
+        "model_memory": model_registry.status(),
+        "import_seconds": import_times
+    })
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/api/db/stats', methods=['GET'])
+def db_stats():
+    return jsonify(music_db.stats())
+
+@app.route('/api/library/stats', methods=['GET'])
+def library_stats():
+    if library_watcher is None:
+        return jsonify({"enabled": False, "queue": tag_queue.stats(), "tagger": library_tagger.stats()})
+    return jsonify({"enabled": True, **library_watcher.stats(), "tagger": library_tagger.stats()})
+
+@app.route('/api/library/prioritize', methods=['POST'])
+def library_prioritize():
+    # 前端开始播放或打开歌曲时调用，让这些文件优先打标签
+    data = request.get_json()
+    if not data or not isinstance(data.get('paths'), list):
+        return jsonify({"error": "Missing 'paths' parameter"}), 400
+    return jsonify({"prioritized": prioritize_tracks(data['paths'])})
+
+@app.route('/api/emotion/jobs/stats', methods=['GET'])
+def emotion_job_stats():
+    return jsonify(emotion_jobs.stats())
+
+def preload_modules():
+    """
+    生产模式在 fork 之前导入重量级模块，工作进程以写时复制方式共享
+
+    多个工作进程且不是 lazy 模式时，还预先加载 BERT 与 Vosk，工作进程共享其权重；
+    TF 的运行时线程池不能跨 fork 使用，情感模型和 musicnn 仍在各工作进程中加载。
+    """
+    for name in ("music_tagger", "inference"):
+        try:
+            timed_import(name, lambda: importlib.import_module(name))
+        except Exception as e:
+            logger.warning("预先导入 %s 失败: %s", name, e)
+    if args.workers > 1 and args.startup != 'lazy':
+        try:
+            loaded = importlib.import_module("inference").preload_shared_models(
+                model_registry, args.bert_path, args.text_encoder, args.text_threads)
+            logger.info("fork 之前已加载 %s，工作进程共享其权重", ", ".join(loaded))
+        except Exception as e:
+            # 工作进程中构造情感预测器时会重新加载并报告错误
+            logger.warning("预先加载模型失败: %s", e)
+
+def start_worker(index):
+    """按 -startup 加载模型并启动后台线程，index 为工作进程序号"""
+    if args.startup == 'eager':
+        # 与旧行为一致：启动服务前加载模型
+        for model in (emotion_model, music_tagger_model):
+            try:
+                model.get()
+            except Exception:
+                pass
+    elif args.startup == 'background':
+        # 服务立即启动，模型在后台预热，就绪情况见 /api/health
+        emotion_model.start_background()
+        music_tagger_model.start_background()
+    # 按 -model_idle_timeout 卸载空闲模型
+    model_registry.start_reaper()
+    # 每个工作进程都从共享的任务队列中领取任务
+    emotion_jobs.start()
+    feature_jobs.start()
+
+    # 近邻预计算写共享数据库，多进程时只在第一个工作进程中运行
+    if args.neighbours_top_k > 0 and index == 0:
+        threading.Thread(target=precompute_neighbours_loop, name="neighbours", daemon=True).start()
+
+    # 曲库监视和后台打标签同样只在第一个工作进程中运行，其余进程只写队列
+    if index == 0:
+        threading.Thread(target=library_tagger.run, name="library-tagger", daemon=True).start()
+        if library_watcher is not None:
+            threading.Thread(target=library_watcher.run, name="library-watcher", daemon=True).start()
+
 if __name__ == '__main__':
-    # 确保在启动应用前模型已初始化
-    print("当前工作目录:", os.getcwd())
-    if emotion_predictor is None:
-        print("在启动服务前再次尝试初始化模型...")
-        initialize_predictor()
-    
-    app.run(host='0.0.0.0', port=22071, debug=True, use_reloader=False)
\ No newline at end of file
+    logger.info("当前工作目录: %s", os.getcwd())
+    if args.serve == 'dev':
+        if args.intra_op_threads > 0:
+            pin_threads(args.intra_op_threads)
+        start_worker(0)
+        app.run(host='0.0.0.0', port=22071, debug=True, use_reloader=False)
+    else:
+        workers = max(1, args.workers)
+        pin_threads(args.intra_op_threads or max(1, (os.cpu_count() or 1) // workers))
+        serve(app, '0.0.0.0', 22071, workers=workers, preload=preload_modules, on_worker_start=start_worker)
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+
+import numpy as np
+import cv2
+from moviepy.config import get_setting
+
+# Vosk 与 MFCC 共用的音频格式：16kHz、16bit、单声道
+SAMPLE_RATE = 16000
+
+# 相邻目标帧间隔超过该帧数时直接 seek，否则用 grab() 顺序跳过
+SEEK_THRESHOLD = 250
+
+# 流式解码单个窗口的最长时间（秒），窗口音频一次读入内存
+MAX_WINDOW_SECONDS = 600
+
+
+def decode_audio_pcm(media_path, sample_rate=SAMPLE_RATE):
+    """
+    用 ffmpeg 一次性解码音轨为内存中的 int16 单声道 PCM，不写临时文件
+
+    返回:
+    形状为 (采样数,) 的 np.int16 数组
+    """
+    proc = subprocess.run(_ffmpeg_pcm_command(media_path, sample_rate), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        message = proc.stderr.decode('utf-8', errors='ignore').strip()
+        if 'does not contain any stream' in message or 'matches no streams' in message:
+            raise Exception("视频中没有音频轨道")
+        raise Exception(f"音频解码失败: {message}")
+    if not proc.stdout:
+        raise Exception("视频中没有音频轨道")
+    return np.frombuffer(proc.stdout, dtype=np.int16)
+
+
+def _ffmpeg_pcm_command(media_path, sample_rate):
+    return [
+        get_setting("FFMPEG_BINARY"),
+        '-v', 'error',
+        '-i', media_path,
+        '-vn',
+        '-ac', '1',
+        '-ar', str(sample_rate),
+        '-f', 's16le',
+        '-'
+    ]
+
+
+def iter_pcm_chunks(pcm, chunk_samples):
+    """把 int16 PCM 数组按 chunk_samples 个采样切块，逐块产出字节"""
+    for start in range(0, len(pcm), chunk_samples):
+        yield pcm[start:start + chunk_samples].tobytes()
+
+
+class DecodedMedia:
+    """
+    一次解复用得到的媒体数据
+
+    pcm 为 16kHz 单声道 int16 音频，由 ASR 与 MFCC 共用；
+    capture 为已打开的 cv2.VideoCapture，视频分支直接从中读取帧。
+    """
+
+    def __init__(self, video_path, sample_rate=SAMPLE_RATE):
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(f"Video file not found: {video_path}")
+
+        self.video_path = video_path
+        self.sample_rate = sample_rate
+        self.capture = cv2.VideoCapture(video_path)
+        if not self.capture.isOpened():
+            raise IOError(f"Cannot open video file: {video_path}")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        try:
+            self.pcm = decode_audio_pcm(video_path, sample_rate)
+        except Exception:
+            self.release()
+            raise
+
+    @property
+    def duration(self):
+        return len(self.pcm) / self.sample_rate
+
+    def audio_float(self):
+        """返回归一化到 [-1, 1] 的 float32 音频，供 librosa 使用"""
+        return self.pcm.astype(np.float32) / 32768.0
+
+    def iter_pcm(self, chunk_samples):
+        """逐块产出 PCM 字节"""
+        return iter_pcm_chunks(self.pcm, chunk_samples)
+
+    def sample_frames(self, num_frames, size):
+        """
+        均匀采样 num_frames 帧并缩放到 size，内存占用与视频长度无关
+
+        帧数可信时预先计算目标帧号，只对目标帧做 retrieve()，其余帧用 grab() 跳过；
+        帧数不可用，或实际帧数少于容器报告的帧数时，退化为有界的抽稀缓冲区。
+
+        返回:
+        形状为 (num_frames, size[1], size[0], 3) 的 np.uint8 数组
+        """
+        if self.frame_count > 0:
+            frames = self._sample_by_index(num_frames, size)
+            if frames is not None:
+                return frames
+            # 可变帧率或 webm 等容器报告的帧数常多于实际帧数，目标帧读不到时
+            # 重新打开视频，在实际读到的帧上均匀采样，而不是用最后一帧补齐缺失的样本
+            self._reopen()
+        return self._sample_by_reservoir(num_frames, size)
+
+    def _reopen(self):
+        # 部分容器读到末尾后不支持 seek 回开头
+        self.capture.release()
+        self.capture = cv2.VideoCapture(self.video_path)
+        if not self.capture.isOpened():
+            raise IOError(f"Cannot open video file: {self.video_path}")
+
+    def _sample_by_index(self, num_frames, size):
+        """按容器报告的帧数采样，有目标帧读不到时返回 None"""
+        width, height = size
+        buffer = np.empty((num_frames, height, width, 3), dtype=np.uint8)
+        if self.frame_count >= num_frames:
+            targets = np.linspace(0, self.frame_count - 1, num_frames, dtype=int)
+        else:
+            # 帧数不足时取全部帧，其余位置用最后一帧补齐
+            targets = np.arange(self.frame_count)
+
+        filled = 0
+        position = 0
+        for target in targets:
+            if target - position > SEEK_THRESHOLD:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, int(target))
+                position = target
+            while position < target and self.capture.grab():
+                position += 1
+            if position < target or not self.capture.grab():
+                return None
+            position += 1
+            ret, frame = self.capture.retrieve()
+            if not ret:
+                return None
+            buffer[filled] = cv2.resize(frame, size)
+            filled += 1
+
+        # 视频总帧数少于 num_frames 时取全部帧，用最后一帧补齐
+        buffer[filled:] = buffer[filled - 1]
+        return buffer
+
+    def _sample_by_reservoir(self, num_frames, size):
+        width, height = size
+        # 缓冲区满时隔一帧丢弃一帧、步长加倍，保留的帧始终均匀分布
+        buffer = np.empty((num_frames * 2, height, width, 3), dtype=np.uint8)
+        kept = 0
+        stride = 1
+        index = 0
+        while self.capture.grab():
+            if index % stride == 0:
+                ret, frame = self.capture.retrieve()
+                if ret:
+                    buffer[kept] = cv2.resize(frame, size)
+                    kept += 1
+                    if kept == len(buffer):
+                        buffer[:num_frames] = buffer[0:len(buffer):2]
+                        kept = num_frames
+                        stride *= 2
+            index += 1
+
+        if kept == 0:
+            raise IOError(f"No frames could be read from video: {self.video_path}")
+        if kept < num_frames:
+            result = np.empty((num_frames, height, width, 3), dtype=np.uint8)
+            result[:kept] = buffer[:kept]
+            result[kept:] = buffer[kept - 1]
+            return result
+        return buffer[np.linspace(0, kept - 1, num_frames, dtype=int)]
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class MediaWindow:
+    """流式解码得到的一个时间窗口"""
+
+    def __init__(self, index, start, end, pcm, frames):
+        self.index = index
+        self.start = start
+        self.end = end
+        # 16kHz 单声道 int16 音频，音轨结束后以静音补齐
+        self.pcm = pcm
+        # (帧数, 高, 宽, 3) 的 uint8 采样帧
+        self.frames = frames
+
+
+class MediaStream:
+    """
+    按固定时间窗口流式解码媒体
+
+    音频通过 ffmpeg 管道逐窗口读取，视频帧按窗口内均匀分布的帧号用 grab()/retrieve() 采样，
+    内存占用只与窗口长度有关，第一个窗口无需等待整个文件解码完成。
+    """
+
+    def __init__(self, video_path, sample_rate=SAMPLE_RATE):
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(f"Video file not found: {video_path}")
+
+        self.video_path = video_path
+        self.sample_rate = sample_rate
+        self.capture = cv2.VideoCapture(video_path)
+        if not self.capture.isOpened():
+            raise IOError(f"Cannot open video file: {video_path}")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 25.0
+        self._position = 0
+        self._video_ended = False
+        self._last_frame = None
+        self._audio = subprocess.Popen(
+            _ffmpeg_pcm_command(video_path, sample_rate),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def _read_pcm(self, num_samples):
+        data = self._audio.stdout.read(num_samples * 2)
+        return np.frombuffer(data[:len(data) // 2 * 2], dtype=np.int16)
+
+    def _read_frames(self, first, last, num_frames, size):
+        """读取帧号 [first, last) 内均匀分布的 num_frames 帧，返回 (帧数组, 实际读取的帧数)"""
+        width, height = size
+        frames = np.zeros((num_frames, height, width, 3), dtype=np.uint8)
+        targets = np.linspace(first, max(first, last - 1), num_frames, dtype=int)
+        filled = 0
+        read = 0
+        while not self._video_ended and self._position < last:
+            if not self.capture.grab():
+                self._video_ended = True
+                break
+            read += 1
+            if filled < num_frames and targets[filled] == self._position:
+                ret, frame = self.capture.retrieve()
+                if ret:
+                    self._last_frame = cv2.resize(frame, size)
+                # 窗口内帧数不足时同一帧填入多个位置
+                while filled < num_frames and targets[filled] == self._position:
+                    if self._last_frame is not None:
+                        frames[filled] = self._last_frame
+                    filled += 1
+            self._position += 1
+        # 视频提前结束时用最后一帧补齐
+        if filled < num_frames and self._last_frame is not None:
+            frames[filled:] = self._last_frame
+        return frames, read
+
+    def iter_windows(self, window_seconds, num_frames, size):
+        """
+        逐个产出 MediaWindow
+
+        参数:
+        window_seconds -- 窗口长度（秒），不超过 MAX_WINDOW_SECONDS
+        num_frames -- 每个窗口采样的帧数
+        size -- 帧缩放尺寸 (宽, 高)
+        """
+        if not 0 < window_seconds <= MAX_WINDOW_SECONDS:
+            raise ValueError(f"窗口长度必须在 (0, {MAX_WINDOW_SECONDS}] 秒之间: {window_seconds}")
+        window_samples = int(window_seconds * self.sample_rate)
+        index = 0
+        while True:
+            pcm = self._read_pcm(window_samples)
+            first = int(round(index * window_seconds * self.fps))
+            last = int(round((index + 1) * window_seconds * self.fps))
+            frames, read = self._read_frames(first, last, num_frames, size)
+            if len(pcm) == 0 and read == 0:
+                break
+            duration = max(len(pcm) / self.sample_rate, read / self.fps)
+            if len(pcm) < window_samples:
+                pcm = np.concatenate([pcm, np.zeros(window_samples - len(pcm), dtype=np.int16)])
+            start = index * window_seconds
+            yield MediaWindow(index, start, start + duration, pcm, frames)
+            index += 1
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+        if self._audio is not None:
+            self._audio.kill()
+            self._audio.wait()
+            self._audio = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
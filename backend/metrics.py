@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 当前请求的分阶段耗时，仅在 profiled() 内有效
+_profile = contextvars.ContextVar("profile", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """按标签分组的单调递增计数器"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """按标签分组的累积直方图"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各桶计数, 总和, 总数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels + ("le",), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels + ("le",), label_values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """查询时由回调函数取值的指标，回调返回 {标签值元组: 数值}"""
+
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+_registry = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    """按 Prometheus 文本格式输出全部指标"""
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            # 回调出错时跳过该指标，不影响其余指标
+            continue
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = register(Histogram("soyo_stage_seconds", "各处理阶段耗时（秒）", labels=("stage",)))
+STAGE_ERRORS = register(Counter("soyo_stage_errors_total", "各处理阶段出错次数", labels=("stage",)))
+
+
+def observe_stage(stage, seconds):
+    """记录一个阶段的耗时，当前请求开启了分析时同时计入其分阶段耗时"""
+    STAGE_SECONDS.observe(seconds, stage)
+    profile = _profile.get()
+    if profile is not None:
+        profile[stage] = round(profile.get(stage, 0.0) + seconds, 4)
+
+
+@contextmanager
+def stage(name):
+    """统计代码块耗时的上下文管理器"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(name)
+        raise
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def profiled(enabled=True):
+    """
+    开启当前请求的分阶段耗时统计
+
+    用法:
+    with profiled(data.get('profile')) as profile:
+        ...
+    # profile 为 {阶段: 秒}，未开启时为 None
+
+    线程池中的阶段需用 contextvars.copy_context().run 提交才能计入。
+    """
+    if not enabled:
+        yield None
+        return
+    profile = {}
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+# 放入队列后让后台线程退出
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    动态微批处理器
+
+    并发提交的单个输入在后台线程中聚合，凑满 max_batch_size 个或等待 max_wait_ms 毫秒后
+    合并为一次 run_batch 调用，再把结果按顺序分发回各个提交者。
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5, name="batcher"):
+        """
+        参数:
+        run_batch -- 批处理函数，接收输入列表，返回等长的结果列表
+        max_batch_size -- 单批最大输入数
+        max_wait_ms -- 收到第一个输入后最多等待的毫秒数
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, name=name, daemon=True).start()
+
+    def close(self):
+        """处理完已提交的输入后停止后台线程"""
+        self._queue.put((_STOP, None))
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """提交单个输入并等待其结果"""
+        return self.submit(item).result()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0
+        }
+
+    def _collect(self):
+        """
+        返回:
+        (本批输入, 是否收到停止信号)
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size and batch[-1][0] is not _STOP:
+            remaining = deadline - time.monotonic()
+            try:
+                # 超时已到时仍取走已在队列中的输入
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1][0] is _STOP:
+            return batch[:-1], True
+        return batch, False
+
+    def _loop(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self._collect()
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.run_batch([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
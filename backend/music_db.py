@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import queue
+import pathlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# 具名查询，sqlite3 按 SQL 文本缓存预编译语句，重复执行时不再解析
+QUERIES = {
+    "labels_version": 'SELECT COALESCE(MAX(seq), 0) FROM music_labels_changes',
+    "labels_all": 'SELECT id, file_name, style_label FROM music_labels',
+    # 序号在 (上次同步, 本次同步] 之间的行；已删除的行 file_name 为 NULL
+    "labels_changed": '''
+        SELECT c.row_id, l.file_name, l.style_label FROM music_labels_changes c
+        LEFT JOIN music_labels l ON l.id = c.row_id
+        WHERE c.seq > ? AND c.seq <= ?
+    ''',
+    # 按序号分块取出变化的行，记下最后一行的序号即可从中断处继续
+    "labels_changed_chunk": '''
+        SELECT c.seq, c.row_id, l.style_label FROM music_labels_changes c
+        LEFT JOIN music_labels l ON l.id = c.row_id
+        WHERE c.seq > ? AND c.seq <= ?
+        ORDER BY c.seq
+        LIMIT ?
+    ''',
+    "label_paths": 'SELECT file_path FROM music_labels WHERE file_name = ?',
+    "track_id_by_name": 'SELECT MIN(id) FROM music_labels WHERE file_name = ? HAVING COUNT(*) > 0',
+    # 只遍历当前歌曲各标签的倒排列表，得分为 L2 归一化权重的点积（余弦相似度）
+    "tag_candidates": '''
+        SELECT m.file_name FROM music_tags s
+        JOIN music_tags t ON t.tag_id = s.tag_id AND t.track_id != s.track_id
+        JOIN music_labels m ON m.id = t.track_id
+        WHERE s.track_id = ?
+        GROUP BY t.track_id
+        ORDER BY SUM(s.weight * t.weight) DESC, t.track_id
+        LIMIT ?
+    ''',
+    "neighbours_meta": 'SELECT key, value FROM music_neighbours_meta',
+    "neighbours_of": '''
+        SELECT m.file_name FROM music_neighbours n
+        JOIN music_labels m ON m.id = n.neighbour_id
+        WHERE n.track_id = ?
+        ORDER BY n.rank
+        LIMIT ?
+    ''',
+    "embeddings_version": 'SELECT COALESCE(MAX(seq), 0) FROM music_embeddings_changes',
+    "embedding_names": 'SELECT id, file_name FROM music_embeddings',
+    "embeddings_all": 'SELECT id, file_name, vector FROM music_embeddings',
+    # 已删除的行 vector 为 NULL
+    "embeddings_changed": '''
+        SELECT c.row_id, e.file_name, e.vector FROM music_embeddings_changes c
+        LEFT JOIN music_embeddings e ON e.id = c.row_id
+        WHERE c.seq > ? AND c.seq <= ?
+    ''',
+}
+
+# 读连接预编译语句缓存的大小
+STATEMENT_CACHE_SIZE = 128
+# 连接池中只读连接的默认上限
+READER_POOL_SIZE = 8
+
+
+def read_only_uri(db_path):
+    """以只读方式打开数据库的 URI，路径中的 ?、#、%、空格和 Windows 盘符都经过转义"""
+    return pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+
+
+def ensure_change_log(conn, table, columns):
+    """
+    在写事务中为 table 建变更日志表 {table}_changes 及增删改触发器
+
+    日志每行保留一行数据最近一次变更的序号 seq，序号在整张日志表中单调递增；
+    读取方记下已同步的最大序号，之后只需比较 MAX(seq) 即可判断有无变化，再取出序号更大的行。
+    不依赖精度只有秒的 updated_at，同一秒内的多次更新、先删后插都能发现，
+    前端直接写入的变更同样会被记录。INSERT OR REPLACE 隐式删除的旧行只有在连接开启
+    recursive_triggers 时才会记录，写这些表时应使用 UPDATE 或 UPSERT。
+
+    参数:
+    table -- 带 INTEGER 主键 id 的表
+    columns -- 更新这些列时记录变更
+
+    返回:
+    table 是否存在（不存在时不建任何对象）
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if not exists:
+        return False
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table}_changes (
+            row_id INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_changes_seq ON {table}_changes(seq)')
+    next_seq = f'(SELECT COALESCE(MAX(seq), 0) + 1 FROM {table}_changes)'
+    for event, row in (("INSERT", "NEW"), (f"UPDATE OF {', '.join(columns)}", "NEW"), ("DELETE", "OLD")):
+        # 触发器内的冲突处理会被外层语句（INSERT OR IGNORE、UPSERT 等）的策略覆盖，
+        # 因此先更新已有的日志行、不存在时再插入，不依赖冲突处理
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_log_{event.split()[0].lower()} AFTER {event} ON {table}
+            BEGIN
+                UPDATE {table}_changes SET seq = {next_seq} WHERE row_id = {row}.id;
+                INSERT INTO {table}_changes (row_id, seq)
+                SELECT {row}.id, {next_seq}
+                WHERE NOT EXISTS (SELECT 1 FROM {table}_changes WHERE row_id = {row}.id);
+            END
+        ''')
+    return True
+
+
+class MusicDatabase:
+    """
+    后端访问曲库数据库的数据访问层
+
+    只读连接放在有上限的连接池中，由各请求线程借用后归还（WAL 模式下读不阻塞前端写入），
+    连接及其预编译语句缓存在请求之间复用；写入共用一个连接，按事务串行执行。
+    查询以名称引用 QUERIES 中的 SQL，并按名称统计执行次数与耗时。
+    """
+
+    def __init__(self, db_path, pool_size=READER_POOL_SIZE):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        # fork 前已建立的连接，子进程中不能使用，也不能关闭
+        self._inherited = []
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # SQLite 连接不能跨 fork 使用，生产模式的工作进程各自建立连接
+            os.register_at_fork(after_in_child=self._after_fork)
+        # WAL 模式写入数据库文件，对前端的连接同样生效；不能在事务中切换
+        with self._write_lock:
+            self._writer().execute('PRAGMA journal_mode=WAL')
+        self.ensure_indexes()
+
+    def _reset(self):
+        # 空闲的只读连接，后进先出，优先复用最近用过的连接
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._pool_lock = threading.Lock()
+        self._writer_conn = None
+        # 可重入：同一线程的嵌套写入共用当前事务
+        self._write_lock = threading.RLock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _after_fork(self):
+        # 保留引用，避免连接在子进程中被回收时关闭父进程仍在使用的数据库句柄
+        while True:
+            try:
+                self._inherited.append(self._readers.get_nowait())
+            except queue.Empty:
+                break
+        if self._writer_conn is not None:
+            self._inherited.append(self._writer_conn)
+        self._reset()
+
+    def ensure_indexes(self):
+        """
+        为点查询建索引，并为增量同步建 music_labels 的变更日志
+
+        返回:
+        music_labels 是否存在；该表由前端创建，尚不存在时跳过
+        """
+        with self.write("ensure_indexes") as conn:
+            exists = ensure_change_log(conn, "music_labels", ("file_name", "style_label"))
+            if exists:
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_music_labels_file_name ON music_labels(file_name)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_music_labels_updated_at ON music_labels(updated_at)')
+            return exists
+
+    def _connect_reader(self):
+        conn = sqlite3.connect(read_only_uri(self.db_path), uri=True, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute('PRAGMA query_only=ON')
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        """借出一个只读连接，池中没有空闲连接且未达上限时新建，否则等待其他线程归还"""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                create = self._reader_count < self.pool_size
+                if create:
+                    self._reader_count += 1
+            if create:
+                try:
+                    conn = self._connect_reader()
+                except Exception:
+                    with self._pool_lock:
+                        self._reader_count -= 1
+                    raise
+            else:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def _writer(self):
+        """写连接，调用方需持有 _write_lock"""
+        if self._writer_conn is None:
+            self._writer_conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        return self._writer_conn
+
+    def _record(self, name, elapsed):
+        with self._stats_lock:
+            entry = self._stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += elapsed * 1000
+            entry["max_ms"] = max(entry["max_ms"], elapsed * 1000)
+
+    def query(self, name, params=(), one=False):
+        """
+        执行具名只读查询
+
+        参数:
+        name -- QUERIES 中的查询名
+        params -- 查询参数
+        one -- 为 True 时只返回第一行
+
+        返回:
+        行列表，one 为 True 时返回单行或 None
+        """
+        start = time.perf_counter()
+        try:
+            with self._reader() as conn:
+                cursor = conn.execute(QUERIES[name], params)
+                return cursor.fetchone() if one else cursor.fetchall()
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    @contextmanager
+    def write(self, name, immediate=False):
+        """
+        写事务，正常退出时提交，异常时回滚；进程内的写事务逐个执行
+
+        参数:
+        name -- 统计用的名称
+        immediate -- 为 True 时以 BEGIN IMMEDIATE 开始事务，先读后写的事务在读取时就持有写锁，
+                     其他进程的写入不会插在读取与写入之间
+
+        用法:
+        with db.write("save_embedding") as conn:
+            conn.execute(...)
+        """
+        start = time.perf_counter()
+        with self._write_lock:
+            conn = self._writer()
+            try:
+                if immediate and not conn.in_transaction:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._record(name, time.perf_counter() - start)
+
+    def stats(self):
+        """各查询的执行次数、平均与最大耗时（毫秒）"""
+        with self._stats_lock:
+            return {
+                name: {
+                    "count": entry["count"],
+                    "avg_ms": round(entry["total_ms"] / entry["count"], 3),
+                    "max_ms": round(entry["max_ms"], 3)
+                }
+                for name, entry in self._stats.items()
+            }
@@ -1,78 +1,769 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import time
+import logging
 import sqlite3
+import threading
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+from ann_index import IVFIndex
+from music_db import MusicDatabase, QUERIES, ensure_change_log, read_only_uri
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_tags(style_label):
+    """
+    将数据库中的 style_label 字段解析为标签列表
+
+    前端保存为 JSON 数组字符串，旧数据为 ', ' 分隔的文本，两种格式都支持
+    """
+    if not style_label:
+        return []
+    if style_label.startswith('['):
+        try:
+            tags = json.loads(style_label)
+        except ValueError:
+            tags = None
+        if isinstance(tags, list):
+            return [str(tag) for tag in tags if tag]
+    return [tag for tag in style_label.split(', ') if tag]
+
+
+def _tag_matrix(tracks, num_tags):
+    """
+    由每行标签组装 L2 归一化的 CSR 矩阵
+
+    参数:
+    tracks -- {行 id: (file_name, 标签列索引数组)}
+    num_tags -- 标签数（矩阵列数）
+
+    返回:
+    (矩阵, 按行排列的行 id, 文件名, 文件名 -> 行号)
+    """
+    row_ids = sorted(tracks)
+    indptr = [0]
+    indices = []
+    data = []
+    file_names = []
+    name_to_row = {}
+    for row, row_id in enumerate(row_ids):
+        file_name, tag_ids = tracks[row_id]
+        indices.append(tag_ids)
+        # 二值向量的 L2 归一化
+        data.append(np.full(len(tag_ids), 1.0 / np.sqrt(len(tag_ids)), dtype=np.float32))
+        indptr.append(indptr[-1] + len(tag_ids))
+        file_names.append(file_name)
+        # 与旧实现 list.index 一致，同名文件取第一条
+        name_to_row.setdefault(file_name, row)
+
+    num_tags = max(num_tags, 1)
+    if row_ids:
+        matrix = sparse.csr_matrix(
+            (np.concatenate(data), np.concatenate(indices), np.asarray(indptr)),
+            shape=(len(row_ids), num_tags)
+        )
+    else:
+        matrix = sparse.csr_matrix((0, num_tags), dtype=np.float32)
+    return matrix, row_ids, file_names, name_to_row
+
+
+class MusicRecommenderIndex:
+    """
+    常驻内存的音乐标签索引
+
+    每首歌保存为 L2 归一化的稀疏标签向量，查询时只需一次稀疏矩阵-向量乘法
+    加 argpartition 取 top-k；按 music_labels 的变更日志只重新读取变化的行。
+    """
+
+    # 预计算的近邻列表过期时，重新读取其他进程写入的近邻状态的最短间隔（秒）
+    NEIGHBOURS_RECHECK_SECONDS = 5
+
+    def __init__(self, db_path, db=None):
+        self.db_path = db_path
+        self.db = db or MusicDatabase(db_path)
+        self._lock = threading.Lock()
+        # 行 id -> (file_name, 标签索引数组)
+        self._tracks = {}
+        # 标签 -> 列索引（只增不减，已删除标签的列保持为空）
+        self._tag_index = {}
+        # 已同步的变更日志序号，None 表示尚未加载
+        self._version = None
+        # 以下为由 _tracks 组装出的查询结构
+        self._row_ids = []
+        self._file_names = []
+        self._name_to_row = {}
+        self._matrix = None
+        self._dirty = True
+        # 预计算近邻列表对应的 (变更日志序号, top_k)
+        self._neighbours_state = None
+        self._neighbours_checked = None
+        with self.db.write("ensure_neighbour_tables") as conn:
+            ensure_neighbour_tables(conn)
+        self._load_neighbours_state()
+
+    def _tag_ids(self, tags):
+        ids = []
+        for tag in tags:
+            idx = self._tag_index.get(tag)
+            if idx is None:
+                idx = len(self._tag_index)
+                self._tag_index[tag] = idx
+            ids.append(idx)
+        return np.unique(np.asarray(ids, dtype=np.int32))
+
+    def _load_rows(self, rows):
+        for row_id, file_name, style_label in rows:
+            tags = _parse_tags(style_label)
+            # 已删除的行 file_name 为 NULL
+            if file_name is not None and tags:
+                self._tracks[row_id] = (file_name, self._tag_ids(tags))
+            else:
+                self._tracks.pop(row_id, None)
+        self._dirty = True
+
+    def refresh(self):
+        """
+        与数据库同步索引
+
+        首次同步读取全部行，之后只读取变更日志中序号大于上次同步的行（含删除）。
+        """
+        if self._version is None:
+            # 表可能在服务启动后才由前端创建，尚不存在时索引保持为空
+            if not self.db.ensure_indexes():
+                if self._dirty:
+                    self._rebuild_matrix()
+                return
+            # 先取序号再读全表，读取期间的变更下次同步时再应用一遍
+            self._version = self.db.query("labels_version", one=True)[0]
+            self._tracks = {}
+            self._tag_index = {}
+            self._load_rows(self.db.query("labels_all"))
+        else:
+            version = self.db.query("labels_version", one=True)[0]
+            if version != self._version:
+                self._load_rows(self.db.query("labels_changed", (self._version, version)))
+                self._version = version
+
+        if self._dirty:
+            self._rebuild_matrix()
+
+    def _rebuild_matrix(self):
+        """由缓存的每行标签组装 CSR 矩阵，不访问数据库"""
+        self._matrix, self._row_ids, self._file_names, self._name_to_row = _tag_matrix(
+            self._tracks, len(self._tag_index))
+        self._dirty = False
+
+    def recommend(self, current_file_name, top_n=3):
+        """
+        为当前播放的音乐推荐相似歌曲
+
+        已预计算且仍然有效的近邻列表直接从 music_neighbours 表读取。
+
+        参数:
+        current_file_name -- 当前播放的音乐文件名
+        top_n -- 推荐歌曲数量
+
+        返回:
+        推荐歌曲文件名列表
+        """
+        with self._lock:
+            self.refresh()
+            matrix = self._matrix
+            file_names = self._file_names
+            current_index = self._name_to_row.get(current_file_name)
+            track_id = self._row_ids[current_index] if current_index is not None else None
+            neighbours_fresh = self._neighbours_fresh(top_n)
+
+        # 如果数据不足或当前文件不在数据库中，返回空列表
+        if len(file_names) < 2 or current_index is None or top_n <= 0:
+            return []
+
+        if neighbours_fresh:
+            return self._lookup_neighbours(track_id, top_n)
+
+        return self._top_rows(matrix, file_names, matrix[current_index].T, top_n, [current_index])
+
+    @staticmethod
+    def _top_rows(matrix, file_names, query, top_n, exclude):
+        # 向量已归一化，点积即余弦相似度
+        scores = (matrix @ query).toarray().ravel()
+        scores[exclude] = -np.inf
+
+        k = min(top_n, len(file_names) - len(exclude))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [file_names[idx] for idx in top]
+
+    def recommend_many(self, file_names, top_n=3, blend=False):
+        """
+        批量推荐
+
+        参数:
+        file_names -- 种子歌曲文件名列表
+        top_n -- 每首种子歌曲（或混合结果）的推荐数量
+        blend -- 为 True 时把全部种子的向量相加，为整个歌单返回一份混合推荐
+
+        返回:
+        blend 为 False 时返回 {文件名: 推荐列表}，否则返回混合推荐列表（不含种子歌曲）
+        """
+        if not blend:
+            return {name: self.recommend(name, top_n) for name in file_names}
+
+        with self._lock:
+            self.refresh()
+            matrix = self._matrix
+            names = self._file_names
+            seeds = sorted({self._name_to_row[name] for name in file_names if name in self._name_to_row})
+
+        if not seeds or top_n <= 0:
+            return []
+        query = sparse.csr_matrix(matrix[seeds].sum(axis=0)).T
+        return self._top_rows(matrix, names, query, top_n, seeds)
+
+    def _neighbours_fresh(self, top_n):
+        """
+        预计算的近邻列表与当前数据一致且数量足够
+
+        不一致时每隔 NEIGHBOURS_RECHECK_SECONDS 秒重新读取一次 music_neighbours_meta，
+        多进程时近邻由第一个工作进程预计算，其余进程从这里得知列表已更新
+        """
+        state = self._neighbours_state
+        if state is None or state[0] != self._version:
+            now = time.monotonic()
+            if self._neighbours_checked is None or now - self._neighbours_checked >= self.NEIGHBOURS_RECHECK_SECONDS:
+                self._neighbours_checked = now
+                self._load_neighbours_state()
+                state = self._neighbours_state
+        return state is not None and top_n <= state[1] and state[0] == self._version
+
+    def _lookup_neighbours(self, track_id, top_n):
+        return [row[0] for row in self.db.query("neighbours_of", (track_id, top_n))]
+
+    def _load_neighbours_state(self):
+        # 旧版本按 (行数, updated_at) 记录的近邻列表没有 version，视为过期
+        meta = dict(self.db.query("neighbours_meta"))
+        if 'version' in meta:
+            self._neighbours_state = (int(meta['version']), int(meta['top_k']))
+        else:
+            self._neighbours_state = None
+
+    def precompute_neighbours(self, top_k=20, block_elements=32 * 1024 * 1024):
+        """
+        为每首歌预计算 top_k 个近邻并写入 music_neighbours 表
+
+        按行分块计算相似度，每块最多 block_elements 个元素，不会构造完整的 N×N 矩阵。
+
+        返回:
+        处理的歌曲数；数据自上次预计算后未变化时返回 0
+        """
+        with self._lock:
+            self.refresh()
+            if self._version is None or self._neighbours_fresh(top_k):
+                return 0
+            matrix = self._matrix
+            row_ids = np.asarray(self._row_ids, dtype=np.int64)
+            state = (self._version, top_k)
+
+        num_rows = matrix.shape[0]
+        k = min(top_k, num_rows - 1)
+        block_size = max(1, block_elements // max(num_rows, 1))
+        matrix_t = matrix.T.tocsc()
+
+        # 相似度在事务外计算，每块的结果以一个短事务写入暂存表，写锁不会在整个预计算期间被占用，
+        # 前端和本进程的其他写入只需等待一块写完；全部写完后再用一个短事务替换正式表
+        with self.db.write("save_neighbours") as conn:
+            conn.execute('DROP TABLE IF EXISTS music_neighbours_new')
+            ensure_neighbour_tables(conn, "music_neighbours_new")
+        if k > 0:
+            for start in range(0, num_rows, block_size):
+                end = min(start + block_size, num_rows)
+                scores = (matrix[start:end] @ matrix_t).toarray()
+                scores[np.arange(end - start), np.arange(start, end)] = -np.inf
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                top_scores = np.take_along_axis(scores, top, axis=1)
+                order = np.argsort(-top_scores, axis=1, kind='stable')
+                top = np.take_along_axis(top, order, axis=1)
+                top_scores = np.take_along_axis(top_scores, order, axis=1)
+                rows = [
+                    (int(row_ids[start + i]), rank, int(row_ids[top[i, rank]]), float(top_scores[i, rank]))
+                    for i in range(end - start) for rank in range(k)
+                ]
+                with self.db.write("save_neighbours") as conn:
+                    conn.executemany(
+                        'INSERT INTO music_neighbours_new (track_id, rank, neighbour_id, score) VALUES (?, ?, ?, ?)',
+                        rows
+                    )
+
+        # 显式开始事务：DDL 不会自动开始事务，删表和改名需要与元数据一起原子地提交
+        with self.db.write("swap_neighbours", immediate=True) as conn:
+            conn.execute('DROP TABLE IF EXISTS music_neighbours')
+            conn.execute('ALTER TABLE music_neighbours_new RENAME TO music_neighbours')
+            conn.execute('DELETE FROM music_neighbours_meta')
+            conn.executemany(
+                'INSERT INTO music_neighbours_meta (key, value) VALUES (?, ?)',
+                [('version', str(state[0])), ('top_k', str(state[1]))]
+            )
+
+        with self._lock:
+            self._neighbours_state = state
+        return num_rows
+
+
+def ensure_neighbour_tables(conn, table="music_neighbours"):
+    """在写事务中创建预计算近邻表，table 为近邻列表表名（预计算时先写入暂存表）"""
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            track_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            neighbour_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (track_id, rank)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS music_neighbours_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def ensure_tag_tables(conn):
+    """
+    在写事务中创建规范化的标签表
+
+    music_tags 按 music_labels 的变更日志（见 music_db.ensure_change_log）增量维护，
+    music_tags_meta 记录已同步到的变更序号；同时清理旧版本在 music_labels 上建的触发器和 music_tags_dirty 表。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS music_tag_names (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS music_tags (
+            track_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            PRIMARY KEY (track_id, tag_id)
+        ) WITHOUT ROWID
+    ''')
+    # 倒排索引：按标签取出全部歌曲及权重，无需回表
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_music_tags_tag ON music_tags(tag_id, track_id, weight)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS music_tags_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    for event in ("insert", "update", "delete"):
+        conn.execute(f'DROP TRIGGER IF EXISTS music_labels_tags_{event}')
+    conn.execute('DROP TABLE IF EXISTS music_tags_dirty')
+
+
+class MusicTagIndex:
+    """
+    基于规范化标签表的 SQL 倒排索引推荐
+
+    music_tags 保存每首歌的标签编号及 L2 归一化权重（1/sqrt(标签数)），查询时只取出与当前歌曲
+    至少有一个共同标签的候选歌曲，在 SQLite 中按权重点积（即余弦相似度）排序取 top-N，
+    不需要把整个曲库读入内存；但开销随候选数增长，常见标签的倒排列表很长时比常驻内存的矩阵慢。
+    """
+
+    # 每个事务最多重新解析的行数
+    SYNC_CHUNK = 5000
+
+    def __init__(self, db_path, db=None):
+        self.db_path = db_path
+        self.db = db or MusicDatabase(db_path)
+        self._lock = threading.Lock()
+        # 标签名 -> 编号
+        self._tag_ids = {}
+        self._ready = False
+        # 本进程已确认同步到的变更日志序号
+        self._version = None
+
+    def _ensure_tables(self):
+        if not self.db.ensure_indexes():
+            return
+        with self.db.write("ensure_tag_tables") as conn:
+            ensure_tag_tables(conn)
+            self._tag_ids = dict(conn.execute('SELECT name, id FROM music_tag_names'))
+        self._ready = True
+
+    def _tag_id(self, conn, name):
+        tag_id = self._tag_ids.get(name)
+        if tag_id is None:
+            conn.execute('INSERT OR IGNORE INTO music_tag_names (name) VALUES (?)', (name,))
+            tag_id = conn.execute('SELECT id FROM music_tag_names WHERE name = ?', (name,)).fetchone()[0]
+            self._tag_ids[name] = tag_id
+        return tag_id
+
+    def _write_tags(self, conn, labels):
+        """labels 为 (track_id, style_label) 列表，style_label 为 None 时只删除该歌曲的标签"""
+        rows = []
+        for track_id, style_label in labels:
+            tags = set(_parse_tags(style_label))
+            weight = 1.0 / np.sqrt(len(tags)) if tags else 0.0
+            rows.extend((track_id, self._tag_id(conn, tag), weight) for tag in tags)
+        conn.executemany('DELETE FROM music_tags WHERE track_id = ?', [(track_id,) for track_id, _ in labels])
+        conn.executemany('INSERT INTO music_tags (track_id, tag_id, weight) VALUES (?, ?, ?)', rows)
+
+    def _sync_chunk(self, version):
+        """
+        在一个写事务中处理至多 SYNC_CHUNK 行
+
+        多个进程共用 music_tags，以 BEGIN IMMEDIATE 开始事务，读取同步位置和写入标签之间不会被其他进程插入；
+        每个事务都很短，前端写 music_labels 时最多等待一块处理完。
+
+        返回:
+        处理的行数，已同步到 version 时为 None
+        """
+        with self.db.write("sync_tags", immediate=True) as conn:
+            meta = dict(conn.execute('SELECT key, value FROM music_tags_meta'))
+            if 'version' not in meta:
+                # 首次同步（或由旧版本升级）：变更日志只含建日志之后的变化，先记下当前序号，
+                # 再按 id 分块全量解析；解析期间的变化序号更大，之后由增量同步处理
+                conn.execute('DELETE FROM music_tags')
+                conn.executemany('INSERT INTO music_tags_meta (key, value) VALUES (?, ?)', [
+                    ('version', str(conn.execute(QUERIES["labels_version"]).fetchone()[0])),
+                    ('build_after', '0')
+                ])
+                return 0
+            if 'build_after' in meta:
+                labels = conn.execute(
+                    'SELECT id, style_label FROM music_labels WHERE id > ? ORDER BY id LIMIT ?',
+                    (int(meta['build_after']), self.SYNC_CHUNK)
+                ).fetchall()
+                if labels:
+                    self._write_tags(conn, labels)
+                    conn.execute("UPDATE music_tags_meta SET value = ? WHERE key = 'build_after'", (str(labels[-1][0]),))
+                else:
+                    conn.execute("DELETE FROM music_tags_meta WHERE key = 'build_after'")
+                return len(labels)
+            changes = conn.execute(
+                QUERIES["labels_changed_chunk"], (int(meta['version']), version, self.SYNC_CHUNK)).fetchall()
+            if not changes:
+                return None
+            self._write_tags(conn, [(track_id, style_label) for _, track_id, style_label in changes])
+            conn.execute("UPDATE music_tags_meta SET value = ? WHERE key = 'version'", (str(changes[-1][0]),))
+            return len(changes)
+
+    def sync(self):
+        """
+        重新解析 music_labels 变更日志中新增的行
+
+        返回:
+        处理的行数
+        """
+        with self._lock:
+            if not self._ready:
+                # music_labels 可能在服务启动后才由前端创建
+                self._ensure_tables()
+                if not self._ready:
+                    return 0
+            version = self.db.query("labels_version", one=True)[0]
+            if version == self._version:
+                return 0
+            total = 0
+            while True:
+                count = self._sync_chunk(version)
+                if count is None:
+                    break
+                total += count
+            self._version = version
+            if total:
+                logger.debug("重新解析了 %d 首歌的标签", total)
+            return total
+
+    def recommend(self, current_file_name, top_n=3):
+        """
+        为当前播放的音乐推荐有共同标签的歌曲
+
+        参数:
+        current_file_name -- 当前播放的音乐文件名（同名文件取第一条）
+        top_n -- 推荐歌曲数量
+
+        返回:
+        推荐歌曲文件名列表，按相似度从高到低排列；有共同标签的歌曲不足 top_n 首时返回的更少
+        """
+        if top_n <= 0:
+            return []
+        self.sync()
+        if not self._ready:
+            return []
+        seed = self.db.query("track_id_by_name", (current_file_name,), one=True)
+        if seed is None:
+            return []
+        return [row[0] for row in self.db.query("tag_candidates", (seed[0], top_n))]
+
+
+def ensure_embedding_table(db):
+    """创建保存 musicnn 标签概率向量的表"""
+    with db.write("ensure_embedding_table") as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS music_embeddings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_path TEXT NOT NULL UNIQUE,
+                file_name TEXT NOT NULL,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_music_embeddings_updated ON music_embeddings(updated_at)')
+        ensure_change_log(conn, "music_embeddings", ("file_name", "vector"))
+
+
+class MusicEmbeddingIndex:
+    """
+    基于 musicnn 标签概率向量的近似最近邻推荐索引
+
+    向量以 float32 BLOB 存放在 music_embeddings 表中，内存中维护 IVFIndex；
+    按变更日志增量插入、替换或删除向量，没有变化时每次查询只比较一次日志序号，
+    索引定期持久化到数据库旁的 .npz 文件，重启后无需重新聚类。
+    """
+
+    # 距离上次保存累计插入这么多向量后再次保存
+    SAVE_INTERVAL = 1000
+
+    def __init__(self, db_path, index_path=None, nprobe=8, db=None):
+        self.db_path = db_path
+        self.db = db or MusicDatabase(db_path)
+        self.index_path = index_path or os.path.splitext(db_path)[0] + '.ann.npz'
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._index = None
+        # 表行 id <-> 索引编号
+        self._slot_by_row = {}
+        self._row_by_slot = {}
+        self._file_names = {}
+        # 文件名 -> 行 id 集合，同名文件取 id 最小的一行
+        self._rows_by_name = {}
+        self._name_to_row = {}
+        # 已同步的变更日志序号，None 表示尚未加载
+        self._version = None
+        self._unsaved = 0
+        ensure_embedding_table(self.db)
+
+    def add_embedding(self, file_path, vector, model, replace=True):
+        """
+        写入一首歌的向量，下一次查询时增量并入索引
+
+        replace 为 False 时已有向量的歌曲保持不变
+        """
+        self.add_embeddings([(file_path, vector)], model, replace)
+
+    def add_embeddings(self, items, model, replace=True):
+        """在一个事务中写入多首歌的向量，items 为 [(文件路径, 向量)]"""
+        conflict = '''DO UPDATE SET
+                    file_name = excluded.file_name,
+                    model = excluded.model,
+                    vector = excluded.vector,
+                    updated_at = CURRENT_TIMESTAMP''' if replace else 'DO NOTHING'
+        with self.db.write("save_embedding") as conn:
+            conn.executemany(f'''
+                INSERT INTO music_embeddings (file_path, file_name, model, vector)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(file_path) {conflict}
+            ''', [
+                (file_path, os.path.basename(file_path), model, np.asarray(vector, dtype=np.float32).tobytes())
+                for file_path, vector in items
+            ])
+
+    def remove_embeddings(self, file_paths):
+        """删除歌曲的向量，下一次查询时从索引中移除"""
+        with self.db.write("remove_embeddings") as conn:
+            conn.executemany('DELETE FROM music_embeddings WHERE file_path = ?', [(path,) for path in file_paths])
+
+    def _load_saved(self):
+        """加载持久化的索引及其保存时的同步位置，成功时返回 True"""
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            index, arrays = IVFIndex.load(self.index_path, nprobe=self.nprobe)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("加载推荐索引失败，将重新构建: %s", e)
+            return False
+        if "version" not in arrays:
+            # 旧版本按 (行数, updated_at) 记录同步位置，无法据此增量同步
+            return False
+        row_ids = arrays["row_ids"].tolist()
+        self._index = index
+        self._slot_by_row = {row_id: slot for slot, row_id in enumerate(row_ids) if row_id >= 0}
+        self._row_by_slot = {slot: row_id for row_id, slot in self._slot_by_row.items()}
+        self._version = int(arrays["version"])
+        return True
+
+    def _set_name(self, row_id, file_name):
+        """更新行的文件名映射，file_name 为 None 时移除该行"""
+        old_name = self._file_names.pop(row_id, None)
+        if old_name is not None:
+            rows = self._rows_by_name[old_name]
+            rows.discard(row_id)
+            if rows:
+                self._name_to_row[old_name] = min(rows)
+            else:
+                del self._rows_by_name[old_name]
+                del self._name_to_row[old_name]
+        if file_name is not None:
+            rows = self._rows_by_name.setdefault(file_name, set())
+            rows.add(row_id)
+            self._name_to_row[file_name] = min(rows)
+            self._file_names[row_id] = file_name
+
+    def _insert_rows(self, rows):
+        """插入或替换行的向量，blob 为 None（行已删除）时从索引中移除"""
+        vectors = []
+        row_ids = []
+        for row_id, file_name, blob in rows:
+            old_slot = self._slot_by_row.pop(row_id, None)
+            if old_slot is not None:
+                self._index.remove([old_slot])
+                self._row_by_slot.pop(old_slot, None)
+                self._set_name(row_id, None)
+            if blob is None:
+                continue
+            vector = np.frombuffer(blob, dtype=np.float32)
+            if self._index is None:
+                self._index = IVFIndex(len(vector), nprobe=self.nprobe)
+            if len(vector) != self._index.dim:
+                continue
+            vectors.append(vector)
+            row_ids.append(row_id)
+            self._set_name(row_id, file_name)
+        if vectors:
+            for row_id, slot in zip(row_ids, self._index.add(np.stack(vectors)).tolist()):
+                self._slot_by_row[row_id] = slot
+                self._row_by_slot[slot] = row_id
+            self._unsaved += len(vectors)
+
+    def refresh(self):
+        """
+        与 music_embeddings 表同步
+
+        首次同步加载持久化的索引（没有时读取全表），之后只应用变更日志中序号大于上次同步的行；
+        没有变化时只执行一次按索引取 MAX(seq) 的查询。
+        """
+        version = self.db.query("embeddings_version", one=True)[0]
+        if version == self._version:
+            return
+
+        if self._version is None:
+            # 保存的序号比数据库新时（如数据库被重建）不可用
+            if self._load_saved() and self._version <= version:
+                # 持久化索引只保存了向量，文件名每次启动从表中读取；此后删除的行由变更日志移除
+                names = dict(self.db.query("embedding_names"))
+                for row_id in self._slot_by_row:
+                    self._set_name(row_id, names.get(row_id))
+            else:
+                # 先取序号再读全表，读取期间的变更随后再应用一遍
+                self._index = None
+                self._slot_by_row = {}
+                self._row_by_slot = {}
+                self._file_names = {}
+                self._rows_by_name = {}
+                self._name_to_row = {}
+                self._insert_rows(self.db.query("embeddings_all"))
+                self._version = version
+
+        if version != self._version:
+            self._insert_rows(self.db.query("embeddings_changed", (self._version, version)))
+            self._version = version
+
+        if self._unsaved >= self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """把索引持久化到 index_path"""
+        if self._index is None:
+            return
+        row_ids = np.full(self._index._size, -1, dtype=np.int64)
+        for slot, row_id in self._row_by_slot.items():
+            row_ids[slot] = row_id
+        temp_path = self.index_path + '.tmp.npz'
+        self._index.save(
+            temp_path,
+            row_ids=row_ids,
+            version=np.asarray(self._version or 0)
+        )
+        os.replace(temp_path, self.index_path)
+        self._unsaved = 0
+
+    def recommend(self, current_file_name, top_n=3):
+        """
+        为当前播放的音乐推荐相似歌曲
+
+        返回:
+        推荐歌曲文件名列表；当前歌曲没有向量时返回 None，由调用方回退到标签推荐
+        """
+        if top_n <= 0:
+            return []
+        with self._lock:
+            self.refresh()
+            row_id = self._name_to_row.get(current_file_name)
+            if row_id is None or self._index is None:
+                return None
+            slot = self._slot_by_row[row_id]
+            slots, _ = self._index.search(self._index.vector(slot), top_n, exclude=slot)
+            return [self._file_names[self._row_by_slot[s]] for s in slots.tolist()]
+
+    def recommend_blend(self, file_names, top_n=3):
+        """
+        以多首歌曲向量的均值为查询，为整个歌单返回一份混合推荐
+
+        返回:
+        推荐歌曲文件名列表（不含种子歌曲）；所有种子歌曲都没有向量时返回 None
+        """
+        if top_n <= 0:
+            return []
+        with self._lock:
+            self.refresh()
+            if self._index is None:
+                return None
+            slots = [self._slot_by_row[self._name_to_row[name]] for name in file_names if name in self._name_to_row]
+            if not slots:
+                return None
+            query = np.mean([self._index.vector(slot) for slot in slots], axis=0)
+            found, _ = self._index.search(query, top_n, exclude=np.asarray(slots))
+            return [self._file_names[self._row_by_slot[s]] for s in found.tolist()]
+
 
 def get_music_recommendations(db_path, current_file_name, top_n=3):
     """
     基于余弦相似度为当前播放的音乐推荐相似歌曲
-    
+
+    一次性读取 music_labels 建矩阵，以只读方式打开数据库，不建表、索引或触发器；
+    常驻服务请使用 MusicRecommenderIndex。
+
     参数:
     current_file_name -- 当前播放的音乐文件名
     top_n -- 推荐歌曲数量
-    
+
     返回:
     推荐歌曲文件名列表
     """
-    # 连接到SQLite数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # 获取所有带有标签的音乐文件
-    cursor.execute('SELECT file_name, style_label FROM music_labels WHERE style_label IS NOT NULL')
-    music_data = cursor.fetchall()
-    
-    # 如果数据不足，直接返回空列表
-    if len(music_data) < 2:
-        conn.close()
-        return []
-    
-    file_names = [item[0] for item in music_data]
-    
-    # 如果当前文件不在数据库中，返回空列表
-    if current_file_name not in file_names:
+    conn = sqlite3.connect(read_only_uri(db_path), uri=True)
+    try:
+        rows = conn.execute(QUERIES["labels_all"]).fetchall()
+    finally:
         conn.close()
+
+    tag_index = {}
+    tracks = {}
+    for row_id, file_name, style_label in rows:
+        tags = _parse_tags(style_label)
+        if tags:
+            tag_ids = [tag_index.setdefault(tag, len(tag_index)) for tag in tags]
+            tracks[row_id] = (file_name, np.unique(np.asarray(tag_ids, dtype=np.int32)))
+    matrix, _, file_names, name_to_row = _tag_matrix(tracks, len(tag_index))
+
+    current_index = name_to_row.get(current_file_name)
+    if len(file_names) < 2 or current_index is None or top_n <= 0:
         return []
-    
-    # 获取所有不同的标签
-    all_tags = []
-    for _, tags in music_data:
-        if tags:  # 确保标签不为空
-            tag_list = tags.split(', ')
-            all_tags.extend(tag_list)
-    
-    # 去重
-    all_tags = list(set(all_tags))
-    
-    # 创建标签到索引的映射
-    tag_index = {tag: idx for idx, tag in enumerate(all_tags)}
-    
-    # 创建音乐的标签向量
-    music_vectors = np.zeros((len(music_data), len(all_tags)))
-    for i, (_, tags) in enumerate(music_data):
-        if tags:  # 确保标签不为空
-            tag_list = tags.split(', ')
-            for tag in tag_list:
-                music_vectors[i, tag_index[tag]] = 1
-    
-    # 计算余弦相似度
-    similarity_matrix = cosine_similarity(music_vectors)
-    
-    # 获取当前文件在列表中的索引
-    current_index = file_names.index(current_file_name)
-    
-    # 获取相似度分数
-    similarity_scores = similarity_matrix[current_index]
-    
-    # 按相似度排序，排除当前播放的歌曲
-    similar_indices = np.argsort(similarity_scores)[::-1]
-    recommended_files = []
-    
-    for idx in similar_indices:
-        if idx != current_index:  # 排除当前歌曲
-            recommended_files.append(file_names[idx])
-        if len(recommended_files) >= top_n:
-            break
-    
-    conn.close()
-    return recommended_files 
\ No newline at end of file
+    return MusicRecommenderIndex._top_rows(matrix, file_names, matrix[current_index].T, top_n, [current_index])
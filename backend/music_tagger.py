@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import librosa
+import soundfile
+import tensorflow as tf
+import musicnn
+from musicnn import configuration as config
+from musicnn import models
+from musicnn.extractor import batch_data
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 快速模式选取分析窗口的方式
+SEGMENT_STRATEGIES = ("even", "energy")
+
+
+class MusicTagger:
+    """
+    常驻内存的 musicnn 标签器
+
+    与 musicnn.tagger.top_tags 结果一致，但 TF 图和权重只在构造时加载一次；
+    批量打标签时音频解码在线程池中进行，多个文件的 patch 堆叠成批送入网络。
+    """
+
+    def __init__(self, model='MSD_musicnn_big', input_length=3, batch_size=64, decode_workers=4):
+        self.model_name = model
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.labels = config.MTT_LABELS if 'MTT' in model else config.MSD_LABELS
+        self.input_length = input_length
+
+        # 秒数转换为帧数，与 musicnn.extractor 保持一致（不重叠）
+        self.n_frames = librosa.time_to_frames(
+            input_length, sr=config.SR, n_fft=config.FFT_SIZE, hop_length=config.FFT_HOP) + 1
+        self.overlap = self.n_frames
+
+        logger.info("Loading musicnn model: %s", model)
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            with tf.compat.v1.name_scope('model'):
+                self._x = tf.compat.v1.placeholder(tf.float32, [None, self.n_frames, config.N_MELS])
+                self._is_training = tf.compat.v1.placeholder(tf.bool)
+                outputs = models.define_model(self._x, self._is_training, model, len(self.labels))
+                self._y = tf.nn.sigmoid(outputs[0])
+            # 沿用进程级的线程数设置（见 serving.pin_threads），0 表示由 TF 自行决定
+            session_config = tf.compat.v1.ConfigProto(
+                intra_op_parallelism_threads=tf.config.threading.get_intra_op_parallelism_threads(),
+                inter_op_parallelism_threads=tf.config.threading.get_inter_op_parallelism_threads()
+            )
+            self._sess = tf.compat.v1.Session(graph=self._graph, config=session_config)
+            self._sess.run(tf.compat.v1.global_variables_initializer())
+            saver = tf.compat.v1.train.Saver()
+            saver.restore(self._sess, os.path.join(os.path.dirname(musicnn.__file__), model) + '/')
+        # 同一个 Session 的并发 run 串行化，避免多个请求争抢线程
+        self._run_lock = threading.Lock()
+        logger.info("musicnn model loaded")
+
+    def close(self):
+        self._sess.close()
+
+    def decode(self, file_path):
+        """解码音频并切分为 (patch数, n_frames, N_MELS) 的 patch 数组"""
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件不存在: {file_path}")
+        try:
+            with metrics.stage("tag_decode"):
+                batch, _ = batch_data(file_path, self.n_frames, self.overlap)
+        except UnboundLocalError:
+            # 音频短于一个 patch 时 batch_data 不会生成任何 patch
+            batch = None
+        if batch is None or len(batch) == 0:
+            raise ValueError(f"音频过短，无法提取标签: {file_path}")
+        return batch
+
+    def decode_segments(self, file_path, segments=8, strategy="even"):
+        """
+        只解码若干个 input_length 长的窗口，切分为与 decode 相同格式的 patch 数组
+
+        参数:
+        segments -- 分析的窗口数
+        strategy -- "even" 在全曲均匀取窗口；"energy" 均匀解码两倍数量的候选窗口，保留能量最高的一半
+
+        返回:
+        (窗口数, n_frames, N_MELS) 的 patch 数组；无法读取时长或曲子不够长（采样省不了多少）时返回 None
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件不存在: {file_path}")
+        if strategy not in SEGMENT_STRATEGIES:
+            raise ValueError(f"未知的采样方式: {strategy}")
+        try:
+            duration = soundfile.info(file_path).duration
+        except RuntimeError:
+            # libsndfile 不支持的格式，由调用方改为整曲解码
+            return None
+        window = self.input_length
+        if duration < window * segments * 2:
+            return None
+
+        candidates = segments * 2 if strategy == "energy" else segments
+        # 窗口起点在全曲范围内均匀分布，不紧贴曲首和曲尾
+        offsets = (np.arange(candidates) + 0.5) * (duration - window) / candidates
+        with metrics.stage("tag_decode"):
+            clips = []
+            for offset in offsets:
+                audio, _ = librosa.load(file_path, sr=config.SR, offset=float(offset), duration=window)
+                if len(audio) >= window * config.SR * 0.9:
+                    clips.append(audio)
+            if not clips:
+                return None
+            if strategy == "energy":
+                energy = [float(np.mean(audio ** 2)) for audio in clips]
+                keep = sorted(np.argsort(energy)[-segments:])
+                clips = [clips[i] for i in keep]
+            patches = [self._patch(audio) for audio in clips]
+        return np.stack(patches)
+
+    def _patch(self, audio):
+        """与 musicnn.extractor.batch_data 相同的对数 mel 谱，截取或补齐为一个 patch"""
+        audio_rep = librosa.feature.melspectrogram(
+            y=audio, sr=config.SR, hop_length=config.FFT_HOP, n_fft=config.FFT_SIZE, n_mels=config.N_MELS).T
+        audio_rep = np.log10(10000 * audio_rep.astype(np.float16) + 1)
+        if audio_rep.shape[0] < self.n_frames:
+            audio_rep = np.pad(audio_rep, ((0, self.n_frames - audio_rep.shape[0]), (0, 0)))
+        return audio_rep[:self.n_frames]
+
+    def taggram(self, patches):
+        """按 batch_size 分批运行网络，返回每个 patch 的标签概率"""
+        outputs = []
+        for start in range(0, patches.shape[0], self.batch_size):
+            with self._run_lock, metrics.stage("musicnn"):
+                out = self._sess.run(self._y, feed_dict={
+                    self._x: patches[start:start + self.batch_size],
+                    self._is_training: False
+                })
+            outputs.append(out)
+        return np.concatenate(outputs, axis=0)
+
+    def _top(self, likelihood_mean, top_n):
+        return [self.labels[idx] for idx in likelihood_mean.argsort()[-top_n:][::-1]]
+
+    def analyze(self, file_path, top_n=5):
+        """
+        返回 (概率最高的 top_n 个标签, 全部标签的平均概率向量)
+
+        概率向量为 float32，可作为推荐用的歌曲向量
+        """
+        likelihood_mean = np.mean(self.taggram(self.decode(file_path)), axis=0).astype(np.float32)
+        return self._top(likelihood_mean, top_n), likelihood_mean
+
+    def analyze_sampled(self, file_path, top_n=5, segments=8, strategy="even"):
+        """
+        只分析采样窗口的快速模式
+
+        返回:
+        (标签, 平均概率向量, 是否为采样结果)；曲子较短或格式不支持采样时退回整曲分析
+        """
+        patches = self.decode_segments(file_path, segments, strategy)
+        if patches is None:
+            return (*self.analyze(file_path, top_n), False)
+        likelihood_mean = np.mean(self.taggram(patches), axis=0).astype(np.float32)
+        return self._top(likelihood_mean, top_n), likelihood_mean, True
+
+    def top_tags(self, file_path, top_n=5):
+        """与 musicnn.tagger.top_tags 相同，返回概率最高的 top_n 个标签"""
+        return self.analyze(file_path, top_n)[0]
+
+    def _decode_all(self, file_paths):
+        """在线程池中解码，按完成顺序产出 (路径, patch数组, 错误信息)"""
+        paths = iter(file_paths)
+        # 限制同时在内存中的解码结果数量
+        window = max(1, self.decode_workers * 2)
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+            running = {}
+            for path in paths:
+                running[executor.submit(self.decode, path)] = path
+                if len(running) >= window:
+                    break
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = running.pop(future)
+                    try:
+                        yield path, future.result(), None
+                    except Exception as e:
+                        yield path, None, str(e)
+                    next_path = next(paths, None)
+                    if next_path is not None:
+                        running[executor.submit(self.decode, next_path)] = next_path
+
+    def _flush(self, pending, top_n):
+        taggram = self.taggram(np.concatenate([patches for _, patches in pending], axis=0))
+        offset = 0
+        for path, patches in pending:
+            likelihood_mean = np.mean(taggram[offset:offset + len(patches)], axis=0).astype(np.float32)
+            offset += len(patches)
+            yield {"path": path, "labels": self._top(likelihood_mean, top_n), "embedding": likelihood_mean}
+
+    def tag_files(self, file_paths, top_n=5):
+        """
+        批量为音乐文件打标签
+
+        参数:
+        file_paths -- 音乐文件路径列表
+        top_n -- 每个文件返回的标签数量
+
+        返回:
+        生成器，按处理完成顺序逐个产出 {"path", "labels", "embedding"} 或 {"path", "error"}
+        """
+        pending = []
+        pending_count = 0
+        for path, patches, error in self._decode_all(file_paths):
+            if error is not None:
+                yield {"path": path, "error": error}
+                continue
+            pending.append((path, patches))
+            pending_count += len(patches)
+            if pending_count >= self.batch_size:
+                yield from self._flush(pending, top_n)
+                pending = []
+                pending_count = 0
+        if pending:
+            yield from self._flush(pending, top_n)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# 指纹采样的块大小与块数（文件头、中间、文件尾）
+SAMPLE_BLOCK_SIZE = 64 * 1024
+SAMPLE_BLOCKS = 3
+
+
+def file_fingerprint(file_path):
+    """
+    计算文件的快速内容指纹
+
+    由文件大小、修改时间以及若干采样块的哈希组成，不读取整个文件；
+    与路径无关，因此重命名或移动后的文件仍能命中缓存。
+    """
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(file_path, 'rb') as f:
+        if stat.st_size <= SAMPLE_BLOCK_SIZE * SAMPLE_BLOCKS:
+            digest.update(f.read())
+        else:
+            step = (stat.st_size - SAMPLE_BLOCK_SIZE) // (SAMPLE_BLOCKS - 1)
+            for i in range(SAMPLE_BLOCKS):
+                f.seek(i * step)
+                digest.update(f.read(SAMPLE_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def default_cache_path(db_path):
+    """缓存数据库放在 -db_path 旁边"""
+    root, _ = os.path.splitext(db_path)
+    return root + '.cache.sqlite'
+
+
+class ResultCache:
+    """
+    以内容指纹 + 模型标识为键的持久化结果缓存
+
+    结果以 JSON 形式存放在独立的 SQLite 文件中，超过 max_entries 时按最近访问时间淘汰（LRU）。
+    """
+
+    def __init__(self, cache_path, max_entries=10000):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._open()
+        if hasattr(os, 'register_at_fork'):
+            # SQLite 连接不能跨 fork 使用，生产模式的工作进程各自重新打开
+            os.register_at_fork(after_in_child=self._open)
+
+    def _open(self):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS result_cache (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                value TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_access ON result_cache(last_access)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, fingerprint):
+        return f"{model}:{fingerprint}"
+
+    def get(self, model, file_path):
+        """
+        查询缓存
+
+        参数:
+        model -- 模型标识（模型名及影响结果的参数）
+        file_path -- 媒体文件路径
+
+        返回:
+        (缓存键, 结果)；未命中时结果为 None，缓存键可直接用于 put
+        """
+        key = self.make_key(model, file_fingerprint(file_path))
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM result_cache WHERE cache_key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return key, None
+            self.hits += 1
+            self._conn.execute(
+                'UPDATE result_cache SET last_access = ? WHERE cache_key = ?', (time.time(), key)
+            )
+            self._conn.commit()
+        return key, json.loads(row[0])
+
+    def put(self, key, model, value):
+        """写入缓存，超出容量时淘汰最久未访问的条目"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO result_cache (cache_key, model, value, last_access) VALUES (?, ?, ?, ?)',
+                (key, model, json.dumps(value, ensure_ascii=False), time.time())
+            )
+            count = self._conn.execute('SELECT COUNT(*) FROM result_cache').fetchone()[0]
+            if count > self.max_entries:
+                cursor = self._conn.execute('''
+                    DELETE FROM result_cache WHERE cache_key IN (
+                        SELECT cache_key FROM result_cache ORDER BY last_access ASC LIMIT ?
+                    )
+                ''', (count - self.max_entries,))
+                self.evictions += cursor.rowcount
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM result_cache').fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
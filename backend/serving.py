@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import signal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 控制各数值库算子内线程数的环境变量，需在导入这些库之前设置
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS")
+
+
+def pin_threads(num_threads):
+    """
+    限制 TensorFlow / PyTorch / OpenMP 的算子内线程数，避免多个工作进程争抢 CPU
+
+    在导入这些库之前调用最可靠；已导入的 torch / tensorflow 也会尽量同步设置。
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(num_threads)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(num_threads)
+    tf = sys.modules.get("tensorflow")
+    if tf is not None:
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        except RuntimeError:
+            # TF 运行时已初始化后不能再修改
+            pass
+
+
+def serve(app, host, port, workers=1, preload=None, on_worker_start=None):
+    """
+    生产模式服务：多线程 WSGI 服务器，POSIX 平台上可预先 fork 多个工作进程共享同一监听端口
+
+    参数:
+    app -- WSGI 应用
+    workers -- 工作进程数，1 或不支持 fork 的平台（Windows）上以单进程多线程运行
+    preload -- fork 之前在主进程中执行，用于导入重量级模块，子进程以写时复制方式共享
+    on_worker_start -- 每个工作进程开始接受请求前以进程序号调用，用于加载模型和启动后台线程
+    """
+    from werkzeug.serving import make_server
+
+    if preload is not None:
+        preload()
+    server = make_server(host, port, app, threaded=True)
+
+    if workers <= 1 or not hasattr(os, "fork"):
+        if workers > 1:
+            logger.warning("当前平台不支持 fork，以单进程多线程方式运行")
+        logger.info("生产模式服务启动: http://%s:%s", host, port)
+        if on_worker_start is not None:
+            on_worker_start(0)
+        server.serve_forever()
+        return
+
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                if on_worker_start is not None:
+                    on_worker_start(index)
+                server.serve_forever()
+            except Exception as e:
+                logger.exception("工作进程 %s 异常退出: %s", os.getpid(), e)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("生产模式服务启动: http://%s:%s，工作进程 %s", host, port, sorted(children))
+
+    # 工作进程意外退出时重新拉起，收到终止信号后等待全部退出
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logger.warning("工作进程 %s 已退出（状态 %s），重新启动", pid, status)
+            time.sleep(1)
+            spawn(index)
+    server.server_close()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import sqlite3
+
+import pytest
+
+# 后端模块为平铺的顶层模块，与 main.py 一样从 backend 目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LabelsDb:
+    """以前端的方式直接写 music_labels（不经过后端）"""
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS music_labels (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_name TEXT NOT NULL,
+                    file_path TEXT NOT NULL UNIQUE,
+                    style_label TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+    def connect(self):
+        return sqlite3.connect(self.path)
+
+    def insert(self, file_name, style_label):
+        with self.connect() as conn:
+            return conn.execute(
+                'INSERT INTO music_labels (file_name, file_path, style_label) VALUES (?, ?, ?)',
+                (file_name, f"/music/{file_name}", style_label)
+            ).lastrowid
+
+    def update(self, file_name, style_label):
+        with self.connect() as conn:
+            conn.execute(
+                'UPDATE music_labels SET style_label = ?, updated_at = CURRENT_TIMESTAMP WHERE file_name = ?',
+                (style_label, file_name)
+            )
+
+    def delete(self, file_name):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM music_labels WHERE file_name = ?', (file_name,))
+
+
+@pytest.fixture
+def labels_db(tmp_path):
+    db = LabelsDb(str(tmp_path / "music.db"))
+    db.insert("a.mp3", "rock, pop")
+    db.insert("b.mp3", "rock, pop")
+    db.insert("c.mp3", "jazz, blues")
+    db.insert("d.mp3", "jazz")
+    return db
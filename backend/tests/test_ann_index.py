@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import ann_index
+from ann_index import IVFIndex, BRUTE_FORCE_LIMIT
+
+
+def random_vectors(count, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+def test_removed_slots_are_reused():
+    index = IVFIndex(16)
+    slots = index.add(random_vectors(100))
+    for round_ in range(50):
+        # 逐个替换：先删后插
+        index.remove(slots[:10])
+        slots = np.concatenate([slots[10:], index.add(random_vectors(10, seed=round_ + 1))])
+    assert len(index) == 100
+    assert index._size == 100
+    assert sorted(slots.tolist()) == list(range(100))
+
+
+def test_retrain_is_triggered_by_live_vectors(monkeypatch):
+    index = IVFIndex(16)
+    slots = index.add(random_vectors(BRUTE_FORCE_LIMIT // 2))
+    index.remove(slots)
+    index.add(random_vectors(BRUTE_FORCE_LIMIT // 2, seed=1))
+    assert index._size == BRUTE_FORCE_LIMIT // 2
+
+    calls = []
+    monkeypatch.setattr(IVFIndex, "train", lambda self, iterations=10: calls.append(len(self)))
+    index.add(random_vectors(10, seed=2))
+    assert calls == []
+
+
+def test_removed_vectors_leave_the_inverted_lists(monkeypatch):
+    monkeypatch.setattr(ann_index, "BRUTE_FORCE_LIMIT", 64)
+    vectors = random_vectors(256)
+    index = IVFIndex(16, nprobe=64)
+    slots = index.add(vectors)
+    assert index.centroids is not None
+
+    index.remove(slots[:128])
+    assert sum(len(members) for members in index._lists) == 128
+    found, _ = index.search(vectors[0], 5)
+    assert not set(found.tolist()) & set(slots[:128].tolist())
+
+    reused = index.add(vectors[:128])
+    assert sorted(reused.tolist()) == sorted(slots[:128].tolist())
+    found, _ = index.search(vectors[0], 1)
+    assert found[0] in reused.tolist()
+
+
+def test_search_with_non_positive_k():
+    index = IVFIndex(16)
+    index.add(random_vectors(10))
+    assert len(index.search(random_vectors(1)[0], 0)[0]) == 0
+    assert len(index.search(random_vectors(1)[0], -5)[0]) == 0
+
+
+def test_save_and_load_keep_free_slots(tmp_path):
+    index = IVFIndex(16)
+    slots = index.add(random_vectors(20))
+    index.remove(slots[:5])
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded, _ = IVFIndex.load(path)
+    assert len(loaded) == 15
+    loaded.add(random_vectors(5, seed=1))
+    assert loaded._size == 20
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import sqlite3
+import threading
+import subprocess
+
+import pytest
+
+from emotion_jobs import EmotionJobQueue, QueueFullError
+
+
+def wait_finished(jobs, job_id, timeout=5):
+    version = -1
+    while True:
+        job, version = jobs.wait_for_change(job_id, version, timeout=timeout)
+        assert job is not None
+        if job['status'] in ('done', 'failed'):
+            return job
+
+
+def test_job_reports_stages_and_result():
+    def run(path, progress):
+        progress("decoding")
+        return {"path": path}
+
+    jobs = EmotionJobQueue(run)
+    job, existing = jobs.submit("a.mp4")
+    assert not existing
+    result = wait_finished(jobs, job.id)
+    assert result['status'] == 'done'
+    assert result['stage'] == 'done'
+    assert result['result'] == {"path": "a.mp4"}
+
+
+def test_failed_job_reports_error():
+    def run(path, progress):
+        raise RuntimeError("无法解码")
+
+    jobs = EmotionJobQueue(run)
+    job, _ = jobs.submit("a.mp4")
+    result = wait_finished(jobs, job.id)
+    assert result['status'] == 'failed'
+    assert result['error'] == "无法解码"
+
+
+def test_same_path_is_deduplicated_while_active():
+    release = threading.Event()
+    jobs = EmotionJobQueue(lambda path, progress: release.wait(5))
+    first, _ = jobs.submit("a.mp4")
+    second, existing = jobs.submit("a.mp4")
+    assert existing and second.id == first.id
+
+    release.set()
+    wait_finished(jobs, first.id)
+    # 已结束的任务不再去重
+    third, existing = jobs.submit("a.mp4")
+    assert not existing and third.id != first.id
+
+
+def test_full_queue_rejects_new_jobs():
+    release = threading.Event()
+    started = threading.Event()
+
+    def run(path, progress):
+        started.set()
+        release.wait(5)
+
+    jobs = EmotionJobQueue(run, workers=1, max_queue=1)
+    jobs.submit("running.mp4")
+    assert started.wait(5)
+    jobs.submit("queued.mp4")
+    with pytest.raises(QueueFullError):
+        jobs.submit("rejected.mp4")
+    release.set()
+
+
+def test_timed_out_job_frees_its_worker():
+    stuck = threading.Event()
+
+    def run(path, progress):
+        if path == "stuck.mp4":
+            stuck.wait(5)
+        return path
+
+    jobs = EmotionJobQueue(run, workers=1, timeout=0.2)
+    slow, _ = jobs.submit("stuck.mp4")
+    fast, _ = jobs.submit("fast.mp4")
+    assert wait_finished(jobs, slow.id)['status'] == 'failed'
+    # 超时的分析仍在后台运行时，下一个任务照常完成
+    assert wait_finished(jobs, fast.id)['result'] == "fast.mp4"
+    assert jobs.stats()["stalled"] == 1
+
+    stuck.set()
+    for _ in range(50):
+        if jobs.stats()["stalled"] == 0:
+            break
+        time.sleep(0.1)
+    assert jobs.stats()["stalled"] == 0
+
+
+def test_stalled_analyses_count_against_capacity():
+    stuck = threading.Event()
+    ran = []
+
+    def run(path, progress):
+        ran.append(path)
+        if path.startswith("stuck"):
+            stuck.wait(5)
+        return path
+
+    jobs = EmotionJobQueue(run, workers=1, timeout=0.2, max_stalled=1)
+    first, _ = jobs.submit("stuck-1.mp4")
+    second, _ = jobs.submit("stuck-2.mp4")
+    third, _ = jobs.submit("fast.mp4")
+    assert wait_finished(jobs, first.id)['status'] == 'failed'
+    assert wait_finished(jobs, second.id)['status'] == 'failed'
+    # 后台名额已满，工作线程等待超时的分析结束后才处理下一个任务
+    time.sleep(0.3)
+    assert jobs.get(third.id)['status'] == 'queued' and "fast.mp4" not in ran
+
+    stuck.set()
+    assert wait_finished(jobs, third.id)['status'] == 'done'
+
+
+def test_jobs_are_shared_through_the_store(tmp_path):
+    store = str(tmp_path / "jobs.db")
+    release = threading.Event()
+    # 模拟两个工作进程：只在 worker 中处理任务，在 front 中提交和查询
+    front = EmotionJobQueue(lambda path, progress: path, store_path=store, start=False)
+    worker = EmotionJobQueue(lambda path, progress: release.wait(5) and path.upper(), store_path=store)
+
+    job, existing = front.submit("a.mp4")
+    assert not existing
+    again, existing = worker.submit("a.mp4")
+    assert existing and again.id == job.id
+
+    release.set()
+    result = wait_finished(front, job.id)
+    assert result['status'] == 'done' and result['result'] == "A.MP4"
+    assert worker.get(job.id) == front.get(job.id)
+
+
+def test_jobs_of_exited_processes_are_failed(tmp_path):
+    store = str(tmp_path / "jobs.db")
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+
+    front = EmotionJobQueue(lambda path, progress: path, store_path=store, start=False)
+    job, _ = front.submit("a.mp4")
+    with sqlite3.connect(store) as conn:
+        conn.execute("UPDATE jobs SET status = 'running', owner = ? WHERE id = ?", (child.pid, job.id))
+
+    EmotionJobQueue(lambda path, progress: path, store_path=store)
+    assert front.get(job.id)['status'] == 'failed'
+    # 同一路径可以重新提交
+    assert not front.submit("a.mp4")[1]
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from library_watcher import TagWorkQueue, PRIORITY_NORMAL, PRIORITY_PLAYING, PRIORITY_REFINE
+
+
+def test_failure_demotes_only_prioritized_files(tmp_path):
+    queue = TagWorkQueue(str(tmp_path / "queue.db"))
+    queue.record([("/m/refine.mp3", 1, 1)], priority=PRIORITY_REFINE)
+    queue.record([("/m/playing.mp3", 1, 1)], priority=PRIORITY_PLAYING)
+    queue.record([("/m/normal.mp3", 1, 1)])
+
+    queue.fail({"/m/refine.mp3": "解码失败", "/m/playing.mp3": "解码失败"})
+    # 插队的文件降回普通优先级，细化任务仍排在普通任务之后
+    assert queue.take(3) == ["/m/playing.mp3", "/m/normal.mp3", "/m/refine.mp3"]
+    priorities = dict(queue._conn.execute('SELECT path, priority FROM tag_queue'))
+    assert priorities == {"/m/refine.mp3": PRIORITY_REFINE, "/m/playing.mp3": PRIORITY_NORMAL,
+                          "/m/normal.mp3": PRIORITY_NORMAL}
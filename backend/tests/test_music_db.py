@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from music_db import MusicDatabase
+from conftest import LabelsDb
+
+
+def test_reader_pool_is_bounded_and_reused(labels_db):
+    db = MusicDatabase(labels_db.path, pool_size=2)
+
+    def read():
+        for _ in range(50):
+            assert len(db.query("labels_all")) == 4
+
+    # 每个请求一个新线程，与多线程 WSGI 服务器相同
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert db._reader_count <= 2
+    assert db._readers.qsize() == db._reader_count
+
+
+def test_paths_with_uri_special_characters(tmp_path):
+    labels = LabelsDb(str(tmp_path / "曲库 #1?%.db"))
+    labels.insert("a.mp3", "rock")
+    db = MusicDatabase(labels.path)
+    assert db.query("labels_all") == [(1, "a.mp3", "rock")]
+    with db.write("update") as conn:
+        conn.execute("UPDATE music_labels SET style_label = 'pop'")
+    assert db.query("labels_all", one=True) == (1, "a.mp3", "pop")
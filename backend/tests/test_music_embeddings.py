@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from music_recommender import MusicEmbeddingIndex
+
+DIM = 8
+
+
+def vector(i):
+    """第 i 维为主的向量，i 相同的歌曲互为最近邻"""
+    v = np.full(DIM, 0.01, dtype=np.float32)
+    v[i % DIM] = 1.0
+    return v
+
+
+def make_index(tmp_path):
+    return MusicEmbeddingIndex(str(tmp_path / "music.db"), index_path=str(tmp_path / "music.ann.npz"))
+
+
+def test_incremental_insert_replace_and_delete(tmp_path):
+    index = make_index(tmp_path)
+    index.add_embeddings([("/m/a.mp3", vector(0)), ("/m/b.mp3", vector(0)), ("/m/c.mp3", vector(1))], "test")
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+    assert index.recommend("missing.mp3", 1) is None
+
+    # 同一秒内替换两次，行数不变
+    index.add_embedding("/m/c.mp3", vector(0), "test")
+    assert sorted(index.recommend("a.mp3", 2)) == ["b.mp3", "c.mp3"]
+    index.add_embedding("/m/c.mp3", vector(1), "test")
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+
+    # 先删后插，行数不变
+    index.remove_embeddings(["/m/b.mp3"])
+    index.add_embedding("/m/d.mp3", vector(0), "test")
+    assert index.recommend("a.mp3", 1) == ["d.mp3"]
+    assert index.recommend("b.mp3", 1) is None
+
+
+def test_duplicate_file_names_resolve_to_first_row(tmp_path):
+    index = make_index(tmp_path)
+    index.add_embeddings([("/x/a.mp3", vector(0)), ("/y/a.mp3", vector(1)), ("/m/b.mp3", vector(1))], "test")
+    # 同名文件取 id 最小的一行，删除后改用下一行
+    assert index.recommend("a.mp3", 1) == ["a.mp3"]
+    index.remove_embeddings(["/x/a.mp3"])
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+
+
+def test_saved_index_applies_changes_made_after_saving(tmp_path):
+    index = make_index(tmp_path)
+    index.add_embeddings([("/m/a.mp3", vector(0)), ("/m/b.mp3", vector(0)), ("/m/c.mp3", vector(1))], "test")
+    index.recommend("a.mp3", 1)
+    index.save()
+
+    index.remove_embeddings(["/m/b.mp3"])
+    index.add_embedding("/m/d.mp3", vector(0), "test")
+
+    reloaded = make_index(tmp_path)
+    assert reloaded.recommend("a.mp3", 1) == ["d.mp3"]
+    assert reloaded.recommend("b.mp3", 1) is None
+    assert reloaded.recommend("c.mp3", 3) is not None
+
+
+def test_saved_index_from_another_database_is_rebuilt(tmp_path):
+    index = make_index(tmp_path)
+    index.add_embeddings([("/m/%d.mp3" % i, vector(i)) for i in range(5)], "test")
+    index.recommend("0.mp3", 1)
+    index.save()
+
+    # 数据库被重建后序号从头开始，持久化的索引不能再用
+    (tmp_path / "music.db").unlink()
+    fresh = make_index(tmp_path)
+    fresh.add_embeddings([("/m/a.mp3", vector(0)), ("/m/b.mp3", vector(0))], "test")
+    assert fresh.recommend("a.mp3", 1) == ["b.mp3"]
+    assert fresh.recommend("0.mp3", 1) is None
+
+
+def test_non_positive_top_n_returns_nothing(tmp_path):
+    index = make_index(tmp_path)
+    index.add_embeddings([("/m/a.mp3", vector(0)), ("/m/b.mp3", vector(0)), ("/m/c.mp3", vector(1))], "test")
+    assert index.recommend("a.mp3", 0) == []
+    assert index.recommend("a.mp3", -2) == []
+    assert index.recommend_blend(["a.mp3"], -1) == []
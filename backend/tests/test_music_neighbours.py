@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from music_recommender import MusicRecommenderIndex
+
+
+def _lookups(index):
+    return index.db.stats().get("neighbours_of", {}).get("count", 0)
+
+
+def test_precomputed_neighbours_are_used(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    assert index.precompute_neighbours(top_k=3) == 4
+    assert index.precompute_neighbours(top_k=3) == 0
+
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+    assert _lookups(index) == 1
+    # 超过预计算的数量时回退到矩阵
+    index.recommend("a.mp3", 5)
+    assert _lookups(index) == 1
+
+
+def test_label_change_makes_neighbours_stale(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    index.precompute_neighbours(top_k=3)
+    labels_db.update("d.mp3", "rock, pop")
+
+    assert sorted(index.recommend("a.mp3", 2)) == ["b.mp3", "d.mp3"]
+    assert _lookups(index) == 0
+    assert index.precompute_neighbours(top_k=3) == 4
+    assert sorted(index.recommend("a.mp3", 2)) == ["b.mp3", "d.mp3"]
+    assert _lookups(index) == 1
+
+
+def test_other_instance_sees_recomputed_neighbours(labels_db):
+    reader = MusicRecommenderIndex(labels_db.path)
+    reader.NEIGHBOURS_RECHECK_SECONDS = 0
+    writer = MusicRecommenderIndex(labels_db.path)
+    writer.precompute_neighbours(top_k=3)
+    reader.recommend("a.mp3", 1)
+    assert _lookups(reader) == 1
+
+    # 多进程时由另一个进程重新预计算，这里的内存状态过期后应重新读取近邻状态
+    labels_db.update("d.mp3", "rock, pop")
+    assert sorted(reader.recommend("a.mp3", 2)) == ["b.mp3", "d.mp3"]
+    assert _lookups(reader) == 1
+    writer.precompute_neighbours(top_k=3)
+    assert sorted(reader.recommend("a.mp3", 2)) == ["b.mp3", "d.mp3"]
+    assert _lookups(reader) == 2
+
+
+def test_legacy_neighbours_meta_is_ignored(labels_db):
+    MusicRecommenderIndex(labels_db.path)
+    with labels_db.connect() as conn:
+        conn.execute("INSERT INTO music_neighbours_meta (key, value) VALUES ('row_count', '4')")
+        conn.execute("INSERT INTO music_neighbours_meta (key, value) VALUES ('last_updated', '2024-01-01')")
+
+    index = MusicRecommenderIndex(labels_db.path)
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+    assert _lookups(index) == 0
+    assert index.precompute_neighbours(top_k=3) == 4
+
+
+def test_precompute_commits_in_short_transactions(labels_db):
+    for i in range(20):
+        labels_db.insert(f"x{i}.mp3", "rock" if i % 2 else "jazz")
+    index = MusicRecommenderIndex(labels_db.path)
+    # 每块只有一行，每行的近邻单独提交
+    assert index.precompute_neighbours(top_k=3, block_elements=1) == 24
+    assert index.db.stats()["save_neighbours"]["count"] == 25
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+    assert _lookups(index) == 1
+
+    with labels_db.connect() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        assert conn.execute('SELECT COUNT(*) FROM music_neighbours').fetchone()[0] == 24 * 3
+    assert "music_neighbours_new" not in tables
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from library_watcher import write_style_labels
+from music_recommender import MusicRecommenderIndex, get_music_recommendations
+
+
+def test_recommend_ranks_by_shared_tags(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+    assert index.recommend("c.mp3", 1) == ["d.mp3"]
+    assert index.recommend("missing.mp3", 3) == []
+
+
+def test_refresh_sees_updates_within_the_same_second(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    assert index.recommend("c.mp3", 1) == ["d.mp3"]
+
+    # 两次更新落在同一秒内，行数和 MAX(updated_at) 都不变
+    labels_db.update("d.mp3", "rock, pop")
+    assert sorted(index.recommend("a.mp3", 2)) == ["b.mp3", "d.mp3"]
+    labels_db.update("d.mp3", "jazz, blues")
+    assert index.recommend("c.mp3", 1) == ["d.mp3"]
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+
+
+def test_refresh_sees_delete_followed_by_insert(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    assert index.recommend("a.mp3", 1) == ["b.mp3"]
+
+    # 行数不变
+    labels_db.delete("b.mp3")
+    labels_db.insert("e.mp3", "jazz, blues")
+    assert "b.mp3" not in index.recommend("a.mp3", 5)
+    assert index.recommend("c.mp3", 1) == ["e.mp3"]
+    assert index.recommend("b.mp3", 3) == []
+
+
+def test_refresh_sees_backend_upserts(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    assert index.recommend("c.mp3", 1) == ["d.mp3"]
+
+    # 后台打标签以 UPSERT 写入，触发器内不能依赖冲突处理
+    write_style_labels(index.db, [{"path": "/music/b.mp3", "labels": ["jazz", "blues"]}])
+    write_style_labels(index.db, [{"path": "/music/b.mp3", "labels": ["jazz", "blues", "soul"]},
+                                  {"path": "/music/e.mp3", "labels": ["jazz", "blues"]}])
+    assert index.recommend("c.mp3", 1) == ["e.mp3"]
+    assert sorted(index.recommend("b.mp3", 2)) == ["c.mp3", "e.mp3"]
+
+
+def test_incremental_refresh_matches_full_rebuild(labels_db):
+    index = MusicRecommenderIndex(labels_db.path)
+    index.recommend("a.mp3", 3)
+    labels_db.update("a.mp3", "jazz")
+    labels_db.insert("f.mp3", '["rock", "jazz"]')
+    labels_db.delete("c.mp3")
+
+    fresh = MusicRecommenderIndex(labels_db.path)
+    for name in ("a.mp3", "b.mp3", "d.mp3", "f.mp3"):
+        assert sorted(index.recommend(name, 5)) == sorted(fresh.recommend(name, 5))
+
+
+def test_one_shot_helper_does_not_change_the_schema(labels_db):
+    with labels_db.connect() as conn:
+        before = conn.execute('SELECT type, name FROM sqlite_master ORDER BY name').fetchall()
+    assert get_music_recommendations(labels_db.path, "a.mp3", 1) == ["b.mp3"]
+    with labels_db.connect() as conn:
+        assert conn.execute('SELECT type, name FROM sqlite_master ORDER BY name').fetchall() == before
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal'
+    index = MusicRecommenderIndex(labels_db.path)
+    assert get_music_recommendations(labels_db.path, "c.mp3", 1) == index.recommend("c.mp3", 1)
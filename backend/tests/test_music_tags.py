@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from library_watcher import write_style_labels
+from music_recommender import MusicTagIndex
+
+
+def _postings(index):
+    with index.db.write("read_tags") as conn:
+        return sorted(conn.execute('''
+            SELECT t.track_id, n.name, t.weight FROM music_tags t
+            JOIN music_tag_names n ON n.id = t.tag_id
+        ''').fetchall())
+
+
+def _rebuilt(db_path):
+    index = MusicTagIndex(db_path)
+    index.sync()
+    with index.db.write("reset_tags") as conn:
+        conn.execute('DELETE FROM music_tags_meta')
+    index.sync()
+    return _postings(index)
+
+
+def test_recommend_ranks_by_shared_tags(labels_db):
+    index = MusicTagIndex(labels_db.path)
+    assert index.recommend("a.mp3", 3) == ["b.mp3"]
+    assert index.recommend("c.mp3", 3) == ["d.mp3"]
+    assert index.recommend("missing.mp3", 3) == []
+
+
+def test_sync_is_incremental(labels_db):
+    index = MusicTagIndex(labels_db.path)
+    assert index.sync() == 4
+    assert index.sync() == 0
+
+    labels_db.update("d.mp3", "rock, pop")
+    assert index.sync() == 1
+    assert sorted(index.recommend("a.mp3", 3)) == ["b.mp3", "d.mp3"]
+
+    # 行数不变的先删后插
+    labels_db.delete("b.mp3")
+    labels_db.insert("e.mp3", "jazz, blues")
+    assert index.recommend("a.mp3", 3) == ["d.mp3"]
+    assert index.recommend("c.mp3", 3) == ["e.mp3"]
+
+
+def test_incremental_sync_matches_full_rebuild(labels_db):
+    index = MusicTagIndex(labels_db.path)
+    index.SYNC_CHUNK = 2
+    index.sync()
+    labels_db.update("a.mp3", "jazz")
+    labels_db.insert("f.mp3", '["rock", "jazz"]')
+    labels_db.delete("c.mp3")
+    write_style_labels(index.db, [{"path": "/music/b.mp3", "labels": ["jazz", "soul"]}])
+    index.sync()
+
+    assert _postings(index) == _rebuilt(labels_db.path)
+
+
+def test_initial_build_is_chunked(labels_db):
+    reference = _rebuilt(labels_db.path)
+    index = MusicTagIndex(labels_db.path)
+    index.SYNC_CHUNK = 1
+    with index.db.write("reset_tags") as conn:
+        conn.execute('DELETE FROM music_tags_meta')
+    assert index.sync() == 4
+    assert _postings(index) == reference
+    # 首次全量解析按块分成多个短事务，每块只解析 SYNC_CHUNK 首
+    assert index.db.stats()["sync_tags"]["count"] >= 5
+
+
+def test_initial_build_resumes_and_catches_up(labels_db):
+    first = MusicTagIndex(labels_db.path)
+    first.SYNC_CHUNK = 2
+    first.sync()
+    with first.db.write("reset_tags") as conn:
+        conn.execute('DELETE FROM music_tags_meta')
+    # 模拟解析到一半时进程退出，期间前端改写了已解析和未解析的行
+    version = first.db.query("labels_version", one=True)[0]
+    assert first._sync_chunk(version) == 0
+    assert first._sync_chunk(version) == 2
+    labels_db.update("a.mp3", "jazz")
+    labels_db.delete("d.mp3")
+    labels_db.insert("e.mp3", "rock, pop")
+
+    second = MusicTagIndex(labels_db.path)
+    second.sync()
+    assert _postings(second) == _rebuilt(labels_db.path)
+
+
+def test_other_instance_does_not_reparse(labels_db):
+    first = MusicTagIndex(labels_db.path)
+    second = MusicTagIndex(labels_db.path)
+    assert first.sync() == 4
+    # 已同步的序号保存在数据库中，其他进程不会重复解析
+    assert second.sync() == 0
+    labels_db.update("d.mp3", "rock")
+    assert second.sync() == 1
+    assert first.sync() == 0
+    assert first.recommend("d.mp3", 3) == ["a.mp3", "b.mp3"]
+
+
+def test_legacy_triggers_are_removed(labels_db):
+    with labels_db.connect() as conn:
+        conn.execute('CREATE TABLE music_tags_dirty (track_id INTEGER PRIMARY KEY)')
+        conn.execute('''
+            CREATE TRIGGER music_labels_tags_insert AFTER INSERT ON music_labels
+            BEGIN INSERT OR IGNORE INTO music_tags_dirty (track_id) VALUES (NEW.id); END
+        ''')
+
+    index = MusicTagIndex(labels_db.path)
+    index.sync()
+    with labels_db.connect() as conn:
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE tbl_name = 'music_labels'")}
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert "music_labels_tags_insert" not in names
+    assert "music_tags_dirty" not in tables
+    labels_db.insert("e.mp3", "jazz")
+    assert index.recommend("e.mp3", 1) == ["d.mp3"]
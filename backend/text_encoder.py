@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import logging
+
+import numpy as np
+import torch
+from transformers import BertTokenizer, BertModel
+
+logger = logging.getLogger(__name__)
+
+# 可选的文本编码后端
+TEXT_ENCODERS = ("fp32", "int8", "onnx")
+# BERT 输入窗口（token 数，含 [CLS] 和 [SEP]）
+MAX_LENGTH = 110
+
+
+def default_onnx_path(bert_model_path):
+    """
+    导出的 ONNX 模型默认保存在用户缓存目录（bert_path 可能只读）
+
+    文件名由 BERT 模型目录的绝对路径及其中各文件的大小和修改时间决定，替换模型后重新导出。
+    """
+    model_dir = os.path.abspath(bert_model_path)
+    digest = hashlib.blake2b(model_dir.encode("utf-8"), digest_size=8)
+    for entry in sorted(os.scandir(model_dir), key=lambda entry: entry.name):
+        if entry.is_file():
+            info = entry.stat()
+            digest.update(f"{entry.name}:{info.st_size}:{info.st_mtime_ns};".encode("utf-8"))
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_root, "soyo-player", "onnx", f"bert-{digest.hexdigest()}.onnx")
+
+
+class TorchTextEncoder:
+    """
+    PyTorch BERT 文本编码器
+
+    quantize 为 True 时对全部 Linear 层做动态 int8 量化（权重 int8，激活按批动态量化），
+    CPU 上通常快 1.5~2 倍，输出与 fp32 有少量偏差。
+    """
+
+    def __init__(self, bert_model_path, quantize=False):
+        self.name = "int8" if quantize else "fp32"
+        self.tokenizer = BertTokenizer.from_pretrained(bert_model_path, local_files_only=True)
+        model = BertModel.from_pretrained(bert_model_path, local_files_only=True)
+        model.eval()
+        self.hidden_size = model.config.hidden_size
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+
+    def encode(self, texts):
+        """
+        一次前向处理多条文本
+
+        返回:
+        每条文本一个 (有效token数, hidden_size) 的 float32 数组
+        """
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=MAX_LENGTH)
+        with torch.inference_mode():
+            outputs = self.model(**inputs)
+        hidden = outputs.last_hidden_state.numpy()
+        lengths = inputs["attention_mask"].sum(dim=1).tolist()
+        return [hidden[i, :length] for i, length in enumerate(lengths)]
+
+
+class OnnxTextEncoder:
+    """
+    ONNX Runtime BERT 文本编码器
+
+    onnx_path 不存在时先把 PyTorch 模型导出到该路径（动态 batch 和序列长度），之后直接加载；
+    未指定时使用 default_onnx_path。
+    """
+
+    INPUT_NAMES = ("input_ids", "attention_mask", "token_type_ids")
+
+    def __init__(self, bert_model_path, onnx_path=None, num_threads=0):
+        import onnxruntime
+
+        self.name = "onnx"
+        self.tokenizer = BertTokenizer.from_pretrained(bert_model_path, local_files_only=True)
+        self.onnx_path = onnx_path or default_onnx_path(bert_model_path)
+        if not os.path.exists(self.onnx_path):
+            self._export(bert_model_path)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            self.onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.hidden_size = self.session.get_outputs()[0].shape[-1]
+        self._input_names = {node.name for node in self.session.get_inputs()}
+
+    def _export(self, bert_model_path):
+        logger.info("导出 BERT 到 ONNX: %s", self.onnx_path)
+        model = BertModel.from_pretrained(bert_model_path, local_files_only=True)
+        model.eval()
+        sample = self.tokenizer(["export sample"], return_tensors="pt")
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in self.INPUT_NAMES}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        os.makedirs(os.path.dirname(os.path.abspath(self.onnx_path)), exist_ok=True)
+        # 先写临时文件再替换，避免导出中断留下不完整的模型；多个进程同时导出时各写各的临时文件
+        temp_path = f"{self.onnx_path}.{os.getpid()}.tmp"
+        # torch.onnx.export 需要追踪计算图，不能在 inference_mode 下运行
+        try:
+            with torch.no_grad():
+                torch.onnx.export(
+                    model,
+                    tuple(sample[name] for name in self.INPUT_NAMES),
+                    temp_path,
+                    input_names=list(self.INPUT_NAMES),
+                    output_names=["last_hidden_state"],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14
+                )
+            os.replace(temp_path, self.onnx_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def encode(self, texts):
+        inputs = self.tokenizer(texts, return_tensors="np", padding=True, truncation=True, max_length=MAX_LENGTH)
+        feed = {name: inputs[name].astype(np.int64) for name in self.INPUT_NAMES if name in self._input_names}
+        hidden = self.session.run(["last_hidden_state"], feed)[0]
+        lengths = inputs["attention_mask"].sum(axis=1).tolist()
+        return [hidden[i, :length] for i, length in enumerate(lengths)]
+
+
+def build_text_encoder(kind, bert_model_path, num_threads=0, onnx_path=None):
+    """
+    创建文本编码器
+
+    参数:
+    kind -- "fp32"、"int8"（动态量化）或 "onnx"（ONNX Runtime）
+    num_threads -- 编码使用的线程数，0 表示沿用进程设置
+
+    返回:
+    具有 tokenizer、hidden_size 属性和 encode(texts) 方法的编码器
+    """
+    if kind not in TEXT_ENCODERS:
+        raise ValueError(f"未知的文本编码器: {kind}")
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    logger.info("Loading BERT model from: %s (%s)", bert_model_path, kind)
+    if kind == "onnx":
+        return OnnxTextEncoder(bert_model_path, onnx_path=onnx_path, num_threads=num_threads)
+    return TorchTextEncoder(bert_model_path, quantize=(kind == "int8"))
@@ -5,6 +5,9 @@ import userDB from './database';
 import { musicSuffix } from './util';
 import { translateMusicLabel } from './musicLabelMapping';
 
+// 批量标签请求的空闲超时：超过该时间未收到任何数据即中止请求（与单个请求的超时一致）
+const BATCH_IDLE_TIMEOUT = 40000;
+
 /**
  * 音乐标签服务
  * 用于处理音乐文件的风格标签信息，包括本地数据库存储和API请求
@@ -180,59 +183,59 @@ class MusicLabelService {
       }
       
       const results = [];
+      let processed = 0;
       
-      // 分批处理
+      // 分批处理，每批一次请求，由后端常驻模型批量打标签并逐条返回
       for (let i = 0; i < total; i += batchSize) {
         const batch = unlabeledMusic.slice(i, i + batchSize);
+        const musicByPath = new Map(batch.map(music => [music.file_path, music]));
         
-        // 并行处理当前批次
-        const batchPromises = batch.map(async (music, batchIndex) => {
-          const currentIndex = i + batchIndex;
-          
-          // 调用进度回调
-          if (onProgress && typeof onProgress === 'function') {
-            onProgress(currentIndex, total, music.file_name);
-          }
-          
-          try {
-            // 获取标签
-            const styleLabel = await this.fetchMusicStyleLabel(music.file_path);
+        try {
+          await this.fetchMusicStyleLabels(batch.map(music => music.file_path), (result) => {
+            const music = musicByPath.get(result.path);
+            if (!music) {
+              return;
+            }
+            musicByPath.delete(result.path);
+            
+            // 调用进度回调
+            if (onProgress && typeof onProgress === 'function') {
+              onProgress(processed, total, music.file_name);
+            }
+            processed++;
             
-            if (styleLabel) {
+            if (Array.isArray(result.labels)) {
+              const styleLabel = JSON.stringify(result.labels);
               // 更新数据库
               userDB.updateMusicStyleLabel(music.file_path, styleLabel);
-              
-              return {
+              results.push({
                 filePath: music.file_path,
                 fileName: music.file_name,
                 success: true,
                 label: styleLabel
-              };
+              });
             } else {
-              return {
+              results.push({
                 filePath: music.file_path,
                 fileName: music.file_name,
                 success: false,
-                error: '无法获取标签'
-              };
+                error: result.error || '无法获取标签'
+              });
             }
-          } catch (error) {
-            console.error(`处理音乐文件标签失败: ${music.file_path}`, error);
-            return {
-              filePath: music.file_path,
-              fileName: music.file_name,
-              success: false,
-              error: error.message
-            };
-          }
-        });
-        
-        // 等待当前批次完成
-        const batchResults = await Promise.all(batchPromises);
-        results.push(...batchResults);
+          });
+        } catch (error) {
+          console.error('批量请求音乐风格标签失败:', error);
+        }
         
-        // 短暂延迟，避免API请求过快
-        await new Promise(resolve => setTimeout(resolve, 500));
+        // 未返回结果的文件记为失败
+        musicByPath.forEach(music => {
+          results.push({
+            filePath: music.file_path,
+            fileName: music.file_name,
+            success: false,
+            error: '无法获取标签'
+          });
+        });
       }
       
       return results;
@@ -301,6 +304,75 @@ class MusicLabelService {
     }
   }
 
+  /**
+   * 从批量API获取多个音乐文件的风格标签
+   * 后端以NDJSON逐行返回每个文件的结果，每收到一行即调用一次回调
+   * @param {Array<string>} filePaths - 音乐文件路径数组
+   * @param {Function} onResult - 结果回调，参数为 {path, labels} 或 {path, error}
+   * @returns {Promise<void>}
+   */
+  async fetchMusicStyleLabels(filePaths, onResult) {
+    // 后端逐条返回结果，整批耗时随文件数增长，因此不限制总时长；
+    // 每收到一段数据重新计时，后端卡住超过 BATCH_IDLE_TIMEOUT 时中止请求
+    const controller = new AbortController();
+    let timer = null;
+    const resetTimer = () => {
+      clearTimeout(timer);
+      timer = setTimeout(() => controller.abort(), BATCH_IDLE_TIMEOUT);
+    };
+    
+    try {
+      resetTimer();
+      const response = await fetch('http://localhost:22071/api/musiclabel/batch', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ paths: filePaths }),
+        signal: controller.signal
+      });
+      
+      if (!response.ok) {
+        throw new Error(`批量标签API响应错误: ${response.status}`);
+      }
+      
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder('utf-8');
+      let buffer = '';
+      
+      const handleLine = (line) => {
+        if (!line.trim()) {
+          return;
+        }
+        try {
+          onResult(JSON.parse(line));
+        } catch (error) {
+          console.error('解析批量标签结果失败:', line, error);
+        }
+      };
+      
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+          break;
+        }
+        resetTimer();
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(handleLine);
+      }
+      handleLine(buffer + decoder.decode());
+    } catch (error) {
+      if (controller.signal.aborted) {
+        throw new Error(`批量标签API超过 ${BATCH_IDLE_TIMEOUT / 1000} 秒未返回结果，已中止请求`);
+      }
+      throw error;
+    } finally {
+      clearTimeout(timer);
+    }
+  }
+
   /**
    * 更新音乐文件的风格标签
    * @param {string} filePath - 音乐文件路径